@@ -1,17 +1,261 @@
-from flask import Flask, render_template, url_for, flash, redirect, request
+from flask import Flask, render_template, url_for, flash, redirect, request, jsonify, g, abort, Response, send_file, stream_with_context, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager, UserMixin, login_user, current_user, logout_user, login_required
-from datetime import datetime
+from sqlalchemy import bindparam, event, literal, select, union_all
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import aliased, joinedload, Session
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.exceptions import HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
+from collections import Counter, defaultdict, namedtuple
+import base64
+import hmac
+import click
+import csv
+import io
+import json
+import logging
+import math
+import queue
+import random
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from archive import (LEDGER_TABLES, archive_filename, archive_schema, archive_year, archived_max_ids, duplicate_ids,
+                     ensure_sequence, ledger_from, uses_autoincrement)
+from reporting import CategoryTotal, PeriodMetrics, combine_metrics, monthly_flows, period_metrics
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key_here'
 import os
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(os.getcwd(), 'finance.db')
-print(f"Database path: {os.path.join(os.getcwd(), 'finance.db')}")
+DATABASE_PATH = os.environ.get('FINANCE_DB_PATH', os.path.join(os.getcwd(), 'finance.db'))
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DATABASE_PATH
+print(f"Database path: {DATABASE_PATH}")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# SQLite 连接参数：每个新连接都会设置以下 PRAGMA
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+# 负数表示以 KiB 为单位
+app.config['SQLITE_CACHE_SIZE'] = int(os.environ.get('SQLITE_CACHE_SIZE', -64000))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    'connect_args': {'timeout': app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000},
+}
+# 报表使用独立的只读连接，长查询不会占用收银写入需要的写锁
+app.config['REPORTS_READ_ONLY'] = os.environ.get('REPORTS_READ_ONLY', '1') == '1'
+app.config['SQLALCHEMY_BINDS'] = {'reports': app.config['SQLALCHEMY_DATABASE_URI']}
+# 列表页分页大小（可通过 ?per_page= 调整，但不超过最大值）
+app.config['LIST_PAGE_SIZE'] = 50
+app.config['LIST_MAX_PAGE_SIZE'] = 500
+# 首页统计缓存：memory 为进程内缓存；sqlite 为多个 worker 共享的文件缓存
+app.config['DASHBOARD_CACHE_BACKEND'] = os.environ.get('DASHBOARD_CACHE_BACKEND', 'memory')
+app.config['DASHBOARD_CACHE_PATH'] = os.environ.get('DASHBOARD_CACHE_PATH', os.path.join(os.getcwd(), 'cache.db'))
+app.config['DASHBOARD_CACHE_TTL'] = int(os.environ.get('DASHBOARD_CACHE_TTL', 60))
+# 批量导入销售时每批处理的行数
+app.config['IMPORT_CHUNK_SIZE'] = 5000
+# 导出时每次从数据库游标读取的行数
+app.config['EXPORT_BATCH_SIZE'] = 2000
+# 商品目录缓存检查数据库版本号的最小间隔（秒），其他 worker 的改价最多延迟这么久生效
+app.config['CATALOG_VERSION_CHECK_INTERVAL'] = float(os.environ.get('CATALOG_VERSION_CHECK_INTERVAL', 1.0))
+# 数据库被锁时写操作的重试次数和初始退避时间（秒）
+app.config['WRITE_RETRIES'] = 5
+app.config['WRITE_RETRY_BACKOFF'] = 0.05
+# 后台任务：每个进程同时执行的任务数，以及任务结果文件的保存目录
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_RESULT_DIR'] = os.environ.get('JOB_RESULT_DIR', os.path.join(os.getcwd(), 'job_results'))
+# SQL 监控：超过阈值（毫秒）的查询写入慢查询日志；同一请求内同一语句执行次数达到阈值视为 N+1
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 200))
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG', '')
+app.config['N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10))
+# /metrics 的访问令牌（请求头 Authorization: Bearer <令牌>）；未设置时 /metrics 拒绝所有请求
+# （不按来源地址放行：经反向代理转发的请求都来自本机）
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# 变更流：每次读取的默认和最大事件数
+app.config['CHANGE_FEED_BATCH_SIZE'] = 1000
+app.config['CHANGE_FEED_MAX_BATCH_SIZE'] = 10000
+# 首页实时推送：检查统计版本号的间隔（秒，本进程的写入会立即推送）、心跳间隔（秒）和每个连接最多积压的消息数
+app.config['DASHBOARD_STREAM_POLL'] = float(os.environ.get('DASHBOARD_STREAM_POLL', 1.0))
+app.config['DASHBOARD_STREAM_HEARTBEAT'] = 15
+app.config['DASHBOARD_STREAM_QUEUE'] = 100
+# 已归档年度明细的存放目录（每年一个 SQLite 文件），以及一次查询最多挂载的年度库数（SQLite 默认最多挂载10个）
+app.config['ARCHIVE_DIR'] = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(DATABASE_PATH), 'archive'))
+app.config['ARCHIVE_MAX_ATTACHED'] = 9
+# 补货建议：预测方法（ses 指数平滑 / sma 移动平均）、移动平均窗口（天）、平滑系数、补货周期（天）和服务水平 z 值
+app.config['FORECAST_METHOD'] = os.environ.get('FORECAST_METHOD', 'ses')
+app.config['FORECAST_WINDOW'] = 28
+app.config['FORECAST_ALPHA'] = 0.1
+app.config['REORDER_LEAD_DAYS'] = int(os.environ.get('REORDER_LEAD_DAYS', 7))
+app.config['REORDER_SERVICE_Z'] = 1.65
 
 db = SQLAlchemy(app)
+
+def apply_sqlite_pragmas(dbapi_connection, read_only):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+    cursor.execute(f"PRAGMA cache_size = {app.config['SQLITE_CACHE_SIZE']}")
+    cursor.execute(f"PRAGMA mmap_size = {app.config['SQLITE_MMAP_SIZE']}")
+    if read_only:
+        cursor.execute('PRAGMA query_only = ON')
+    else:
+        cursor.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
+        cursor.execute(f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.close()
+
+with app.app_context():
+    event.listen(db.engines[None], 'connect', lambda conn, record: apply_sqlite_pragmas(conn, False))
+    event.listen(db.engines['reports'], 'connect', lambda conn, record: apply_sqlite_pragmas(conn, True))
+
+# SQL 监控：统计每个请求的查询次数和耗时，记录慢查询和 N+1，并按 Flask 端点汇总成 /metrics
+sql_logger = logging.getLogger('finance.sql')
+if app.config['SLOW_QUERY_LOG']:
+    slow_query_handler = logging.FileHandler(app.config['SLOW_QUERY_LOG'], encoding='utf-8')
+    slow_query_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    sql_logger.addHandler(slow_query_handler)
+
+class RequestMetrics:
+    # 进程内指标，多个 worker 时每个 worker 各自统计
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency_buckets = defaultdict(lambda: [0] * len(self.BUCKETS))
+        self.latency_sum = defaultdict(float)
+        self.requests = defaultdict(int)
+        self.queries = defaultdict(int)
+        self.sql_seconds = defaultdict(float)
+        self.slow_queries = defaultdict(int)
+        self.n_plus_one = defaultdict(int)
+        self.lock_errors = defaultdict(int)
+        self.write_retries = defaultdict(int)
+        self.lock_wait_seconds = defaultdict(float)
+    
+    def observe(self, endpoint, seconds, n_plus_one):
+        with self.lock:
+            buckets = self.latency_buckets[endpoint]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            self.latency_sum[endpoint] += seconds
+            self.requests[endpoint] += 1
+            self.n_plus_one[endpoint] += n_plus_one
+    
+    def observe_query(self, endpoint, seconds, slow):
+        # 每条 SQL 执行后立即计入，流式响应在请求结束后执行的查询也能统计到
+        with self.lock:
+            self.queries[endpoint] += 1
+            self.sql_seconds[endpoint] += seconds
+            self.slow_queries[endpoint] += slow
+
+    def observe_lock_error(self, endpoint, waited, retried):
+        # waited：失败的那次尝试加上重试前退避的时间
+        with self.lock:
+            self.lock_errors[endpoint] += 1
+            self.write_retries[endpoint] += retried
+            self.lock_wait_seconds[endpoint] += waited
+    
+    def render(self):
+        # Prometheus 文本格式
+        lines = []
+        with self.lock:
+            lines.append('# HELP finance_request_duration_seconds 请求耗时')
+            lines.append('# TYPE finance_request_duration_seconds histogram')
+            for endpoint in sorted(self.requests):
+                label = f'endpoint="{endpoint}"'
+                for bound, count in zip(self.BUCKETS, self.latency_buckets[endpoint]):
+                    lines.append(f'finance_request_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'finance_request_duration_seconds_bucket{{{label},le="+Inf"}} {self.requests[endpoint]}')
+                lines.append(f'finance_request_duration_seconds_sum{{{label}}} {self.latency_sum[endpoint]:.6f}')
+                lines.append(f'finance_request_duration_seconds_count{{{label}}} {self.requests[endpoint]}')
+            counters = [
+                ('finance_sql_queries_total', 'SQL 查询次数', self.queries, '{}'),
+                ('finance_sql_seconds_total', 'SQL 执行总耗时（秒）', self.sql_seconds, '{:.6f}'),
+                ('finance_slow_queries_total', '慢查询次数', self.slow_queries, '{}'),
+                ('finance_n_plus_one_total', '疑似 N+1 的请求次数', self.n_plus_one, '{}'),
+                ('finance_lock_errors_total', '写事务遇到数据库锁的次数', self.lock_errors, '{}'),
+                ('finance_write_retries_total', '写事务重试次数', self.write_retries, '{}'),
+                ('finance_lock_wait_seconds_total', '因数据库锁失败的尝试及退避耗时（秒）', self.lock_wait_seconds, '{:.6f}'),
+            ]
+            for name, help_text, values, value_format in counters:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for endpoint in sorted(self.requests):
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {value_format.format(values[endpoint])}')
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+def before_sql(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def sql_error(exception_context):
+    # 执行出错时不会触发 after_cursor_execute，丢弃 before_sql 记下的开始时间
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_started'):
+        conn.info['query_started'].pop()
+
+def after_sql(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if not has_request_context():
+        return
+    endpoint = request.endpoint or 'unknown'
+    slow = elapsed * 1000 >= app.config['SLOW_QUERY_MS']
+    request_metrics.observe_query(endpoint, elapsed, slow)
+    if 'sql_statements' in g:
+        g.sql_statements[statement] += 1
+    if slow:
+        sql_logger.warning('慢查询 %.1fms [%s %s] %s', elapsed * 1000, endpoint, request.path,
+                           ' '.join(statement.split()))
+
+with app.app_context():
+    for engine in db.engines.values():
+        event.listen(engine, 'before_cursor_execute', before_sql)
+        event.listen(engine, 'after_cursor_execute', after_sql)
+        event.listen(engine, 'handle_error', sql_error)
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.sql_statements = Counter()
+
+@app.teardown_request
+def finish_request_metrics(exception=None):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    endpoint = request.endpoint or 'unknown'
+    repeated = [(statement, count) for statement, count in g.sql_statements.items()
+                if count >= app.config['N_PLUS_ONE_THRESHOLD']]
+    for statement, count in repeated:
+        sql_logger.warning('疑似 N+1：同一语句执行 %d 次 [%s %s] %s', count, endpoint, request.path,
+                           ' '.join(statement.split()))
+    request_metrics.observe(endpoint, time.perf_counter() - started, len(repeated))
+
+def get_report_session():
+    # 报表查询使用只读会话，请求结束时关闭
+    if not app.config['REPORTS_READ_ONLY']:
+        return db.session
+    if 'report_session' not in g:
+        g.report_session = Session(bind=db.engines['reports'])
+    return g.report_session
+
+@app.teardown_appcontext
+def close_report_session(exception=None):
+    session = g.pop('report_session', None)
+    if session is not None:
+        session.close()
+
 bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
@@ -38,6 +282,11 @@ class Product(db.Model):
     def __repr__(self):
         return f"商品('{self.name}', '{self.category}', '{self.price}')"
 
+class CatalogVersion(db.Model):
+    # 商品目录版本号：商品表有任何变更时由触发器递增，各 worker 据此刷新本地商品缓存
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
 class Supplier(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -54,11 +303,17 @@ class Purchase(db.Model):
     supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     total_cost = db.Column(db.Float, nullable=False)
-    purchase_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    purchase_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     
     product = db.relationship('Product', backref=db.backref('purchases', lazy=True))
     supplier = db.relationship('Supplier', backref=db.backref('purchases', lazy=True))
     
+    # AUTOINCREMENT：归档删除了往年的明细后，新记录也不会重用已归档的 id
+    __table_args__ = (
+        db.Index('ix_purchase_product_id_purchase_date', 'product_id', 'purchase_date'),
+        {'sqlite_autoincrement': True},
+    )
+    
     def __repr__(self):
         return f"采购记录('{self.product.name}', '{self.quantity}', '{self.purchase_date}')"
 
@@ -67,16 +322,35 @@ class Sale(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     total_amount = db.Column(db.Float, nullable=False)
-    sale_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    total_cost = db.Column(db.Float)  # 按销售时的成本价计算的成本，调价后删除销售也按此冲减日汇总
+    sale_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     
     product = db.relationship('Product', backref=db.backref('sales', lazy=True))
     
+    __table_args__ = (
+        db.Index('ix_sale_product_id_sale_date', 'product_id', 'sale_date'),
+        {'sqlite_autoincrement': True},
+    )
+    
     def __repr__(self):
         return f"销售记录('{self.product.name}', '{self.quantity}', '{self.sale_date}')"
 
+class SalesDailySummary(db.Model):
+    # 按 (日期, 商品) 汇总的销售数据，由销售的增删同步维护
+    summary_date = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    cost = db.Column(db.Float, nullable=False, default=0)
+    
+    product = db.relationship('Product')
+    
+    def __repr__(self):
+        return f"销售日汇总('{self.summary_date}', '{self.product_id}', '{self.quantity}', '{self.revenue}')"
+
 class Inventory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     last_updated = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     
@@ -85,12 +359,40 @@ class Inventory(db.Model):
     def __repr__(self):
         return f"库存记录('{self.product.name}', '{self.quantity}', '{self.last_updated}')"
 
+class StockMovement(db.Model):
+    # 库存流水（只追加）：采购、销售及其删除、批量导入都会记录库存变化量
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    change = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(20), nullable=False)
+    ref_id = db.Column(db.Integer)
+    moved_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_stock_movement_moved_at_product_id', 'moved_at', 'product_id'),
+    )
+    
+    def __repr__(self):
+        return f"库存流水('{self.product_id}', '{self.change}', '{self.reason}', '{self.moved_at}')"
+
+class StockSnapshot(db.Model):
+    # 库存快照：某一时刻所有商品的库存数量，作为按时点查询库存的起点
+    id = db.Column(db.Integer, primary_key=True)
+    snapshot_at = db.Column(db.DateTime, nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f"库存快照('{self.snapshot_at}', '{self.product_id}', '{self.quantity}')"
+
 class Expense(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(200), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     category = db.Column(db.String(50), nullable=False)
-    expense_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expense_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    
+    __table_args__ = {'sqlite_autoincrement': True}
     
     def __repr__(self):
         return f"费用记录('{self.description}', '{self.amount}', '{self.expense_date}')"
@@ -100,58 +402,1442 @@ class Income(db.Model):
     description = db.Column(db.String(200), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     category = db.Column(db.String(50), nullable=False)
-    income_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    income_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    
+    __table_args__ = {'sqlite_autoincrement': True}
     
     def __repr__(self):
         return f"收入记录('{self.description}', '{self.amount}', '{self.income_date}')"
 
+class PeriodClose(db.Model):
+    # 月结：冻结某个月的利润表、现金流量表和月末资产数据，历史报表直接读取
+    period_start = db.Column(db.Date, primary_key=True)
+    sales = db.Column(db.Float, nullable=False)
+    purchase_cost = db.Column(db.Float, nullable=False)
+    expenses = db.Column(db.Float, nullable=False)
+    other_income = db.Column(db.Float, nullable=False)
+    profit = db.Column(db.Float, nullable=False)
+    operating_cash_in = db.Column(db.Float, nullable=False)
+    operating_cash_out = db.Column(db.Float, nullable=False)
+    inventory_value = db.Column(db.Float, nullable=False)  # 月末库存价值（按结账时的成本价）
+    low_stock_count = db.Column(db.Integer, nullable=False)
+    product_count = db.Column(db.Integer, nullable=False)
+    expense_categories = db.Column(db.Text, nullable=False, default='[]')  # JSON: [[类别, 金额], ...]
+    income_categories = db.Column(db.Text, nullable=False, default='[]')
+    closed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def to_metrics(self):
+        return PeriodMetrics(
+            sales=self.sales,
+            sub_sales=0,
+            purchases=self.purchase_cost,
+            expenses=self.expenses,
+            other_income=self.other_income,
+            expense_categories=[CategoryTotal(*item) for item in json.loads(self.expense_categories)],
+            income_categories=[CategoryTotal(*item) for item in json.loads(self.income_categories)],
+            inventory_value=self.inventory_value,
+            low_stock_count=self.low_stock_count,
+            product_count=self.product_count,
+        )
+    
+    def __repr__(self):
+        return f"月结('{self.period_start}', '{self.sales}', '{self.profit}')"
+
+class LedgerArchive(db.Model):
+    # 已归档的年度：该年的销售、采购、费用、收入明细已从主库移到 ARCHIVE_DIR 下的年度库
+    year = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(200), nullable=False)
+    sale_rows = db.Column(db.Integer, nullable=False)
+    purchase_rows = db.Column(db.Integer, nullable=False)
+    expense_rows = db.Column(db.Integer, nullable=False)
+    income_rows = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"年度归档('{self.year}', '{self.filename}')"
+
+class ChangeEvent(db.Model):
+    # 变更流（只追加）：商品、供应商和四类明细的增删改在同一事务中记录，id 即下游读取的偏移量
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)  # 表名
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)  # insert / update / delete
+    data = db.Column(db.Text)  # 变更后的整行（JSON），delete 时为空
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    # AUTOINCREMENT：压缩删除了最新的事件后 id 也不会被重用，偏移量始终递增
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    def __repr__(self):
+        return f"变更事件('{self.id}', '{self.entity}', '{self.entity_id}', '{self.op}')"
+
+class ChangeConsumer(db.Model):
+    # 变更流的下游消费者及其已确认的偏移量；所有消费者都确认过的事件可以压缩删除
+    name = db.Column(db.String(50), primary_key=True)
+    acked_offset = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"变更消费者('{self.name}', '{self.acked_offset}')"
+
+class PriceChange(db.Model):
+    # 调价记录（只追加）：每个商品每次调价一行，批量调价的同一批记录共用一个批次号
+    id = db.Column(db.Integer, primary_key=True)
+    batch = db.Column(db.String(32), index=True)  # 手工修改单个商品时为空
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    old_price = db.Column(db.Float, nullable=False)
+    new_price = db.Column(db.Float, nullable=False)
+    old_cost_price = db.Column(db.Float, nullable=False)
+    new_cost_price = db.Column(db.Float, nullable=False)
+    source = db.Column(db.String(200), nullable=False)  # 调价规则、文件名或“手工修改”
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_price_change_product_id_changed_at', 'product_id', 'changed_at'),
+    )
+    
+    def __repr__(self):
+        return f"调价记录('{self.product_id}', '{self.old_price}', '{self.new_price}', '{self.changed_at}')"
+
+class ReplenishmentPlan(db.Model):
+    # 补货建议：由 forecast-demand 命令或后台任务按销售历史批量计算，每个商品一行
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    daily_demand = db.Column(db.Float, nullable=False)
+    demand_std = db.Column(db.Float, nullable=False)
+    safety_stock = db.Column(db.Float, nullable=False)
+    reorder_point = db.Column(db.Float, nullable=False)
+    on_hand = db.Column(db.Integer, nullable=False)  # 计算时的库存
+    days_of_cover = db.Column(db.Float)  # 计算时的可售天数，没有需求时为空
+    method = db.Column(db.String(10), nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"补货建议('{self.product_id}', '{self.daily_demand}', '{self.reorder_point}')"
+
+class Job(db.Model):
+    # 后台任务：状态保存在数据库中，进程重启后未完成的任务会重新排队
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued/running/done/failed/cancelled
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    worker = db.Column(db.String(100))  # 执行任务的 主机名:进程号
+    result_path = db.Column(db.String(500))
+    result_name = db.Column(db.String(200))
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'params': json.loads(self.params),
+            'status': self.status,
+            'cancel_requested': self.cancel_requested,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'download_url': url_for('download_job', job_id=self.id) if self.status == 'done' and self.result_path else None,
+        }
+    
+    def __repr__(self):
+        return f"后台任务('{self.id}', '{self.kind}', '{self.status}')"
+
+# 从销售明细重建销售日汇总（成本取销售记录上保存的成本）；sale_source 可换成合并了归档年度的子查询
+def rebuild_sales_summary_sql(sale_source='sale'):
+    return [
+        'DELETE FROM sales_daily_summary',
+        f'''INSERT INTO sales_daily_summary (summary_date, product_id, quantity, revenue, cost)
+           SELECT date(sale.sale_date), sale.product_id, SUM(sale.quantity), SUM(sale.total_amount),
+                  SUM(sale.total_cost)
+           FROM {sale_source}
+           GROUP BY date(sale.sale_date), sale.product_id''',
+    ]
+
+# 迁移 2 在销售记录有成本列之前执行，仍按商品当前成本价计算
+LEGACY_REBUILD_SALES_SUMMARY_SQL = [
+    'DELETE FROM sales_daily_summary',
+    '''INSERT INTO sales_daily_summary (summary_date, product_id, quantity, revenue, cost)
+       SELECT date(sale.sale_date), sale.product_id, SUM(sale.quantity), SUM(sale.total_amount),
+              SUM(sale.quantity * COALESCE(product.cost_price, 0))
+       FROM sale LEFT JOIN product ON product.id = sale.product_id
+       GROUP BY date(sale.sale_date), sale.product_id''',
+]
+
+# 全文检索：外部内容 FTS5 表 + 触发器，商品和供应商的增删改会自动同步到索引
+# trigram 分词支持中文任意子串匹配（查询词至少3个字符）
+SEARCH_INDEXES = {
+    'product': ['name', 'category'],
+    'supplier': ['name', 'contact', 'address'],
+}
+
+def create_search_indexes(conn):
+    for table, columns in SEARCH_INDEXES.items():
+        fts = f'{table}_fts'
+        cols = ', '.join(columns)
+        new_values = ', '.join(f'new.{column}' for column in columns)
+        old_values = ', '.join(f'old.{column}' for column in columns)
+        try:
+            conn.exec_driver_sql(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                                 f"{cols}, content='{table}', content_rowid='id', tokenize='trigram')")
+        except OperationalError as e:
+            # SQLite 未编译 FTS5 时退回到 LIKE 查询
+            app.logger.warning('无法创建全文索引 %s: %s', fts, e)
+            continue
+        conn.exec_driver_sql(f'''CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new_values});
+        END''')
+        conn.exec_driver_sql(f'''CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+        END''')
+        create_search_update_trigger(conn, table, columns)
+        conn.exec_driver_sql(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+def create_search_update_trigger(conn, table, columns):
+    # 只在被索引的列变化时更新索引，批量调价等只改其他列的更新不会逐行重建全文索引
+    fts = f'{table}_fts'
+    cols = ', '.join(columns)
+    new_values = ', '.join(f'new.{column}' for column in columns)
+    old_values = ', '.join(f'old.{column}' for column in columns)
+    conn.exec_driver_sql(f'''CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN
+        INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+        INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new_values});
+    END''')
+
+def limit_search_update_triggers(conn):
+    for table, columns in SEARCH_INDEXES.items():
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (f'{table}_fts',)
+        ).scalar()
+        if exists:
+            conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS {table}_fts_au')
+            create_search_update_trigger(conn, table, columns)
+
+def ledger_autoincrement(conn):
+    # 把明细表重建为 AUTOINCREMENT（SQLite 不能修改已有表的主键），再把 id 序列推进到主库和已归档年度库的最大 id 之后
+    years = [year for year, in conn.exec_driver_sql('SELECT year FROM ledger_archive')]
+    archived = archived_max_ids(app.config['ARCHIVE_DIR'], years)
+    raw = conn.connection.driver_connection
+    for table in LEDGER_TABLES:
+        if not uses_autoincrement(raw, table):
+            extras = [sql for sql, in raw.execute("SELECT sql FROM sqlite_master WHERE tbl_name = ? "
+                                                  "AND type IN ('index', 'trigger') AND sql IS NOT NULL", (table,))]
+            old_columns = {row[1] for row in raw.execute(f'PRAGMA table_info({table})')}
+            model_table = LEDGER_MODELS[table].__table__
+            columns = ', '.join(column.name for column in model_table.columns if column.name in old_columns)
+            ddl = str(CreateTable(model_table).compile(dialect=conn.dialect))
+            raw.execute(ddl.replace(f'CREATE TABLE {table} ', f'CREATE TABLE {table}_new ', 1))
+            raw.execute(f'INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}')
+            raw.execute(f'DROP TABLE {table}')
+            raw.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+            for sql in extras:
+                raw.execute(sql)
+        hot_max = raw.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+        ensure_sequence(raw, table, max(hot_max, archived[table]))
+
+def add_sale_total_cost(conn, product_schema):
+    # conn 为 sqlite3 连接；已有的销售记录没有保存销售时的成本，按商品当前成本价补齐
+    if 'total_cost' not in {row[1] for row in conn.execute('PRAGMA main.table_info(sale)')}:
+        conn.execute('ALTER TABLE main.sale ADD COLUMN total_cost FLOAT')
+    conn.execute(f'''UPDATE main.sale SET total_cost = quantity * COALESCE(
+                         (SELECT cost_price FROM {product_schema}.product WHERE product.id = sale.product_id), 0)
+                     WHERE total_cost IS NULL''')
+
+def sale_total_cost(conn):
+    add_sale_total_cost(conn.connection.driver_connection, 'main')
+    # 已归档年度库的列与主库保持一致，合并查询才能使用同一组列
+    for year, in conn.exec_driver_sql('SELECT year FROM ledger_archive'):
+        archive = sqlite3.connect(os.path.join(app.config['ARCHIVE_DIR'], archive_filename(year)), isolation_level=None)
+        try:
+            archive.execute('ATTACH DATABASE ? AS hot', (DATABASE_PATH,))
+            archive.execute('BEGIN')
+            add_sale_total_cost(archive, 'hot')
+            archive.execute('COMMIT')
+        finally:
+            archive.close()
+
+# 数据库迁移：按 PRAGMA user_version 顺序执行，已执行过的版本会被跳过
+MIGRATIONS = [
+    (1, [
+        'CREATE INDEX IF NOT EXISTS ix_sale_sale_date ON sale (sale_date)',
+        'CREATE INDEX IF NOT EXISTS ix_sale_product_id_sale_date ON sale (product_id, sale_date)',
+        'CREATE INDEX IF NOT EXISTS ix_purchase_purchase_date ON purchase (purchase_date)',
+        'CREATE INDEX IF NOT EXISTS ix_purchase_product_id_purchase_date ON purchase (product_id, purchase_date)',
+        'CREATE INDEX IF NOT EXISTS ix_expense_expense_date ON expense (expense_date)',
+        'CREATE INDEX IF NOT EXISTS ix_income_income_date ON income (income_date)',
+        'CREATE INDEX IF NOT EXISTS ix_inventory_product_id ON inventory (product_id)',
+    ]),
+    (2, LEGACY_REBUILD_SALES_SUMMARY_SQL),
+    # 用历史采购和销售补齐库存流水，再以当前库存作为第一个快照
+    (3, [
+        '''INSERT INTO stock_movement (product_id, change, reason, ref_id, moved_at)
+           SELECT product_id, quantity, 'purchase', id, purchase_date FROM purchase
+           UNION ALL
+           SELECT product_id, -quantity, 'sale', id, sale_date FROM sale''',
+        lambda conn: take_stock_snapshot(conn),
+    ]),
+    (4, [create_search_indexes]),
+    (5, [
+        'INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)',
+        '''CREATE TRIGGER IF NOT EXISTS product_version_ai AFTER INSERT ON product BEGIN
+            UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS product_version_au AFTER UPDATE ON product BEGIN
+            UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS product_version_ad AFTER DELETE ON product BEGIN
+            UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+        END''',
+    ]),
+    (6, [limit_search_update_triggers]),
+    (7, [ledger_autoincrement]),
+    (8, [sale_total_cost]),
+]
+
+def migrate_db():
+    with db.engine.begin() as conn:
+        version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+        for target, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.exec_driver_sql(statement)
+            conn.exec_driver_sql(f'PRAGMA user_version = {target}')
+            version = target
+
+# 时间窗口：统一返回左闭右开的 [start, end) 区间，直接比较原始 DateTime 列以便使用索引
+def day_window(day=None):
+    day = day or date.today()
+    start = datetime(day.year, day.month, day.day)
+    return start, start + timedelta(days=1)
+
+def month_window(day=None):
+    day = day or date.today()
+    start = datetime(day.year, day.month, 1)
+    if day.month == 12:
+        end = datetime(day.year + 1, 1, 1)
+    else:
+        end = datetime(day.year, day.month + 1, 1)
+    return start, end
+
+def quarter_window(day=None):
+    day = day or date.today()
+    first_month = (day.month - 1) // 3 * 3 + 1
+    start = datetime(day.year, first_month, 1)
+    end = datetime(day.year + 1, 1, 1) if first_month == 10 else datetime(day.year, first_month + 3, 1)
+    return start, end
+
+def year_window(day=None):
+    day = day or date.today()
+    return datetime(day.year, 1, 1), datetime(day.year + 1, 1, 1)
+
+def last_days_window(days, day=None):
+    # 包含今天在内的最近 days 天
+    start, end = day_window(day)
+    return start - timedelta(days=days - 1), end
+
+def in_window(column, window):
+    start, end = window
+    return db.and_(column >= start, column < end)
+
+# 归档查询：报表期间跨入已归档年份时，挂载对应的年度库，把明细表换成主库与年度库的 UNION ALL
+LEDGER_MODELS = {'sale': Sale, 'purchase': Purchase, 'expense': Expense, 'income': Income}
+archive_metadata = db.MetaData()
+
+def archived_years(conn, window):
+    # 只有往年可以归档，期间从今年开始时不查询归档登记表（收银和首页统计不受影响）
+    start, end = window
+    if start >= datetime(date.today().year, 1, 1):
+        return []
+    last_year = (end - timedelta(microseconds=1)).year if end < datetime.max else end.year
+    return [row[0] for row in conn.execute(
+        select(LedgerArchive.year).where(LedgerArchive.year.between(start.year, last_year)).order_by(LedgerArchive.year)
+    )]
+
+def attach_archives(conn, years):
+    # 挂载状态跟随数据库连接，同一次借出中每个年度库只挂载一次，连接归还到连接池时卸载（见 detach_archives）
+    attached = conn.info.setdefault('attached_archives', set())
+    if len(attached | set(years)) > app.config['ARCHIVE_MAX_ATTACHED']:
+        raise RuntimeError(f"一次查询最多合并 {app.config['ARCHIVE_MAX_ATTACHED']} 个已归档年度，请缩小报表期间")
+    for year in years:
+        if year not in attached:
+            path = os.path.join(app.config['ARCHIVE_DIR'], archive_filename(year))
+            if not os.path.exists(path):
+                raise RuntimeError(f'找不到 {year} 年的归档文件 {path}')
+            conn.exec_driver_sql(f'ATTACH DATABASE ? AS {archive_schema(year)}', (path,))
+            attached.add(year)
+
+def detach_archives(dbapi_connection, connection_record):
+    # 连接池 checkin 事件：归还的连接卸载本次挂载的年度库，复用的连接不会累积到 SQLite 的挂载数量上限
+    attached = connection_record.info.get('attached_archives')
+    if not attached or dbapi_connection is None:
+        return
+    for year in sorted(attached):
+        try:
+            dbapi_connection.execute(f'DETACH DATABASE {archive_schema(year)}')
+        except sqlite3.Error as e:
+            # 仍有未关闭的游标时无法卸载，保留记录，下次借出时不会重复挂载
+            app.logger.warning('无法卸载 %s 年的归档库: %s', year, e)
+            continue
+        attached.discard(year)
+
+with app.app_context():
+    for engine in db.engines.values():
+        event.listen(engine, 'checkin', detach_archives)
+
+def ledger_sources(conn, window):
+    # 原生 SQL 报表使用：{表名: FROM 子句}；期间没有跨入已归档年份时返回 None，直接查询主库
+    years = archived_years(conn, window)
+    if not years:
+        return None
+    attach_archives(conn, years)
+    return {table: ledger_from(table, [column.name for column in LEDGER_MODELS[table].__table__.columns], years)
+            for table in LEDGER_TABLES}
+
+def ledger_metrics(session, window):
+    # 期间指标，必要时合并已归档年度的明细
+    return period_metrics(session, window, sources=ledger_sources(session.connection(), window))
+
+def ledger_entity(session, model, window):
+    # ORM 查询使用：返回 model 本身，或映射到主库与年度库 UNION ALL 子查询的别名
+    conn = session.connection()
+    years = archived_years(conn, window)
+    if not years:
+        return model
+    attach_archives(conn, years)
+    table = model.__table__
+    selects = [select(table)]
+    for year in years:
+        key = f'{archive_schema(year)}.{table.name}'
+        archived = archive_metadata.tables.get(key)
+        if archived is None:
+            archived = table.to_metadata(archive_metadata, schema=archive_schema(year))
+        selects.append(select(archived))
+    return aliased(model, union_all(*selects).subquery(table.name))
+
+def sales_summary_upsert():
+    stmt = sqlite_insert(SalesDailySummary)
+    return stmt.on_conflict_do_update(
+        index_elements=['summary_date', 'product_id'],
+        set_={
+            'quantity': SalesDailySummary.quantity + stmt.excluded.quantity,
+            'revenue': SalesDailySummary.revenue + stmt.excluded.revenue,
+            'cost': SalesDailySummary.cost + stmt.excluded.cost,
+        }
+    )
+
+def update_sales_summary(product_id, sale_date, quantity, revenue, cost):
+    # 在当前事务中累加（删除销售时传入负数）
+    db.session.execute(sales_summary_upsert(), {
+        'summary_date': sale_date.date(), 'product_id': product_id,
+        'quantity': quantity, 'revenue': revenue, 'cost': cost,
+    })
+
+def rebuild_sales_summary():
+    with db.engine.begin() as conn:
+        sources = ledger_sources(conn, (datetime.min, datetime.max))
+        for statement in rebuild_sales_summary_sql(sources['sale'] if sources else 'sale'):
+            conn.exec_driver_sql(statement)
+
+# 库存变更：使用单条条件 UPDATE，避免多个 worker 同时读-改-写导致超卖
+inventory_table = Inventory.__table__
+
+stock_movement_table = StockMovement.__table__
+
+def decrement_stock(product_id, quantity, reason, ref_id=None):
+    # 库存不足时不更新任何行，返回 False
+    now = datetime.utcnow()
+    result = db.session.execute(
+        inventory_table.update().where(
+            inventory_table.c.product_id == product_id,
+            inventory_table.c.quantity >= quantity
+        ).values(
+            quantity=inventory_table.c.quantity - quantity,
+            last_updated=now
+        )
+    )
+    if result.rowcount == 0:
+        return False
+    record_stock_movement(product_id, -quantity, reason, ref_id, now)
+    return True
+
+def increment_stock(product_id, quantity, reason, ref_id=None):
+    now = datetime.utcnow()
+    result = db.session.execute(
+        inventory_table.update().where(
+            inventory_table.c.product_id == product_id
+        ).values(
+            quantity=inventory_table.c.quantity + quantity,
+            last_updated=now
+        )
+    )
+    if result.rowcount == 0:
+        db.session.add(Inventory(product_id=product_id, quantity=quantity))
+    record_stock_movement(product_id, quantity, reason, ref_id, now)
+
+def record_stock_movement(product_id, change, reason, ref_id=None, moved_at=None):
+    db.session.execute(stock_movement_table.insert().values(
+        product_id=product_id, change=change, reason=reason,
+        ref_id=ref_id, moved_at=moved_at or datetime.utcnow()
+    ))
+
+# 变更流：写入路由在提交前调用，事件与业务数据同时提交或回滚
+change_event_table = ChangeEvent.__table__
+
+def change_value(value):
+    # 日期时间与 SQLAlchemy 在 SQLite 中的存储格式一致，下游可以直接与整表复制的数据混用
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+def record_changes(op, entity, rows):
+    # rows 为包含 id 的列字典列表
+    if not rows:
+        return
+    now = datetime.utcnow()
+    db.session.execute(change_event_table.insert(), [{
+        'entity': entity, 'entity_id': row['id'], 'op': op, 'created_at': now,
+        'data': None if op == 'delete' else json.dumps({key: change_value(value) for key, value in row.items()},
+                                                        ensure_ascii=False),
+    } for row in rows])
+
+def record_changes_where(op, table, condition):
+    # 批量写入后调用：为 table 中满足 condition 的记录生成事件，整行用 json_object 在 SQLite 中序列化
+    data = db.func.json_object(*[part for column in table.columns for part in (column.name, column)])
+    db.session.execute(change_event_table.insert().from_select(
+        ['entity', 'entity_id', 'op', 'data', 'created_at'],
+        select(literal(table.name), table.c.id, literal(op), data, literal(datetime.utcnow(), db.DateTime))
+        .where(condition).order_by(table.c.id)
+    ))
+
+def record_inserted_changes(table, last_id):
+    # 批量插入后调用：id 大于 last_id 的都是本事务插入的新记录
+    record_changes_where('insert', table, table.c.id > last_id)
+
+def change_row(obj):
+    # 模型实例的列字典；新增的记录需要先 flush 取得 id
+    return {column.name: getattr(obj, column.key) for column in obj.__table__.columns}
+
+def record_change(op, obj):
+    record_changes(op, obj.__tablename__, [change_row(obj)])
+
+def fetch_changes(after, limit):
+    # 偏移量 after 之后的 limit 个事件。SQLite 同一时间只有一个写事务，id 按提交顺序分配，
+    # 读到偏移量 n 时，小于 n 的事件都已提交，不会在之后出现
+    return ChangeEvent.query.filter(ChangeEvent.id > after).order_by(ChangeEvent.id).limit(limit).all()
+
+def ack_changes(consumer, offset):
+    # 偏移量只前进不后退，返回确认后的偏移量
+    def work():
+        latest = db.session.query(db.func.coalesce(db.func.max(ChangeEvent.id), 0)).scalar()
+        row = db.session.get(ChangeConsumer, consumer) or ChangeConsumer(name=consumer, acked_offset=0)
+        row.acked_offset = max(row.acked_offset, min(offset, latest))
+        row.updated_at = datetime.utcnow()
+        db.session.add(row)
+        db.session.commit()
+        return row.acked_offset
+    return run_with_retry(work)
+
+def compact_changes():
+    # 删除所有消费者都已确认的事件；还没有消费者时不删除
+    def work():
+        acked = db.session.query(db.func.min(ChangeConsumer.acked_offset)).scalar()
+        if acked is None:
+            return 0
+        deleted = db.session.execute(change_event_table.delete().where(change_event_table.c.id <= acked)).rowcount
+        db.session.commit()
+        return deleted
+    return run_with_retry(work)
+
+def take_stock_snapshot(conn):
+    snapshot_table = StockSnapshot.__table__
+    conn.execute(snapshot_table.insert().from_select(
+        ['snapshot_at', 'product_id', 'quantity'],
+        select(literal(datetime.utcnow(), db.DateTime), inventory_table.c.product_id, inventory_table.c.quantity)
+    ))
+
+def stock_as_of(session, moment):
+    """返回 {product_id: 库存数量}，为 moment 之前（不含）发生的所有库存变化的结果"""
+    before = session.query(db.func.max(StockSnapshot.snapshot_at)).filter(
+        StockSnapshot.snapshot_at <= moment
+    ).scalar()
+    after = None
+    if before is None:
+        after = session.query(db.func.min(StockSnapshot.snapshot_at)).filter(
+            StockSnapshot.snapshot_at > moment
+        ).scalar()
+    
+    if before is not None:
+        # 从之前最近的快照向后重放流水
+        snapshot_at, sign = before, 1
+        movement_filter = (StockMovement.moved_at > before, StockMovement.moved_at < moment)
+    elif after is not None:
+        # 没有更早的快照时，从之后最近的快照向前回退流水
+        snapshot_at, sign = after, -1
+        movement_filter = (StockMovement.moved_at >= moment, StockMovement.moved_at <= after)
+    else:
+        # 没有任何快照：从头累加流水
+        snapshot_at, sign = None, 1
+        movement_filter = (StockMovement.moved_at < moment,)
+    
+    quantities = defaultdict(int)
+    if snapshot_at is not None:
+        for product_id, quantity in session.query(StockSnapshot.product_id, StockSnapshot.quantity).filter(
+            StockSnapshot.snapshot_at == snapshot_at
+        ):
+            quantities[product_id] = quantity
+    
+    for product_id, change in session.query(StockMovement.product_id, db.func.sum(StockMovement.change)).filter(
+        *movement_filter
+    ).group_by(StockMovement.product_id):
+        quantities[product_id] += sign * change
+    return quantities
+
+def is_lock_error(error):
+    message = str(error.orig).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+def run_with_retry(work):
+    """执行一个完整的写事务（包括提交），遇到数据库锁冲突时回滚并按指数退避重试"""
+    retries = app.config['WRITE_RETRIES']
+    endpoint = (request.endpoint or 'unknown') if has_request_context() else 'cli'
+    for attempt in range(retries + 1):
+        started = time.perf_counter()
+        try:
+            return work()
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_lock_error(e):
+                raise
+            if attempt == retries:
+                request_metrics.observe_lock_error(endpoint, time.perf_counter() - started, False)
+                raise
+            backoff = app.config['WRITE_RETRY_BACKOFF'] * (2 ** attempt) * (0.5 + random.random())
+            request_metrics.observe_lock_error(endpoint, time.perf_counter() - started + backoff, True)
+            time.sleep(backoff)
+
+# 批量导入销售（CSV 或 JSONL，字段：product_id, quantity, 可选 sale_date, total_amount）
+def iter_import_lines(stream, file_format):
+    if file_format == 'jsonl':
+        for line_no, line in enumerate(stream, start=1):
+            if line.strip():
+                yield line_no, line
+    else:
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # 表头占第1行
+            yield reader.line_num, row
+
+def import_field(record, field, convert, expected, required=True):
+    # 读取并转换一个字段，错误信息指明字段和原始值；可选字段缺失时返回 None
+    value = record.get(field)
+    if value is None or value == '':
+        if required:
+            raise ValueError(f'缺少字段 {field}')
+        return None
+    try:
+        return convert(value)
+    except (ValueError, TypeError, OverflowError):
+        raise ValueError(f'{field} 应为{expected}: {value}')
+
+def parse_integer(value):
+    # JSON 中的小数和布尔值不截断为整数，按格式错误拒绝
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(value)
+    return int(value)
+
+def parse_number(value):
+    # 布尔值、NaN 和无穷大不是有效的金额或百分比
+    number = float(value)
+    if isinstance(value, bool) or not math.isfinite(number):
+        raise ValueError(value)
+    return number
+
+def parse_sale_date(value):
+    sale_date = datetime.fromisoformat(value)
+    if sale_date.tzinfo is not None:
+        # 带时区的时间换算为 UTC，与其他销售记录一致
+        sale_date = sale_date.astimezone(timezone.utc).replace(tzinfo=None)
+    return sale_date
+
+def parse_import_line(line, products, closed_months=frozenset(), archived=frozenset()):
+    """解析一行导入数据；closed_months 为已月结月份的第一天，archived 为已归档的年份，这些期间的销售会被拒绝"""
+    if isinstance(line, str):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError('格式错误：不是有效的 JSON')
+    else:
+        record = line
+    if not isinstance(record, dict):
+        raise ValueError('格式错误：每行应为一个 JSON 对象')
+    product_id = import_field(record, 'product_id', parse_integer, '整数')
+    if product_id not in products:
+        raise ValueError(f'product_id 对应的商品不存在: {product_id}')
+    quantity = import_field(record, 'quantity', parse_integer, '整数')
+    if quantity <= 0:
+        raise ValueError(f'quantity 必须大于0: {quantity}')
+    price, cost_price = products[product_id]
+    sale_date = import_field(record, 'sale_date', parse_sale_date, 'ISO 格式的日期时间（如 2024-05-01 或 2024-05-01T10:30:00）',
+                             required=False) or datetime.utcnow()
+    if sale_date.year in archived:
+        raise ValueError(f'sale_date 所在的 {sale_date.year} 年已归档，不能再导入: {sale_date:%Y-%m-%d}')
+    if sale_date.date().replace(day=1) in closed_months:
+        raise ValueError(f'sale_date 所在的 {sale_date:%Y-%m} 已月结，不能再导入: {sale_date:%Y-%m-%d}')
+    total_amount = import_field(record, 'total_amount', parse_number, '数字', required=False)
+    if total_amount is None:
+        total_amount = price * quantity
+    elif total_amount < 0:
+        raise ValueError(f'total_amount 不能为负数: {total_amount}')
+    return {
+        'product_id': product_id, 'quantity': quantity,
+        'total_amount': total_amount, 'sale_date': sale_date,
+        'cost': cost_price * quantity,
+    }
+
+class StockChanged(Exception):
+    # 批量导入期间库存被其他请求修改，需要重新处理本批
+    pass
+
+def import_sales_chunk(lines):
+    stock = dict(db.session.query(Inventory.product_id, Inventory.quantity).filter(
+        Inventory.product_id.in_({record['product_id'] for _, record in lines})
+    ).all())
+    sales = []
+    rejected = []
+    for line_no, record in lines:
+        if stock.get(record['product_id'], 0) < record['quantity']:
+            rejected.append((line_no, f"quantity 超过商品 {record['product_id']} 的可用库存: {record['quantity']}"))
+            continue
+        stock[record['product_id']] -= record['quantity']
+        sales.append(record)
+    if not sales:
+        return 0, rejected
+    
+    # 每个商品只更新一次库存，每个 (日期, 商品) 只更新一次日汇总
+    inventory_delta = defaultdict(int)
+    summary = defaultdict(lambda: [0, 0.0, 0.0])
+    for record in sales:
+        inventory_delta[record['product_id']] += record['quantity']
+        totals = summary[(record['sale_date'].date(), record['product_id'])]
+        totals[0] += record['quantity']
+        totals[1] += record['total_amount']
+        totals[2] += record['cost']
+    
+    now = datetime.utcnow()
+    result = db.session.execute(
+        inventory_table.update().where(
+            inventory_table.c.product_id == bindparam('b_product_id'),
+            inventory_table.c.quantity >= bindparam('b_quantity')
+        ).values(
+            quantity=inventory_table.c.quantity - bindparam('b_quantity'),
+            last_updated=now
+        ),
+        [{'b_product_id': product_id, 'b_quantity': quantity} for product_id, quantity in inventory_delta.items()]
+    )
+    if result.rowcount != len(inventory_delta):
+        raise StockChanged()
+    db.session.execute(stock_movement_table.insert(), [
+        {'product_id': product_id, 'change': -quantity, 'reason': 'import', 'ref_id': None, 'moved_at': now}
+        for product_id, quantity in inventory_delta.items()
+    ])
+    # 本事务持有写锁，新记录的 id 都大于插入前的最大 id，变更事件直接在 SQLite 中按新记录生成
+    last_id = db.session.query(db.func.coalesce(db.func.max(Sale.id), 0)).scalar()
+    db.session.execute(Sale.__table__.insert(), [
+        {'product_id': record['product_id'], 'quantity': record['quantity'], 'total_amount': record['total_amount'],
+         'total_cost': record['cost'], 'sale_date': record['sale_date']}
+        for record in sales
+    ])
+    record_inserted_changes(Sale.__table__, last_id)
+    db.session.execute(sales_summary_upsert(), [
+        {'summary_date': summary_date, 'product_id': product_id,
+         'quantity': totals[0], 'revenue': totals[1], 'cost': totals[2]}
+        for (summary_date, product_id), totals in summary.items()
+    ])
+    return len(sales), rejected
+
+def commit_import_chunk(lines, result):
+    def work():
+        for _ in range(app.config['WRITE_RETRIES']):
+            try:
+                imported, rejected = import_sales_chunk(lines)
+                db.session.commit()
+                return imported, rejected
+            except StockChanged:
+                db.session.rollback()
+        raise StockChanged()
+    imported, rejected = run_with_retry(work)
+    result['imported'] += imported
+    result['rejected'].extend(rejected)
+
+def bulk_import_sales(stream, file_format, chunk_size=None):
+    """流式导入销售记录，按批提交；无效行记录到 rejected 中而不会中断导入"""
+    chunk_size = chunk_size or app.config['IMPORT_CHUNK_SIZE']
+    products = {product_id: (price, cost_price) for product_id, price, cost_price in
+                db.session.query(Product.id, Product.price, Product.cost_price)}
+    # 已月结月份的报表取自结账记录，已归档年份的明细不在主库，这些期间的销售不能再导入
+    closed_months = {row[0] for row in db.session.query(PeriodClose.period_start)}
+    archived = {row[0] for row in db.session.query(LedgerArchive.year)}
+    result = {'imported': 0, 'rejected': []}
+    
+    chunk = []
+    for line_no, line in iter_import_lines(stream, file_format):
+        try:
+            chunk.append((line_no, parse_import_line(line, products, closed_months, archived)))
+        except ValueError as e:
+            result['rejected'].append((line_no, str(e)))
+            continue
+        if len(chunk) >= chunk_size:
+            commit_import_chunk(chunk, result)
+            chunk = []
+    if chunk:
+        commit_import_chunk(chunk, result)
+    
+    if result['imported']:
+        invalidate_dashboard()
+    return result
+
+# 批量调价：按规则（某个类别的售价或成本价加减百分比、金额）或按文件（product_id 以及 price、cost_price）调价。
+# 先用集合操作写入本批的调价记录，再据此用一条 UPDATE ... FROM 更新商品，全部在一个事务中完成
+REPRICE_FIELDS = {'price': '售价', 'cost_price': '成本价'}
+price_change_table = PriceChange.__table__
+product_table = Product.__table__
+
+class RepriceError(Exception):
+    pass
+
+def describe_price_rule(field, category, percent, amount):
+    parts = [f'{percent:+g}%'] if percent else []
+    if amount:
+        parts.append(f'{amount:+g}元')
+    return f"{category or '全部商品'} {REPRICE_FIELDS[field]} {' '.join(parts)}"
+
+def validate_price_rule(field, percent, amount):
+    if field not in REPRICE_FIELDS:
+        raise RepriceError(f'只能调整 {"、".join(REPRICE_FIELDS)}')
+    if not percent and not amount:
+        raise RepriceError('请填写调价百分比或金额')
+    if percent <= -100:
+        raise RepriceError('降价百分比必须小于100%')
+
+def stage_rule_changes(batch, source, field, category=None, percent=0, amount=0):
+    # 一条 INSERT ... SELECT 算出新价格（保留两位小数），只记录价格确实变化的商品；返回 (匹配的商品数, [])
+    column = product_table.c[field]
+    new_value = db.func.round(column * (1 + percent / 100) + amount, 2)
+    matched = [product_table.c.category == category] if category else []
+    db.session.execute(price_change_table.insert().from_select(
+        ['batch', 'product_id', 'old_price', 'new_price', 'old_cost_price', 'new_cost_price', 'source', 'changed_at'],
+        select(
+            literal(batch), product_table.c.id,
+            product_table.c.price, new_value if field == 'price' else product_table.c.price,
+            product_table.c.cost_price, new_value if field == 'cost_price' else product_table.c.cost_price,
+            literal(source), literal(datetime.utcnow(), db.DateTime),
+        ).where(new_value != column, *matched)
+    ))
+    return db.session.query(db.func.count()).select_from(product_table).filter(*matched).scalar(), []
+
+def parse_price_line(line):
+    # 错误信息与批量导入销售一致，指明字段和原始值
+    if isinstance(line, str):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError('格式错误：不是有效的 JSON')
+    else:
+        record = line
+    if not isinstance(record, dict):
+        raise ValueError('格式错误：每行应为一个 JSON 对象')
+    product_id = import_field(record, 'product_id', parse_integer, '整数')
+    prices = {}
+    for field, label in REPRICE_FIELDS.items():
+        value = import_field(record, field, parse_number, '数字', required=False)
+        if value is not None:
+            prices[field] = round(value, 2)
+            if prices[field] < 0:
+                raise ValueError(f'{field}（{label}）不能为负数: {value}')
+    if not prices:
+        raise ValueError('缺少字段 price 或 cost_price')
+    return product_id, prices
+
+def parse_price_file(stream, file_format):
+    # 在事务之外读取整个文件，返回 ({product_id: (行号, {字段: 新价格})}, 被拒绝的行)；同一商品出现多次时以后面的为准
+    requested = {}
+    rejected = []
+    for line_no, line in iter_import_lines(stream, file_format):
+        try:
+            product_id, prices = parse_price_line(line)
+        except ValueError as e:
+            rejected.append((line_no, str(e)))
+            continue
+        previous = requested.get(product_id, (None, {}))[1]
+        requested[product_id] = (line_no, {**previous, **prices})
+    return requested, rejected
+
+def stage_file_changes(batch, source, requested, rejected):
+    # 当前价格一次查询取出，只把价格确实变化的商品用 executemany 写入调价记录
+    current = {product_id: (price, cost_price) for product_id, price, cost_price in
+               db.session.query(Product.id, Product.price, Product.cost_price)}
+    rejected = list(rejected)
+    now = datetime.utcnow()
+    matched = 0
+    rows = []
+    for product_id, (line_no, prices) in requested.items():
+        if product_id not in current:
+            rejected.append((line_no, f'商品不存在: {product_id}'))
+            continue
+        matched += 1
+        price, cost_price = current[product_id]
+        new_price, new_cost_price = prices.get('price', price), prices.get('cost_price', cost_price)
+        if (new_price, new_cost_price) != (price, cost_price):
+            rows.append({'batch': batch, 'product_id': product_id, 'old_price': price, 'new_price': new_price,
+                         'old_cost_price': cost_price, 'new_cost_price': new_cost_price,
+                         'source': source, 'changed_at': now})
+    if rows:
+        db.session.execute(price_change_table.insert(), rows)
+    return matched, sorted(rejected)
+
+def price_batch_summary(batch, matched, rejected, top=20):
+    # 本批调价的差异汇总：调价商品数、调价前后的售价和成本价合计，以及变化最大的商品
+    in_batch = PriceChange.batch == batch
+    changed, price_before, price_after, cost_before, cost_after = db.session.query(
+        db.func.count(PriceChange.id), db.func.sum(PriceChange.old_price), db.func.sum(PriceChange.new_price),
+        db.func.sum(PriceChange.old_cost_price), db.func.sum(PriceChange.new_cost_price)
+    ).filter(in_batch).one()
+    difference = (db.func.abs(PriceChange.new_price - PriceChange.old_price)
+                  + db.func.abs(PriceChange.new_cost_price - PriceChange.old_cost_price))
+    largest = db.session.query(
+        PriceChange.product_id, Product.name, PriceChange.old_price, PriceChange.new_price,
+        PriceChange.old_cost_price, PriceChange.new_cost_price
+    ).join(Product, Product.id == PriceChange.product_id).filter(in_batch).order_by(
+        difference.desc(), PriceChange.product_id
+    ).limit(top).all()
+    return {
+        'batch': batch,
+        'matched': matched,
+        'changed': changed,
+        'unchanged': matched - changed,
+        'price_before': round(price_before or 0, 2),
+        'price_after': round(price_after or 0, 2),
+        'cost_before': round(cost_before or 0, 2),
+        'cost_after': round(cost_after or 0, 2),
+        'largest': [row._asdict() for row in largest],
+        'rejected': rejected,
+    }
+
+def apply_price_changes(batch):
+    # 按本批调价记录一次性更新商品，并为被调价的商品生成变更事件
+    db.session.execute(product_table.update().values(
+        price=price_change_table.c.new_price,
+        cost_price=price_change_table.c.new_cost_price,
+    ).where(price_change_table.c.batch == batch, price_change_table.c.product_id == product_table.c.id))
+    record_changes_where('update', product_table, product_table.c.id.in_(
+        select(price_change_table.c.product_id).where(price_change_table.c.batch == batch)
+    ))
+
+def bulk_reprice(source, stage, dry_run=False):
+    """stage(batch, source) 在当前事务中写入本批调价记录，返回 (匹配的商品数, 被拒绝的行)。
+    全部调价在一个事务中完成；dry_run 时只计算差异汇总，然后回滚"""
+    batch = uuid.uuid4().hex
+    
+    def work():
+        matched, rejected = stage(batch, source)
+        negative = db.session.query(PriceChange.id).filter(
+            PriceChange.batch == batch, db.or_(PriceChange.new_price < 0, PriceChange.new_cost_price < 0)
+        ).first()
+        if negative:
+            db.session.rollback()
+            raise RepriceError('调价后的价格不能为负数')
+        summary = price_batch_summary(batch, matched, rejected)
+        if dry_run:
+            db.session.rollback()
+            return summary
+        apply_price_changes(batch)
+        db.session.commit()
+        return summary
+    
+    summary = run_with_retry(work)
+    summary['dry_run'] = dry_run
+    if summary['changed'] and not dry_run:
+        product_catalog.invalidate()
+    return summary
+
+# 整单结账：一个购物篮的所有商品在同一事务中完成
+class CheckoutError(Exception):
+    pass
+
+def checkout_basket(lines):
+    """lines 为 (product_id, quantity) 列表；全部成功或全部失败，返回创建的销售记录"""
+    if not lines:
+        raise CheckoutError('购物篮为空')
+    requested = defaultdict(int)
+    for product_id, quantity in lines:
+        if quantity <= 0:
+            raise CheckoutError('销售数量必须大于0')
+        requested[product_id] += quantity
+    
+    # 价格来自商品目录缓存，库存一次查询取出
+    stock = dict(db.session.query(Inventory.product_id, Inventory.quantity).filter(
+        Inventory.product_id.in_(requested)
+    ).all())
+    found = {}
+    for product_id, quantity in requested.items():
+        product = product_catalog.get(product_id)
+        if product is None:
+            raise CheckoutError(f'商品不存在: {product_id}')
+        if stock.get(product_id, 0) < quantity:
+            raise CheckoutError(f'库存不足，无法完成销售: {product.name}')
+        found[product_id] = product
+    
+    def work():
+        now = datetime.utcnow()
+        # 条件扣减库存是最终的库存检查，任何一个商品失败则整单回滚
+        for product_id, quantity in requested.items():
+            product = found[product_id]
+            if not decrement_stock(product_id, quantity, 'sale'):
+                db.session.rollback()
+                raise CheckoutError(f'库存不足，无法完成销售: {product.name}')
+            update_sales_summary(product_id, now, quantity, product.price * quantity, product.cost_price * quantity)
+        
+        sales = []
+        for product_id, quantity in lines:
+            product = found[product_id]
+            sales.append(Sale(product_id=product_id, quantity=quantity, total_amount=product.price * quantity,
+                              total_cost=product.cost_price * quantity, sale_date=now))
+        db.session.add_all(sales)
+        db.session.flush()
+        record_changes('insert', 'sale', [change_row(sale) for sale in sales])
+        db.session.commit()
+        return sales
+    
+    sales = run_with_retry(work)
+    invalidate_dashboard()
+    return sales
+
+# 商品/供应商搜索（输入联想）
+def search_ids(table, q, limit):
+    # 返回按相关度排序的 id 列表；有全文索引且每个词不少于3个字符时使用 FTS5，否则用 LIKE
+    terms = q.split()
+    fts = f'{table}_fts'
+    has_fts = db.session.execute(
+        db.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': fts}
+    ).scalar()
+    if has_fts and all(len(term) >= 3 for term in terms):
+        match = ' AND '.join('"' + term.replace('"', '""') + '"' for term in terms)
+        return db.session.execute(
+            db.text(f'SELECT rowid FROM {fts} WHERE {fts} MATCH :match ORDER BY rank LIMIT :limit'),
+            {'match': match, 'limit': limit}
+        ).scalars().all()
+    
+    columns = SEARCH_INDEXES[table]
+    conditions = []
+    params = {'limit': limit}
+    for i, term in enumerate(terms):
+        params[f'term{i}'] = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        conditions.append('(' + ' OR '.join(f"{column} LIKE :term{i} ESCAPE '\\'" for column in columns) + ')')
+    return db.session.execute(
+        db.text(f"SELECT id FROM {table} WHERE {' AND '.join(conditions)} ORDER BY name LIMIT :limit"), params
+    ).scalars().all()
+
+def search_limit():
+    return max(1, min(request.args.get('limit', type=int) or 10, 50))
+
+# 商品目录缓存：收银时直接从进程内读取价格，不再每次查询数据库
+class CatalogEntry:
+    __slots__ = ('name', 'category', 'price', 'cost_price')
+    
+    def __init__(self, name, category, price, cost_price):
+        self.name = name
+        self.category = category
+        self.price = price
+        self.cost_price = cost_price
+
+class ProductCatalog:
+    def __init__(self):
+        self._entries = {}
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+    
+    def get(self, product_id):
+        self.refresh()
+        entry = self._entries.get(product_id)
+        if entry is None:
+            # 未命中时可能是其他 worker 刚添加的商品，立即检查一次版本号
+            self.invalidate()
+            self.refresh()
+            entry = self._entries.get(product_id)
+        return entry
+    
+    def refresh(self):
+        # 按间隔检查数据库中的版本号，版本变化时整体重新加载
+        now = time.monotonic()
+        if now - self._checked_at < app.config['CATALOG_VERSION_CHECK_INTERVAL']:
+            return
+        version = db.session.execute(
+            db.select(CatalogVersion.version).where(CatalogVersion.id == 1)
+        ).scalar()
+        self._checked_at = now
+        if version != self._version or version is None:
+            self.load(version)
+    
+    def load(self, version=None):
+        with self._lock:
+            rows = db.session.execute(
+                db.select(Product.id, Product.name, Product.category, Product.price, Product.cost_price)
+            ).all()
+            # 构建新字典后整体替换，读取方不会看到加载到一半的数据
+            self._entries = {row.id: CatalogEntry(row.name, row.category, row.price, row.cost_price) for row in rows}
+            self._version = version
+    
+    def invalidate(self):
+        # 本进程修改商品后调用，下次读取时立即检查版本号
+        self._checked_at = 0
+
+product_catalog = ProductCatalog()
+
+# 缓存后端：子类实现 _load/set/delete/incr，命中与未命中次数由基类统计
+class CacheBackend:
+    name = 'base'
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        value = self._load(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+    
+    def peek(self, key):
+        # 读取但不计入命中统计（用于读取版本号）
+        return self._load(key)
+    
+    def stats(self):
+        return {'backend': self.name, 'hits': self.hits, 'misses': self.misses}
+
+class MemoryCache(CacheBackend):
+    name = 'memory'
+    
+    def __init__(self):
+        super().__init__()
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def _load(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] is not None and item[1] < time.time():
+                del self._data[key]
+                return None
+            return item[0]
+    
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            # 顺便清理过期条目：统计版本号变化后旧的键不会再被读取，只能在这里删除
+            expired = [item_key for item_key, (_, item_expires_at) in self._data.items()
+                       if item_expires_at is not None and item_expires_at < now]
+            for item_key in expired:
+                del self._data[item_key]
+            self._data[key] = (value, expires_at)
+    
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def incr(self, key):
+        with self._lock:
+            value = self._data.get(key, (0, None))[0] + 1
+            self._data[key] = (value, None)
+            return value
+
+class SQLiteCache(CacheBackend):
+    name = 'sqlite'
+    
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._execute([('CREATE TABLE IF NOT EXISTS cache_entry '
+                        '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)', ())])
+    
+    def _execute(self, statements):
+        # 每次操作使用独立连接并在一个事务中执行，返回最后一条语句的第一行
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                row = None
+                for sql, params in statements:
+                    row = conn.execute(sql, params).fetchone()
+                return row
+        finally:
+            conn.close()
+    
+    def _load(self, key):
+        row = self._execute([('SELECT value, expires_at FROM cache_entry WHERE key = ?', (key,))])
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return json.loads(row[0])
+    
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        self._execute([
+            # 顺便清理过期条目
+            ('DELETE FROM cache_entry WHERE expires_at < ?', (now,)),
+            ('INSERT OR REPLACE INTO cache_entry (key, value, expires_at) VALUES (?, ?, ?)',
+             (key, json.dumps(value), expires_at)),
+        ])
+    
+    def delete(self, key):
+        self._execute([('DELETE FROM cache_entry WHERE key = ?', (key,))])
+    
+    def incr(self, key):
+        row = self._execute([
+            ("INSERT INTO cache_entry (key, value, expires_at) VALUES (?, '1', NULL) "
+             "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1", (key,)),
+            ('SELECT value FROM cache_entry WHERE key = ?', (key,)),
+        ])
+        return int(row[0])
+    
+    def stats(self):
+        stats = super().stats()
+        stats['path'] = self.path
+        return stats
+
+def create_cache(backend):
+    if backend == 'sqlite':
+        return SQLiteCache(app.config['DASHBOARD_CACHE_PATH'])
+    return MemoryCache()
+
+dashboard_cache = create_cache(app.config['DASHBOARD_CACHE_BACKEND'])
+
+def dashboard_cache_key():
+    # 写操作递增版本号即可让所有 worker 的旧缓存失效；日期变化时自动换键
+    version = dashboard_cache.peek('dashboard:version') or 0
+    return f'dashboard:{version}:{date.today().isoformat()}'
+
+def invalidate_dashboard():
+    dashboard_cache.incr('dashboard:version')
+    dashboard_broadcaster.notify()
+
+def compute_dashboard_stats():
+    # 一条聚合语句同时算出本月和今日的全部指标
+    metrics = period_metrics(db.session, month_window(), sub_window=day_window())
+    month_profit = metrics.sales - metrics.purchases - metrics.expenses
+    return {
+        'product_count': metrics.product_count,
+        'today_sales': round(metrics.sub_sales, 2),
+        'month_profit': round(month_profit, 2),
+        'low_stock_count': metrics.low_stock_count,
+    }
+
+def get_dashboard_stats():
+    key = dashboard_cache_key()
+    stats = dashboard_cache.get(key)
+    if stats is None:
+        stats = compute_dashboard_stats()
+        dashboard_cache.set(key, stats, app.config['DASHBOARD_CACHE_TTL'])
+    return stats
+
+class DashboardBroadcaster:
+    # 首页实时推送：每个进程一个后台线程，统计版本号变化时只计算一次，把有变化的指标推送给本进程的所有连接。
+    # 其他 worker 的写入通过共享缓存（DASHBOARD_CACHE_BACKEND=sqlite）的版本号发现
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._key = None
+        self._stats = None
+    
+    def subscribe(self):
+        # 没有连接时后台线程退出，第一个连接到来时再启动
+        subscriber = queue.Queue(maxsize=app.config['DASHBOARD_STREAM_QUEUE'])
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='dashboard-stream', daemon=True)
+                self._thread.start()
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+    
+    def notify(self):
+        self._wakeup.set()
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait(app.config['DASHBOARD_STREAM_POLL'])
+            self._wakeup.clear()
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            try:
+                self.refresh()
+            except Exception:
+                app.logger.exception('首页统计推送失败')
+    
+    def refresh(self):
+        key = dashboard_cache_key()
+        if key == self._key:
+            return
+        with app.app_context():
+            stats = get_dashboard_stats()
+        delta = {name: value for name, value in stats.items() if self._stats is None or self._stats.get(name) != value}
+        self._key, self._stats = key, stats
+        if delta:
+            self.publish(delta)
+    
+    def publish(self, delta):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(delta)
+            except queue.Full:
+                # 页面长时间没有读取：丢弃积压的增量，改为让它重新获取完整统计
+                while not subscriber.empty():
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        break
+                subscriber.put_nowait(None)
+
+dashboard_broadcaster = DashboardBroadcaster()
+
+def sse_message(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+# 游标分页（按 日期+id 倒序，没有日期列的列表只按 id 倒序）
+def encode_cursor(record_date, record_id):
+    raw = f"{record_date.isoformat() if record_date is not None else ''}|{record_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    # 无效游标视为不存在，直接回到第一页
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        date_part, id_part = raw.split('|')
+        return datetime.fromisoformat(date_part) if date_part else None, int(id_part)
+    except (ValueError, UnicodeError):
+        return None
+
+def get_page_size():
+    per_page = request.args.get('per_page', type=int) or app.config['LIST_PAGE_SIZE']
+    return max(1, min(per_page, app.config['LIST_MAX_PAGE_SIZE']))
+
+def keyset_paginate(query, date_column, id_column):
+    """按 (日期, id) 倒序取一页数据（date_column 为 None 时只按 id），返回 (记录列表, 下一页游标, 上一页游标)"""
+    page_size = get_page_size()
+    columns = (id_column,) if date_column is None else (date_column, id_column)
+    key = db.tuple_(*columns)
+    before = decode_cursor(request.args.get('before'))
+    after = decode_cursor(request.args.get('after'))
+    if before and (before[0] is None) != (date_column is None):
+        before = None
+    if after and (after[0] is None) != (date_column is None):
+        after = None
+    
+    if before:
+        # 向前翻页：取比游标更新的记录，升序取出后再反转
+        rows = query.filter(key > db.tuple_(*before[-len(columns):])).order_by(
+            *(column.asc() for column in columns)
+        ).limit(page_size + 1).all()
+        has_prev = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_next = True
+    else:
+        if after:
+            query = query.filter(key < db.tuple_(*after[-len(columns):]))
+        rows = query.order_by(
+            *(column.desc() for column in columns)
+        ).limit(page_size + 1).all()
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        has_prev = after is not None
+    
+    if not rows:
+        return rows, None, None
+    
+    first, last = rows[0], rows[-1]
+    record_date = (lambda row: None) if date_column is None else (lambda row: getattr(row, date_column.key))
+    next_cursor = encode_cursor(record_date(last), last.id) if has_next else None
+    prev_cursor = encode_cursor(record_date(first), first.id) if has_prev else None
+    return rows, next_cursor, prev_cursor
+
 # 路由定义
 @app.route("/")
 @app.route("/home")
 @login_required
 def home():
-    from datetime import date
-    
-    # 计算统计数据
-    product_count = Product.query.count()
-    
-    # 今日销售
-    today = date.today()
-    today_sales = db.session.query(db.func.sum(Sale.total_amount)).filter(db.func.date(Sale.sale_date) == today).scalar() or 0
-    
-    # 本月销售和成本
-    this_month = today.month
-    this_year = today.year
-    
-    month_sales = db.session.query(db.func.sum(Sale.total_amount)).filter(
-        db.func.strftime('%m', Sale.sale_date) == f'{this_month:02d}',
-        db.func.strftime('%Y', Sale.sale_date) == f'{this_year}'
-    ).scalar() or 0
-    
-    month_purchases = db.session.query(db.func.sum(Purchase.total_cost)).filter(
-        db.func.strftime('%m', Purchase.purchase_date) == f'{this_month:02d}',
-        db.func.strftime('%Y', Purchase.purchase_date) == f'{this_year}'
-    ).scalar() or 0
-    
-    month_expenses = db.session.query(db.func.sum(Expense.amount)).filter(
-        db.func.strftime('%m', Expense.expense_date) == f'{this_month:02d}',
-        db.func.strftime('%Y', Expense.expense_date) == f'{this_year}'
-    ).scalar() or 0
-    
-    month_profit = month_sales - month_purchases - month_expenses
+    return render_template('home.html', **get_dashboard_stats())
+
+@app.route("/dashboard/stream")
+@login_required
+def dashboard_stream():
+    # Server-Sent Events：先发送完整统计，之后只发送有变化的指标
+    subscriber = dashboard_broadcaster.subscribe()
+    # 先订阅再读取统计，订阅之后的变化都会推送，页面不会漏掉更新
+    stats = get_dashboard_stats()
     
-    # 低库存商品（库存小于10的商品）
-    low_stock_count = db.session.query(db.func.count(Inventory.id)).filter(Inventory.quantity < 10).scalar() or 0
+    def generate():
+        try:
+            yield 'retry: 3000\n' + sse_message(stats)
+            while True:
+                try:
+                    delta = subscriber.get(timeout=app.config['DASHBOARD_STREAM_HEARTBEAT'])
+                except queue.Empty:
+                    # 心跳：保持连接，同时让服务器及时发现已关闭的页面
+                    yield ': ping\n\n'
+                    continue
+                if delta is None:
+                    with app.app_context():
+                        delta = get_dashboard_stats()
+                yield sse_message(delta)
+        finally:
+            dashboard_broadcaster.unsubscribe(subscriber)
     
-    return render_template('home.html', 
-                           product_count=product_count,
-                           today_sales=round(today_sales, 2),
-                           month_profit=round(month_profit, 2),
-                           low_stock_count=low_stock_count)
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/cache/stats")
+@login_required
+def cache_stats():
+    return jsonify(dashboard_cache.stats())
+
+@app.route("/metrics")
+def metrics():
+    # 供 Prometheus 抓取，不需要登录，但必须配置 METRICS_TOKEN 并携带令牌
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        abort(403)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route("/register", methods=['GET', 'POST'])
 def register():
@@ -206,8 +1892,49 @@ def logout():
 @app.route("/products")
 @login_required
 def product_list():
-    products = Product.query.all()
-    return render_template('product_list.html', products=products)
+    q = request.args.get('q', '').strip()
+    query = Product.query.options(joinedload(Product.inventory))
+    if q:
+        # 搜索结果最多200条，按相关度排序，不分页
+        ids = search_ids('product', q, 200)
+        products = sorted(query.filter(Product.id.in_(ids)).all(), key=lambda product: ids.index(product.id))
+        next_cursor = prev_cursor = None
+    else:
+        # 新添加的商品在前
+        products, next_cursor, prev_cursor = keyset_paginate(query, None, Product.id)
+    return render_template('product_list.html', products=products, q=q,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+@app.route("/api/search/products")
+@login_required
+def search_products():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify([])
+    ids = search_ids('product', q, search_limit())
+    rows = {row.id: row for row in db.session.query(
+        Product.id, Product.name, Product.category, Product.price, Product.cost_price, Inventory.quantity
+    ).outerjoin(Inventory, Inventory.product_id == Product.id).filter(Product.id.in_(ids))}
+    return jsonify([
+        {'id': row.id, 'name': row.name, 'category': row.category, 'price': row.price,
+         'cost_price': row.cost_price, 'stock': row.quantity or 0,
+         'label': f'{row.name}（{row.category}）¥{row.price} - 库存: {row.quantity or 0}'}
+        for row in (rows[product_id] for product_id in ids if product_id in rows)
+    ])
+
+@app.route("/api/search/suppliers")
+@login_required
+def search_suppliers():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify([])
+    ids = search_ids('supplier', q, search_limit())
+    suppliers = {supplier.id: supplier for supplier in Supplier.query.filter(Supplier.id.in_(ids))}
+    return jsonify([
+        {'id': supplier.id, 'name': supplier.name, 'contact': supplier.contact,
+         'label': f'{supplier.name}（{supplier.contact}）'}
+        for supplier in (suppliers[supplier_id] for supplier_id in ids if supplier_id in suppliers)
+    ])
 
 @app.route("/product/add", methods=['GET', 'POST'])
 @login_required
@@ -226,13 +1953,17 @@ def add_product():
         
         product = Product(name=name, category=category, price=price, cost_price=cost_price)
         db.session.add(product)
+        db.session.flush()
+        record_change('insert', product)
         db.session.commit()
         
         # 初始化库存
         inventory = Inventory(product_id=product.id, quantity=0)
         db.session.add(inventory)
         db.session.commit()
+        invalidate_dashboard()
         
+        product_catalog.invalidate()
         flash('商品添加成功', 'success')
         return redirect(url_for('product_list'))
     return render_template('add_product.html')
@@ -242,11 +1973,18 @@ def add_product():
 def update_product(product_id):
     product = Product.query.get_or_404(product_id)
     if request.method == 'POST':
+        old_price, old_cost_price = product.price, product.cost_price
         product.name = request.form['name']
         product.category = request.form['category']
         product.price = float(request.form['price'])
         product.cost_price = float(request.form['cost_price'])
+        if (product.price, product.cost_price) != (old_price, old_cost_price):
+            db.session.add(PriceChange(product_id=product.id, old_price=old_price, new_price=product.price,
+                                       old_cost_price=old_cost_price, new_cost_price=product.cost_price,
+                                       source='手工修改'))
+        record_change('update', product)
         db.session.commit()
+        product_catalog.invalidate()
         flash('商品信息更新成功', 'success')
         return redirect(url_for('product_list'))
     return render_template('update_product.html', product=product)
@@ -255,11 +1993,66 @@ def update_product(product_id):
 @login_required
 def delete_product(product_id):
     product = Product.query.get_or_404(product_id)
+    record_change('delete', product)
     db.session.delete(product)
     db.session.commit()
+    invalidate_dashboard()
+    product_catalog.invalidate()
     flash('商品已删除', 'success')
     return redirect(url_for('product_list'))
 
+@app.route("/product/reprice", methods=['GET', 'POST'])
+@login_required
+def reprice_products():
+    categories = [row[0] for row in db.session.query(Product.category).distinct().order_by(Product.category)]
+    if request.method == 'GET':
+        return render_template('reprice_products.html', categories=categories, summary=None)
+    
+    # JSON 请求按规则调价：{"field": "price", "category": "食品", "percent": 5, "amount": 0, "dry_run": false}
+    payload = request.get_json(silent=True) if request.is_json else None
+    try:
+        if payload is not None and not isinstance(payload, dict):
+            raise RepriceError('请求格式错误：应为 JSON 对象')
+        if payload is not None or request.form.get('mode') != 'file':
+            params = payload if payload is not None else request.form
+            field = params.get('field') or 'price'
+            category = params.get('category') or None
+            percent = import_field(params, 'percent', parse_number, '数字', required=False) or 0
+            amount = import_field(params, 'amount', parse_number, '数字', required=False) or 0
+            dry_run = str(params.get('dry_run', '')).lower() in ('1', 'true', 'on')
+            validate_price_rule(field, percent, amount)
+            summary = bulk_reprice(describe_price_rule(field, category, percent, amount),
+                                   lambda batch, source: stage_rule_changes(batch, source, field, category,
+                                                                            percent, amount),
+                                   dry_run)
+        else:
+            upload = request.files.get('file')
+            if not upload or not upload.filename:
+                raise RepriceError('请选择调价文件')
+            file_format = 'jsonl' if upload.filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+            try:
+                requested, rejected = parse_price_file(
+                    io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''), file_format
+                )
+            except UnicodeDecodeError:
+                raise RepriceError('调价文件应为 UTF-8 编码')
+            summary = bulk_reprice(f'文件 {upload.filename}'[:200],
+                                   lambda batch, source: stage_file_changes(batch, source, requested, rejected),
+                                   request.form.get('dry_run') == '1')
+    except (RepriceError, ValueError) as e:
+        if payload is not None or request.accept_mimetypes.best == 'application/json':
+            return jsonify(error=str(e)), 400
+        flash(str(e), 'danger')
+        return redirect(url_for('reprice_products'))
+    
+    if payload is not None or request.accept_mimetypes.best == 'application/json':
+        return jsonify(summary)
+    if summary['dry_run']:
+        flash(f"试算：将调整 {summary['changed']} 个商品的价格，尚未保存", 'info')
+    else:
+        flash(f"已调整 {summary['changed']} 个商品的价格", 'success')
+    return render_template('reprice_products.html', categories=categories, summary=summary)
+
 # 供应商管理路由
 @app.route("/suppliers")
 @login_required
@@ -284,6 +2077,8 @@ def add_supplier():
         
         supplier = Supplier(name=name, contact=contact, phone=phone, address=address)
         db.session.add(supplier)
+        db.session.flush()
+        record_change('insert', supplier)
         db.session.commit()
         
         flash('供应商添加成功', 'success')
@@ -299,6 +2094,7 @@ def update_supplier(supplier_id):
         supplier.contact = request.form['contact']
         supplier.phone = request.form['phone']
         supplier.address = request.form['address']
+        record_change('update', supplier)
         db.session.commit()
         flash('供应商信息更新成功', 'success')
         return redirect(url_for('supplier_list'))
@@ -308,6 +2104,7 @@ def update_supplier(supplier_id):
 @login_required
 def delete_supplier(supplier_id):
     supplier = Supplier.query.get_or_404(supplier_id)
+    record_change('delete', supplier)
     db.session.delete(supplier)
     db.session.commit()
     flash('供应商已删除', 'success')
@@ -317,54 +2114,67 @@ def delete_supplier(supplier_id):
 @app.route("/purchases")
 @login_required
 def purchase_list():
-    purchases = Purchase.query.order_by(Purchase.purchase_date.desc()).all()
-    return render_template('purchase_list.html', purchases=purchases)
+    query = Purchase.query.options(joinedload(Purchase.product), joinedload(Purchase.supplier))
+    purchases, next_cursor, prev_cursor = keyset_paginate(query, Purchase.purchase_date, Purchase.id)
+    return render_template('purchase_list.html', purchases=purchases,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 @app.route("/purchase/add", methods=['GET', 'POST'])
 @login_required
 def add_purchase():
-    products = Product.query.all()
-    suppliers = Supplier.query.all()
     if request.method == 'POST':
-        product_id = int(request.form['product_id'])
-        supplier_id = int(request.form['supplier_id'])
-        quantity = int(request.form['quantity'])
+        try:
+            product_id = int(request.form['product_id'])
+            supplier_id = int(request.form['supplier_id'])
+            quantity = int(request.form['quantity'])
+        except ValueError:
+            flash('请选择商品和供应商并填写数量', 'danger')
+            return redirect(url_for('add_purchase'))
         
-        # 获取商品信息
-        product = Product.query.get_or_404(product_id)
+        # 获取商品信息（来自商品目录缓存）
+        product = product_catalog.get(product_id)
+        if product is None:
+            abort(404)
         total_cost = product.cost_price * quantity
         
-        # 创建采购记录
-        purchase = Purchase(product_id=product_id, supplier_id=supplier_id, quantity=quantity, total_cost=total_cost)
-        db.session.add(purchase)
-        
-        # 更新库存
-        inventory = Inventory.query.filter_by(product_id=product_id).first()
-        if inventory:
-            inventory.quantity += quantity
-            inventory.last_updated = datetime.utcnow()
-        else:
-            inventory = Inventory(product_id=product_id, quantity=quantity)
-            db.session.add(inventory)
+        def work():
+            # 创建采购记录
+            purchase = Purchase(product_id=product_id, supplier_id=supplier_id, quantity=quantity, total_cost=total_cost)
+            db.session.add(purchase)
+            db.session.flush()
+            record_change('insert', purchase)
+            
+            # 更新库存
+            increment_stock(product_id, quantity, 'purchase', purchase.id)
+            db.session.commit()
         
-        db.session.commit()
+        run_with_retry(work)
+        invalidate_dashboard()
         flash('采购记录添加成功', 'success')
         return redirect(url_for('purchase_list'))
-    return render_template('add_purchase.html', products=products, suppliers=suppliers)
+    return render_template('add_purchase.html')
 
 @app.route("/purchase/<int:purchase_id>/delete", methods=['POST'])
 @login_required
 def delete_purchase(purchase_id):
-    purchase = Purchase.query.get_or_404(purchase_id)
-    
-    # 更新库存（撤销采购）
-    inventory = Inventory.query.filter_by(product_id=purchase.product_id).first()
-    if inventory and inventory.quantity >= purchase.quantity:
-        inventory.quantity -= purchase.quantity
-        inventory.last_updated = datetime.utcnow()
+    def work():
+        purchase = Purchase.query.get_or_404(purchase_id)
+        error = locked_period_error(purchase.purchase_date)
+        if error:
+            return error
+        
+        # 更新库存（撤销采购；库存已不足时不扣减）
+        decrement_stock(purchase.product_id, purchase.quantity, 'purchase_delete', purchase.id)
+        
+        record_change('delete', purchase)
+        db.session.delete(purchase)
+        db.session.commit()
     
-    db.session.delete(purchase)
-    db.session.commit()
+    error = run_with_retry(work)
+    if error:
+        flash(error, 'danger')
+        return redirect(url_for('purchase_list'))
+    invalidate_dashboard()
     flash('采购记录已删除', 'success')
     return redirect(url_for('purchase_list'))
 
@@ -372,55 +2182,137 @@ def delete_purchase(purchase_id):
 @app.route("/sales")
 @login_required
 def sale_list():
-    sales = Sale.query.order_by(Sale.sale_date.desc()).all()
-    return render_template('sale_list.html', sales=sales)
+    query = Sale.query.options(joinedload(Sale.product))
+    sales, next_cursor, prev_cursor = keyset_paginate(query, Sale.sale_date, Sale.id)
+    return render_template('sale_list.html', sales=sales,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 @app.route("/sale/add", methods=['GET', 'POST'])
 @login_required
 def add_sale():
-    products = Product.query.all()
     if request.method == 'POST':
-        product_id = int(request.form['product_id'])
-        quantity = int(request.form['quantity'])
-        
-        # 获取商品信息
-        product = Product.query.get_or_404(product_id)
-        
-        # 检查库存
-        inventory = Inventory.query.filter_by(product_id=product_id).first()
-        if not inventory or inventory.quantity < quantity:
-            flash('库存不足，无法完成销售', 'danger')
+        try:
+            product_id = int(request.form['product_id'])
+            quantity = int(request.form['quantity'])
+        except ValueError:
+            flash('请选择商品并填写数量', 'danger')
             return redirect(url_for('add_sale'))
         
+        # 获取商品信息（来自商品目录缓存）
+        product = product_catalog.get(product_id)
+        if product is None:
+            abort(404)
+        
         # 计算总金额
         total_amount = product.price * quantity
         
-        # 创建销售记录
-        sale = Sale(product_id=product_id, quantity=quantity, total_amount=total_amount)
-        db.session.add(sale)
-        
-        # 更新库存
-        inventory.quantity -= quantity
-        inventory.last_updated = datetime.utcnow()
+        def work():
+            # 创建销售记录
+            sale = Sale(product_id=product_id, quantity=quantity, total_amount=total_amount,
+                        total_cost=product.cost_price * quantity, sale_date=datetime.utcnow())
+            db.session.add(sale)
+            db.session.flush()
+            record_change('insert', sale)
+            
+            # 检查并扣减库存
+            if not decrement_stock(product_id, quantity, 'sale', sale.id):
+                db.session.rollback()
+                return False
+            update_sales_summary(product_id, sale.sale_date, quantity, total_amount, sale.total_cost)
+            db.session.commit()
+            return True
         
-        db.session.commit()
+        if not run_with_retry(work):
+            flash('库存不足，无法完成销售', 'danger')
+            return redirect(url_for('add_sale'))
+        invalidate_dashboard()
         flash('销售记录添加成功', 'success')
         return redirect(url_for('sale_list'))
-    return render_template('add_sale.html', products=products)
+    return render_template('add_sale.html')
+
+@app.route("/checkout", methods=['GET', 'POST'])
+@login_required
+def checkout():
+    if request.method == 'POST':
+        try:
+            lines = [(int(product_id), int(quantity)) for product_id, quantity in
+                     zip(request.form.getlist('product_id'), request.form.getlist('quantity'))
+                     if product_id and quantity]
+            sales = checkout_basket(lines)
+        except ValueError:
+            db.session.rollback()
+            flash('商品或数量格式错误', 'danger')
+            return redirect(url_for('checkout'))
+        except CheckoutError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('checkout'))
+        total = sum(sale.total_amount for sale in sales)
+        flash(f'结账成功，共 {len(sales)} 件商品，合计 ¥{total:.2f}', 'success')
+        return redirect(url_for('sale_list'))
+    return render_template('checkout.html')
+
+@app.route("/api/checkout", methods=['POST'])
+@login_required
+def api_checkout():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify(error='商品或数量格式错误'), 400
+    try:
+        lines = [(int(line['product_id']), int(line['quantity'])) for line in payload.get('lines', [])]
+        sales = checkout_basket(lines)
+    except (KeyError, TypeError, ValueError):
+        db.session.rollback()
+        return jsonify(error='商品或数量格式错误'), 400
+    except CheckoutError as e:
+        db.session.rollback()
+        return jsonify(error=str(e)), 409
+    return jsonify(
+        sale_ids=[sale.id for sale in sales],
+        total_amount=round(sum(sale.total_amount for sale in sales), 2)
+    ), 201
+
+@app.route("/sale/import", methods=['GET', 'POST'])
+@login_required
+def import_sales():
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('请选择要导入的文件', 'danger')
+            return redirect(url_for('import_sales'))
+        file_format = 'jsonl' if upload.filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        result = bulk_import_sales(stream, file_format)
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify(imported=result['imported'], rejected=result['rejected'])
+        flash(f"成功导入 {result['imported']} 条销售记录，拒绝 {len(result['rejected'])} 行",
+              'success' if not result['rejected'] else 'warning')
+        return render_template('import_sales.html', rejected=result['rejected'][:1000])
+    return render_template('import_sales.html', rejected=[])
 
 @app.route("/sale/<int:sale_id>/delete", methods=['POST'])
 @login_required
 def delete_sale(sale_id):
-    sale = Sale.query.get_or_404(sale_id)
-    
-    # 更新库存（撤销销售）
-    inventory = Inventory.query.filter_by(product_id=sale.product_id).first()
-    if inventory:
-        inventory.quantity += sale.quantity
-        inventory.last_updated = datetime.utcnow()
+    def work():
+        sale = Sale.query.get_or_404(sale_id)
+        error = locked_period_error(sale.sale_date)
+        if error:
+            return error
+        
+        # 更新库存（撤销销售）
+        increment_stock(sale.product_id, sale.quantity, 'sale_delete', sale.id)
+        
+        # 按销售时保存的成本冲减，调价不影响已有销售的成本
+        update_sales_summary(sale.product_id, sale.sale_date, -sale.quantity, -sale.total_amount, -sale.total_cost)
+        record_change('delete', sale)
+        db.session.delete(sale)
+        db.session.commit()
     
-    db.session.delete(sale)
-    db.session.commit()
+    error = run_with_retry(work)
+    if error:
+        flash(error, 'danger')
+        return redirect(url_for('sale_list'))
+    invalidate_dashboard()
     flash('销售记录已删除', 'success')
     return redirect(url_for('sale_list'))
 
@@ -428,8 +2320,9 @@ def delete_sale(sale_id):
 @app.route("/expenses")
 @login_required
 def expense_list():
-    expenses = Expense.query.order_by(Expense.expense_date.desc()).all()
-    return render_template('expense_list.html', expenses=expenses)
+    expenses, next_cursor, prev_cursor = keyset_paginate(Expense.query, Expense.expense_date, Expense.id)
+    return render_template('expense_list.html', expenses=expenses,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 @app.route("/expense/add", methods=['GET', 'POST'])
 @login_required
@@ -441,7 +2334,10 @@ def add_expense():
         
         expense = Expense(description=description, amount=amount, category=category)
         db.session.add(expense)
+        db.session.flush()
+        record_change('insert', expense)
         db.session.commit()
+        invalidate_dashboard()
         
         flash('费用记录添加成功', 'success')
         return redirect(url_for('expense_list'))
@@ -451,16 +2347,23 @@ def add_expense():
 @login_required
 def delete_expense(expense_id):
     expense = Expense.query.get_or_404(expense_id)
+    error = locked_period_error(expense.expense_date)
+    if error:
+        flash(error, 'danger')
+        return redirect(url_for('expense_list'))
+    record_change('delete', expense)
     db.session.delete(expense)
     db.session.commit()
+    invalidate_dashboard()
     flash('费用记录已删除', 'success')
     return redirect(url_for('expense_list'))
 
 @app.route("/incomes")
 @login_required
 def income_list():
-    incomes = Income.query.order_by(Income.income_date.desc()).all()
-    return render_template('income_list.html', incomes=incomes)
+    incomes, next_cursor, prev_cursor = keyset_paginate(Income.query, Income.income_date, Income.id)
+    return render_template('income_list.html', incomes=incomes,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 @app.route("/income/add", methods=['GET', 'POST'])
 @login_required
@@ -472,6 +2375,8 @@ def add_income():
         
         income = Income(description=description, amount=amount, category=category)
         db.session.add(income)
+        db.session.flush()
+        record_change('insert', income)
         db.session.commit()
         
         flash('收入记录添加成功', 'success')
@@ -482,66 +2387,311 @@ def add_income():
 @login_required
 def delete_income(income_id):
     income = Income.query.get_or_404(income_id)
+    error = locked_period_error(income.income_date)
+    if error:
+        flash(error, 'danger')
+        return redirect(url_for('income_list'))
+    record_change('delete', income)
     db.session.delete(income)
     db.session.commit()
     flash('收入记录已删除', 'success')
     return redirect(url_for('income_list'))
 
+# 变更流接口：下游从保存的偏移量开始按批读取，处理完成后确认偏移量
+@app.route("/api/changes")
+@login_required
+def api_changes():
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', app.config['CHANGE_FEED_BATCH_SIZE']))
+    except ValueError:
+        return jsonify(error='after 和 limit 必须是整数'), 400
+    limit = max(1, min(limit, app.config['CHANGE_FEED_MAX_BATCH_SIZE']))
+    events = fetch_changes(after, limit + 1)
+    has_more = len(events) > limit
+    events = events[:limit]
+    return jsonify(
+        events=[{
+            'offset': event.id, 'entity': event.entity, 'id': event.entity_id, 'op': event.op,
+            'data': json.loads(event.data) if event.data else None,
+            'created_at': change_value(event.created_at),
+        } for event in events],
+        next_offset=events[-1].id if events else after,
+        has_more=has_more,
+    )
+
+@app.route("/api/changes/ack", methods=['POST'])
+@login_required
+def api_ack_changes():
+    payload = request.get_json(silent=True) or {}
+    try:
+        consumer = str(payload['consumer'])[:50]
+        offset = int(payload['offset'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify(error='需要 consumer 和整数 offset'), 400
+    return jsonify(consumer=consumer, offset=ack_changes(consumer, offset))
+
+# 数据导出（CSV / XLSX），按批从游标读取，内存占用与导出行数无关
+EXPORT_LEDGERS = {
+    'sales': {
+        'title': '销售记录',
+        'model': Sale,
+        'date_field': 'sale_date',
+        'headers': ['编号', '商品名称', '销售数量', '销售金额', '销售日期'],
+        'columns': lambda sale: (sale.id, Product.name, sale.quantity, sale.total_amount, sale.sale_date),
+        'joins': lambda query, sale: query.outerjoin(Product, Product.id == sale.product_id),
+    },
+    'purchases': {
+        'title': '采购记录',
+        'model': Purchase,
+        'date_field': 'purchase_date',
+        'headers': ['编号', '商品名称', '供应商', '采购数量', '总成本', '采购日期'],
+        'columns': lambda purchase: (purchase.id, Product.name, Supplier.name, purchase.quantity,
+                                     purchase.total_cost, purchase.purchase_date),
+        'joins': lambda query, purchase: query.outerjoin(Product, Product.id == purchase.product_id)
+                                              .outerjoin(Supplier, Supplier.id == purchase.supplier_id),
+    },
+    'expenses': {
+        'title': '费用记录',
+        'model': Expense,
+        'date_field': 'expense_date',
+        'headers': ['编号', '费用描述', '金额', '分类', '费用日期'],
+        'columns': lambda expense: (expense.id, expense.description, expense.amount, expense.category,
+                                    expense.expense_date),
+        'joins': lambda query, expense: query,
+    },
+    'incomes': {
+        'title': '收入记录',
+        'model': Income,
+        'date_field': 'income_date',
+        'headers': ['编号', '收入描述', '金额', '分类', '收入日期'],
+        'columns': lambda income: (income.id, income.description, income.amount, income.category,
+                                   income.income_date),
+        'joins': lambda query, income: query,
+    },
+}
+
+def parse_date_range():
+    # start/end 为包含在内的日期（YYYY-MM-DD），默认本月
+    default_start, default_end = month_window()
+    try:
+        start = request.args.get('start')
+        start = datetime.strptime(start, '%Y-%m-%d') if start else default_start
+        end = request.args.get('end')
+        end = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else default_end
+    except ValueError:
+        abort(400)
+    return start, end
+
+def iter_export_rows(ledger, window):
+    session = get_report_session()
+    # 导出范围跨入已归档年份时，明细表换成合并了年度库的子查询
+    entity = ledger_entity(session, ledger['model'], window)
+    date_column = getattr(entity, ledger['date_field'])
+    columns = ledger['columns'](entity)
+    query = ledger['joins'](session.query(*columns), entity).filter(
+        in_window(date_column, window)
+    ).order_by(date_column, columns[0])
+    return query.yield_per(app.config['EXPORT_BATCH_SIZE'])
+
+def generate_csv(ledger, window):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # 带 BOM，便于 Excel 正确识别中文
+    buffer.write('\ufeff')
+    writer.writerow(ledger['headers'])
+    for count, row in enumerate(iter_export_rows(ledger, window), start=1):
+        writer.writerow(row)
+        if count % app.config['EXPORT_BATCH_SIZE'] == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def write_xlsx(ledger, window, check_cancelled=None):
+    # check_cancelled 由后台任务传入，每写入一批行检查一次是否已取消
+    from openpyxl import Workbook
+    
+    # write_only 模式逐行写入磁盘，不在内存中保留整个工作表
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(ledger['title'])
+    sheet.append(ledger['headers'])
+    try:
+        for count, row in enumerate(iter_export_rows(ledger, window), start=1):
+            sheet.append(list(row))
+            if check_cancelled and count % app.config['EXPORT_BATCH_SIZE'] == 0:
+                check_cancelled()
+    except JobCancelled:
+        # 先关闭工作表，释放 openpyxl 写入中的临时文件
+        sheet.close()
+        raise
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+@app.route("/export/<ledger_name>")
+@login_required
+def export_ledger(ledger_name):
+    ledger = EXPORT_LEDGERS.get(ledger_name)
+    if ledger is None:
+        abort(404)
+    window = parse_date_range()
+    filename = f"{ledger_name}_{window[0]:%Y%m%d}_{(window[1] - timedelta(days=1)):%Y%m%d}"
+    
+    if request.args.get('format', 'csv') == 'xlsx':
+        try:
+            output = write_xlsx(ledger, window)
+        except ImportError:
+            flash('导出 Excel 需要安装 openpyxl', 'danger')
+            return redirect(request.referrer or url_for('home'))
+        return send_file(output, as_attachment=True, download_name=f'{filename}.xlsx',
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    
+    return Response(stream_with_context(generate_csv(ledger, window)), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}.csv'})
+
+# 补货建议：按销售历史预测每个商品的日需求，计算补货点；库存不高于补货点（可售天数不足补货周期加安全库存）时提示补货
+replenishment_plan_table = ReplenishmentPlan.__table__
+
+def refresh_replenishment_plan(method=None, history_days=None, check_cancelled=None):
+    # check_cancelled 由后台任务传入：预测计算完成后、替换补货建议之前检查是否已取消
+    from forecasting import forecast
+    
+    method = method or app.config['FORECAST_METHOD']
+    result = forecast(db.session, date.today(), history_days, method=method,
+                      window=app.config['FORECAST_WINDOW'], alpha=app.config['FORECAST_ALPHA'],
+                      lead_days=app.config['REORDER_LEAD_DAYS'], service_z=app.config['REORDER_SERVICE_Z'])
+    now = datetime.utcnow()
+    rows = [
+        {'product_id': product_id, 'daily_demand': demand, 'demand_std': std, 'safety_stock': safety,
+         'reorder_point': reorder_point, 'on_hand': int(on_hand),
+         'days_of_cover': cover if cover != float('inf') else None, 'method': method, 'computed_at': now}
+        for product_id, demand, std, safety, reorder_point, on_hand, cover in zip(*(
+            column.tolist() for column in result))
+    ]
+    if check_cancelled:
+        check_cancelled()
+    
+    def work():
+        db.session.execute(replenishment_plan_table.delete())
+        if rows:
+            db.session.execute(replenishment_plan_table.insert(), rows)
+        db.session.commit()
+    
+    run_with_retry(work)
+    invalidate_dashboard()
+    return len(rows)
+
+def reorder_condition():
+    # 有补货建议的商品按补货点判断，尚未计算的商品仍按库存小于10判断
+    return db.or_(
+        db.and_(ReplenishmentPlan.product_id.is_(None), Inventory.quantity < 10),
+        Inventory.quantity <= ReplenishmentPlan.reorder_point,
+    )
+
 # 报表分析路由
 @app.route("/report/sales")
 @login_required
 def sales_report():
-    from datetime import date, timedelta
-    
-    # 获取最近30天的销售数据
-    today = date.today()
-    start_date = today - timedelta(days=29)
+    return render_template('sales_report.html', **sales_report_data(get_report_session()))
+
+def sales_report_data(session, days=30, top=10):
+    # 最近 days 天的销售报表数据（从销售日汇总表读取）；top 为 None 时返回全部商品
+    start, end = last_days_window(days)
     
     # 按日期分组统计销售额
-    daily_sales = db.session.query(
-        db.func.date(Sale.sale_date).label('sale_date'),
-        db.func.sum(Sale.total_amount).label('total_amount')
+    daily_sales = session.query(
+        SalesDailySummary.summary_date.label('sale_date'),
+        db.func.sum(SalesDailySummary.revenue).label('total_amount')
     ).filter(
-        db.func.date(Sale.sale_date) >= start_date
+        SalesDailySummary.summary_date >= start.date(),
+        SalesDailySummary.summary_date < end.date()
     ).group_by(
-        db.func.date(Sale.sale_date)
+        SalesDailySummary.summary_date
     ).order_by(
-        db.func.date(Sale.sale_date)
+        SalesDailySummary.summary_date
     ).all()
     
     # 按月分组统计销售额
-    monthly_sales = db.session.query(
-        db.func.strftime('%Y-%m', Sale.sale_date).label('month'),
-        db.func.sum(Sale.total_amount).label('total_amount')
+    monthly_sales = session.query(
+        db.func.strftime('%Y-%m', SalesDailySummary.summary_date).label('month'),
+        db.func.sum(SalesDailySummary.revenue).label('total_amount')
     ).group_by(
-        db.func.strftime('%Y-%m', Sale.sale_date)
+        'month'
     ).order_by(
         'month'
     ).all()
     
     # 按商品分组统计销售额
-    product_sales = db.session.query(
+    product_sales = session.query(
         Product.name,
-        db.func.sum(Sale.quantity).label('total_quantity'),
-        db.func.sum(Sale.total_amount).label('total_amount')
+        db.func.sum(SalesDailySummary.quantity).label('total_quantity'),
+        db.func.sum(SalesDailySummary.revenue).label('total_amount')
     ).join(
-        Sale
+        SalesDailySummary, SalesDailySummary.product_id == Product.id
     ).group_by(
-        Product.name
+        Product.id, Product.name
     ).order_by(
         db.desc('total_amount')
-    ).limit(10).all()
+    ).limit(top).all()
     
-    return render_template('sales_report.html', 
-                           daily_sales=daily_sales,
-                           monthly_sales=monthly_sales,
-                           product_sales=product_sales)
+    return {
+        'daily_sales': daily_sales,
+        'monthly_sales': monthly_sales,
+        'product_sales': product_sales,
+    }
+
+InventoryItem = namedtuple('InventoryItem', ['name', 'category', 'quantity', 'price'])
+CategoryInventory = namedtuple('CategoryInventory', ['category', 'total_quantity', 'total_value'])
+
+def historical_inventory(session, moment):
+    # 由库存快照和流水还原某一时刻的库存，返回与实时库存报表相同的四组数据
+    quantities = stock_as_of(session, moment)
+    inventory_items = sorted(
+        (InventoryItem(name, category, quantities.get(product_id, 0), price)
+         for product_id, name, category, price in
+         session.query(Product.id, Product.name, Product.category, Product.price)),
+        key=lambda item: item.quantity
+    )
+    total_inventory_value = sum(item.price * item.quantity for item in inventory_items)
+    
+    categories = defaultdict(lambda: [0, 0])
+    for item in inventory_items:
+        categories[item.category][0] += item.quantity
+        categories[item.category][1] += item.price * item.quantity
+    category_inventory = [CategoryInventory(category, quantity, value)
+                          for category, (quantity, value) in sorted(categories.items())]
+    
+    low_stock_items = [item for item in inventory_items if item.quantity < 10]
+    return inventory_items, total_inventory_value, category_inventory, low_stock_items
 
 @app.route("/report/inventory")
 @login_required
 def inventory_report():
+    # 指定 as_of 日期时，显示该日日终的历史库存
+    as_of = request.args.get('as_of')
+    if as_of:
+        try:
+            as_of = datetime.strptime(as_of, '%Y-%m-%d').date()
+        except ValueError:
+            abort(400)
+    return render_template('inventory_report.html', **inventory_report_data(get_report_session(), as_of))
+
+def inventory_report_data(session, as_of=None):
+    if as_of:
+        inventory_items, total_inventory_value, category_inventory, low_stock_items = \
+            historical_inventory(session, day_window(as_of)[1])
+        return {
+            'as_of': as_of,
+            'inventory_items': inventory_items,
+            'total_inventory_value': total_inventory_value,
+            'category_inventory': category_inventory,
+            'low_stock_items': low_stock_items,
+        }
+    
     # 获取所有商品的库存信息
-    inventory_items = db.session.query(
+    inventory_items = session.query(
         Product.name,
         Product.category,
         Inventory.quantity,
@@ -553,14 +2703,14 @@ def inventory_report():
     ).all()
     
     # 计算总库存价值
-    total_inventory_value = db.session.query(
+    total_inventory_value = session.query(
         db.func.sum(Product.price * Inventory.quantity)
     ).join(
         Inventory
     ).scalar() or 0
     
     # 按类别统计库存
-    category_inventory = db.session.query(
+    category_inventory = session.query(
         Product.category,
         db.func.sum(Inventory.quantity).label('total_quantity'),
         db.func.sum(Product.price * Inventory.quantity).label('total_value')
@@ -572,97 +2722,213 @@ def inventory_report():
         'category'
     ).all()
     
-    # 低库存商品（库存小于10）
-    low_stock_items = db.session.query(
+    # 需补货商品：库存不高于补货点，按当前库存的可售天数升序（没有需求的商品排在最前）
+    days_of_cover = Inventory.quantity / db.func.nullif(ReplenishmentPlan.daily_demand, 0)
+    low_stock_items = session.query(
         Product.name,
         Product.category,
-        Inventory.quantity
+        Inventory.quantity,
+        ReplenishmentPlan.daily_demand,
+        ReplenishmentPlan.reorder_point,
+        days_of_cover.label('days_of_cover')
     ).join(
         Inventory
+    ).outerjoin(
+        ReplenishmentPlan, ReplenishmentPlan.product_id == Product.id
     ).filter(
-        Inventory.quantity < 10
+        reorder_condition()
     ).order_by(
-        Inventory.quantity
+        days_of_cover.nulls_first(), Inventory.quantity
     ).all()
     
-    return render_template('inventory_report.html',
-                          inventory_items=inventory_items,
-                          total_inventory_value=total_inventory_value,
-                          category_inventory=category_inventory,
-                          low_stock_items=low_stock_items)
+    return {
+        'inventory_items': inventory_items,
+        'total_inventory_value': total_inventory_value,
+        'category_inventory': category_inventory,
+        'low_stock_items': low_stock_items,
+    }
+
+def closing_position(session, moment, low_stock=10):
+    # moment 时点的库存价值（按当前成本价）、低库存商品数和商品数
+    quantities = stock_as_of(session, moment)
+    inventory_value = 0
+    low_stock_count = 0
+    product_count = 0
+    for product_id, cost_price in session.query(Product.id, Product.cost_price):
+        quantity = quantities.get(product_id, 0)
+        inventory_value += cost_price * quantity
+        low_stock_count += quantity < low_stock
+        product_count += 1
+    return inventory_value, low_stock_count, product_count
+
+def close_period(month_start):
+    """月结：计算并保存 month_start 所在月份的报表数据（已结账的月份会被重新计算）"""
+    window = month_window(month_start)
+    if window[1] > datetime.combine(date.today(), datetime.min.time()):
+        raise ValueError(f'{month_start:%Y-%m} 尚未结束，不能结账')
+    metrics = ledger_metrics(db.session, window)
+    inventory_value, low_stock_count, product_count = closing_position(db.session, window[1])
+    operating_cash_in = metrics.sales + metrics.other_income
+    operating_cash_out = metrics.purchases + metrics.expenses
+    db.session.merge(PeriodClose(
+        period_start=window[0].date(),
+        sales=metrics.sales,
+        purchase_cost=metrics.purchases,
+        expenses=metrics.expenses,
+        other_income=metrics.other_income,
+        profit=operating_cash_in - operating_cash_out,
+        operating_cash_in=operating_cash_in,
+        operating_cash_out=operating_cash_out,
+        inventory_value=inventory_value,
+        low_stock_count=low_stock_count,
+        product_count=product_count,
+        expense_categories=json.dumps([list(item) for item in metrics.expense_categories], ensure_ascii=False),
+        income_categories=json.dumps([list(item) for item in metrics.income_categories], ensure_ascii=False),
+        closed_at=datetime.utcnow(),
+    ))
+    db.session.commit()
+
+def check_archivable(year):
+    # 只能归档已经结束且 12 个月全部月结的年份：往年报表取自结账记录，归档后仍可以重新结账
+    if year >= date.today().year:
+        raise ValueError(f'{year} 年尚未结束，不能归档')
+    closed = db.session.query(db.func.count(PeriodClose.period_start)).filter(
+        PeriodClose.period_start >= date(year, 1, 1), PeriodClose.period_start < date(year + 1, 1, 1)
+    ).scalar()
+    if closed < 12:
+        raise ValueError(f'{year} 年只有 {closed} 个月已月结，请先执行 close-period')
+
+def archivable_years():
+    # 主库中还有明细、已全部月结且尚未归档的往年
+    ledger_dates = (Sale.sale_date, Purchase.purchase_date, Expense.expense_date, Income.income_date)
+    earliest = [db.session.query(db.func.min(column)).scalar() for column in ledger_dates]
+    earliest = [value for value in earliest if value is not None]
+    if not earliest:
+        return []
+    archived = {row[0] for row in db.session.query(LedgerArchive.year)}
+    years = []
+    for year in range(min(earliest).year, date.today().year):
+        window = year_window(date(year, 1, 1))
+        if year in archived or not any(db.session.query(db.exists().where(in_window(column, window))).scalar()
+                                       for column in ledger_dates):
+            continue
+        try:
+            check_archivable(year)
+        except ValueError:
+            continue
+        years.append(year)
+    return years
+
+def unclosed_months():
+    # 从最早一笔业务所在月份到上个月，尚未月结的月份
+    earliest = [db.session.query(db.func.min(column)).scalar()
+                for column in (Sale.sale_date, Purchase.purchase_date, Expense.expense_date, Income.income_date)]
+    earliest = [value for value in earliest if value is not None]
+    if not earliest:
+        return []
+    closed = {row[0] for row in db.session.query(PeriodClose.period_start)}
+    month_start, this_month = month_window(min(earliest))[0], month_window()[0]
+    months = []
+    while month_start < this_month:
+        if month_start.date() not in closed:
+            months.append(month_start.date())
+        month_start = month_window(month_start)[1]
+    return months
+
+def locked_period_error(moment, action='删除'):
+    # 已归档年份和已月结月份的明细不能再修改：报表取自结账记录，修改明细后两者会不一致；返回错误信息或 None
+    if db.session.get(LedgerArchive, moment.year) is not None:
+        return f'{moment.year} 年已归档，不能{action}该年的记录'
+    if db.session.get(PeriodClose, month_window(moment)[0].date()) is not None:
+        return f'{moment:%Y-%m} 已月结，不能{action}该月的记录，如需更正请在当月登记调整'
+    return None
+
+def period_statement(session, window):
+    """window 期间的报表指标：已月结的整月直接读取 PeriodClose，其余部分实时聚合；返回 (指标, 已结账月数)"""
+    start, end = window
+    closed = {row.period_start: row for row in session.query(PeriodClose).filter(
+        PeriodClose.period_start >= start.date(), PeriodClose.period_start < end.date()
+    )}
+    parts = []
+    closed_months = 0
+    live_start = None
+    cursor = start
+    while cursor < end:
+        month_start, month_end = month_window(cursor)
+        row = closed.get(month_start.date())
+        if cursor == month_start and month_end <= end and row is not None:
+            if live_start is not None:
+                parts.append(ledger_metrics(session, (live_start, cursor)))
+                live_start = None
+            parts.append(row.to_metrics())
+            closed_months += 1
+        elif live_start is None:
+            live_start = cursor
+        cursor = min(month_end, end)
+    if live_start is not None:
+        parts.append(ledger_metrics(session, (live_start, end)))
+    
+    closing = None
+    if live_start is not None and end <= datetime.combine(date.today(), datetime.min.time()):
+        # 期末落在未结账的历史月份：由库存流水还原期末库存
+        inventory_value, low_stock_count, product_count = closing_position(session, end)
+        closing = parts[-1]._replace(inventory_value=inventory_value, low_stock_count=low_stock_count,
+                                     product_count=product_count)
+    return combine_metrics(parts, closing), closed_months
+
+def shift_years(moment, years):
+    try:
+        return moment.replace(year=moment.year + years)
+    except ValueError:
+        # 2月29日
+        return moment.replace(year=moment.year + years, day=28)
 
 @app.route("/report/financial")
 @login_required
 def financial_report():
-    from datetime import date
-    
-    today = date.today()
-    
-    # 本月财务数据
-    month_start = date(today.year, today.month, 1)
-    
-    # 本月销售额
-    month_sales = db.session.query(
-        db.func.sum(Sale.total_amount)
-    ).filter(
-        Sale.sale_date >= month_start
-    ).scalar() or 0
-    
-    # 本月采购成本
-    month_purchase_cost = db.session.query(
-        db.func.sum(Purchase.total_cost)
-    ).filter(
-        Purchase.purchase_date >= month_start
-    ).scalar() or 0
+    return render_template('financial_report.html', **financial_report_data(get_report_session()))
+
+def financial_report_data(session, monthly=False):
+    # 按请求参数计算财务报表数据；monthly 为真时附带期间内逐月的利润明细
+    # 报表期间：month / quarter / year（ref 指定所在日期，默认今天），或 custom（start/end）
+    period = request.args.get('period', 'month')
+    if period == 'custom':
+        window = parse_date_range()
+        period_label = f"{window[0]:%Y-%m-%d} 至 {(window[1] - timedelta(days=1)):%Y-%m-%d}"
+    else:
+        try:
+            ref = request.args.get('ref')
+            ref = datetime.strptime(ref, '%Y-%m-%d').date() if ref else date.today()
+        except ValueError:
+            abort(400)
+        windows = {'month': month_window, 'quarter': quarter_window, 'year': year_window}
+        if period not in windows:
+            abort(400)
+        window = windows[period](ref)
+        period_label = {
+            'month': f'{ref.year}年{ref.month}月',
+            'quarter': f'{ref.year}年第{(ref.month - 1) // 3 + 1}季度',
+            'year': f'{ref.year}年',
+        }[period]
     
-    # 本月费用
-    month_expenses = db.session.query(
-        db.func.sum(Expense.amount)
-    ).filter(
-        Expense.expense_date >= month_start
-    ).scalar() or 0
+    if window[1] > datetime.combine(date.today(), datetime.min.time()):
+        period_label += '（截至今日）'
     
-    # 本月收入（包括销售和其他收入）
-    month_other_income = db.session.query(
-        db.func.sum(Income.amount)
-    ).filter(
-        Income.income_date >= month_start
-    ).scalar() or 0
+    # 已月结的月份直接读取结账数据，只有未结账部分实时聚合
+    metrics, closed_months = period_statement(session, window)
+    month_sales = metrics.sales
+    month_purchase_cost = metrics.purchases
+    month_expenses = metrics.expenses
+    month_other_income = metrics.other_income
+    expense_categories = metrics.expense_categories
+    income_categories = metrics.income_categories
     
-    # 计算本月利润
+    # 计算期间利润
     month_profit = (month_sales + month_other_income) - (month_purchase_cost + month_expenses)
     
-    # 费用分类统计
-    expense_categories = db.session.query(
-        Expense.category,
-        db.func.sum(Expense.amount).label('total_amount')
-    ).filter(
-        Expense.expense_date >= month_start
-    ).group_by(
-        Expense.category
-    ).order_by(
-        db.desc('total_amount')
-    ).all()
-    
-    # 收入分类统计
-    income_categories = db.session.query(
-        Income.category,
-        db.func.sum(Income.amount).label('total_amount')
-    ).filter(
-        Income.income_date >= month_start
-    ).group_by(
-        Income.category
-    ).order_by(
-        db.desc('total_amount')
-    ).all()
-    
     # 资产负债表数据
     # 库存价值（按成本价计算）
-    total_inventory_value = db.session.query(
-        db.func.sum(Product.cost_price * Inventory.quantity)
-    ).join(
-        Inventory, Product.id == Inventory.product_id
-    ).scalar() or 0
+    total_inventory_value = metrics.inventory_value
     
     # 计算总资产（库存价值 + 本月利润）
     total_assets = total_inventory_value + month_profit
@@ -682,26 +2948,409 @@ def financial_report():
     # 净现金流量
     net_cash_flow = operating_cash_in - operating_cash_out
     
-    return render_template('financial_report.html',
-                          month_sales=month_sales,
-                          month_purchase_cost=month_purchase_cost,
-                          month_expenses=month_expenses,
-                          month_other_income=month_other_income,
-                          month_profit=month_profit,
-                          expense_categories=expense_categories,
-                          income_categories=income_categories,
-                          total_inventory_value=total_inventory_value,
-                          total_assets=total_assets,
-                          total_liabilities=total_liabilities,
-                          total_equity=total_equity,
-                          operating_cash_in=operating_cash_in,
-                          operating_cash_out=operating_cash_out,
-                          net_cash_flow=net_cash_flow)
+    # 往年同期对比（compare=N，最多5年）
+    try:
+        compare = min(max(int(request.args.get('compare', 0)), 0), 5)
+    except ValueError:
+        abort(400)
+    comparison = []
+    for years_back in range(1, compare + 1):
+        past_window = (shift_years(window[0], -years_back), shift_years(window[1], -years_back))
+        past, _ = period_statement(session, past_window)
+        comparison.append({
+            'label': f"{past_window[0]:%Y-%m-%d} 至 {(past_window[1] - timedelta(days=1)):%Y-%m-%d}",
+            'sales': past.sales,
+            'purchase_cost': past.purchases,
+            'expenses': past.expenses,
+            'other_income': past.other_income,
+            'profit': (past.sales + past.other_income) - (past.purchases + past.expenses),
+            'inventory_value': past.inventory_value,
+        })
+    
+    # 逐月明细：一条按月分组的语句算出期间内每月的发生额
+    monthly_breakdown = []
+    if monthly:
+        for flow in monthly_flows(session, window, sources=ledger_sources(session.connection(), window)):
+            monthly_breakdown.append({
+                'label': flow.month,
+                'sales': flow.sales,
+                'purchase_cost': flow.purchases,
+                'expenses': flow.expenses,
+                'other_income': flow.other_income,
+                'profit': (flow.sales + flow.other_income) - (flow.purchases + flow.expenses),
+            })
+    
+    return {
+        'period': period,
+        'period_label': period_label,
+        'closed_months': closed_months,
+        'compare': compare,
+        'comparison': comparison,
+        'monthly_breakdown': monthly_breakdown,
+        'month_sales': month_sales,
+        'month_purchase_cost': month_purchase_cost,
+        'month_expenses': month_expenses,
+        'month_other_income': month_other_income,
+        'month_profit': month_profit,
+        'expense_categories': expense_categories,
+        'income_categories': income_categories,
+        'total_inventory_value': total_inventory_value,
+        'total_assets': total_assets,
+        'total_liabilities': total_liabilities,
+        'total_equity': total_equity,
+        'operating_cash_in': operating_cash_in,
+        'operating_cash_out': operating_cash_out,
+        'net_cash_flow': net_cash_flow,
+    }
+
+REPORT_DOCX_NAMES = {'sales': '销售报表', 'inventory': '库存报表', 'financial': '财务报表'}
+
+def build_report_docx(report_name, check_cancelled=None):
+    # 直接用报表数据生成 Word 文档（不经过 HTML/Markdown），参数与对应的报表页面相同；
+    # check_cancelled 由后台任务传入，在查询数据之后和生成文件之前检查是否已取消
+    from docx_report import REPORT_BUILDERS, report_to_bytes
+    
+    check_cancelled = check_cancelled or (lambda: None)
+    session = get_report_session()
+    if report_name == 'sales':
+        # Word 版列出全部商品；days 可指定统计天数（最多一年）
+        try:
+            days = min(max(int(request.args.get('days', 30)), 1), 366)
+        except ValueError:
+            abort(400)
+        data = sales_report_data(session, days=days, top=None)
+        check_cancelled()
+        doc = REPORT_BUILDERS['sales'](data, days=days)
+    elif report_name == 'inventory':
+        as_of = request.args.get('as_of')
+        if as_of:
+            try:
+                as_of = datetime.strptime(as_of, '%Y-%m-%d').date()
+            except ValueError:
+                abort(400)
+        data = inventory_report_data(session, as_of)
+        check_cancelled()
+        doc = REPORT_BUILDERS['inventory'](data)
+    elif report_name == 'financial':
+        data = financial_report_data(session, monthly=True)
+        check_cancelled()
+        doc = REPORT_BUILDERS['financial'](data)
+    else:
+        abort(404)
+    check_cancelled()
+    filename = f"{REPORT_DOCX_NAMES[report_name]}_{datetime.now():%Y%m%d%H%M%S}.docx"
+    return report_to_bytes(doc), filename
+
+@app.route("/report/<report_name>/docx")
+@login_required
+def report_docx(report_name):
+    if report_name not in REPORT_DOCX_NAMES:
+        abort(404)
+    try:
+        output, filename = build_report_docx(report_name)
+    except ImportError:
+        flash('导出 Word 需要安装 python-docx', 'danger')
+        return redirect(request.referrer or url_for('home'))
+    return send_file(output, as_attachment=True, download_name=filename,
+                     mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+
+# 后台任务：导出、报表、文档生成等耗时操作在任务线程池中执行，不占用处理请求的线程
+class JobCancelled(Exception):
+    pass
+
+REPORT_JOB_ENDPOINTS = {
+    'sales_report': '销售报表',
+    'inventory_report': '库存报表',
+    'financial_report': '财务报表',
+}
+
+def markdown_sources():
+    # 可转换为 Word 的 Markdown 文件（仅限应用目录下）
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return sorted(name for name in os.listdir(base_dir) if name.endswith('.md'))
+
+def job_result_path(job, filename):
+    os.makedirs(app.config['JOB_RESULT_DIR'], exist_ok=True)
+    return os.path.join(app.config['JOB_RESULT_DIR'], f'{job.id}_{filename}')
+
+def run_export_job(job, params, check_cancelled):
+    ledger = EXPORT_LEDGERS[params['ledger_name']]
+    window = parse_date_range()
+    filename = f"{params['ledger_name']}_{window[0]:%Y%m%d}_{(window[1] - timedelta(days=1)):%Y%m%d}"
+    if params.get('format') == 'xlsx':
+        filename += '.xlsx'
+        path = job_result_path(job, filename)
+        with write_xlsx(ledger, window, check_cancelled) as output, open(path, 'wb') as f:
+            shutil.copyfileobj(output, f)
+        return path, filename
+    filename += '.csv'
+    path = job_result_path(job, filename)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in generate_csv(ledger, window):
+            check_cancelled()
+            f.write(chunk)
+    return path, filename
+
+def run_report_job(job, params, check_cancelled):
+    # 在任务线程中调用报表视图，保存渲染好的页面；format=docx 时直接生成 Word 文档
+    check_cancelled()
+    if params.get('format') == 'docx':
+        output, filename = build_report_docx(params['report'].replace('_report', ''), check_cancelled)
+        path = job_result_path(job, filename)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(output, f)
+        return path, filename
+    html = app.view_functions[params['report']]()
+    check_cancelled()
+    filename = f"{params['report']}_{datetime.now():%Y%m%d%H%M%S}.html"
+    path = job_result_path(job, filename)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html)
+    return path, filename
+
+def run_rebuild_job(job, params, check_cancelled):
+    # 重建在一个事务中完成，开始后不再响应取消
+    check_cancelled()
+    rebuild_sales_summary()
+    return None
+
+def run_forecast_job(job, params, check_cancelled):
+    check_cancelled()
+    refresh_replenishment_plan(params.get('method'), check_cancelled=check_cancelled)
+    return None
+
+def run_markdown_docx_job(job, params, check_cancelled):
+    from md_to_word import md_to_docx
+    
+    source = params['source']
+    filename = os.path.splitext(source)[0] + '.docx'
+    path = job_result_path(job, filename)
+    md_to_docx(os.path.join(os.path.dirname(os.path.abspath(__file__)), source), path, check_cancelled)
+    return path, filename
+
+JOB_KINDS = {
+    'export': {'label': '导出明细', 'run': run_export_job},
+    'report': {'label': '生成报表', 'run': run_report_job},
+    'rebuild_sales_summary': {'label': '重建销售日汇总', 'run': run_rebuild_job},
+    'forecast_demand': {'label': '计算补货建议', 'run': run_forecast_job},
+    'markdown_docx': {'label': 'Markdown 转 Word', 'run': run_markdown_docx_job},
+}
+
+def validate_job_params(kind, params):
+    # 返回错误信息，参数有效时返回 None
+    if kind not in JOB_KINDS:
+        return '未知的任务类型'
+    if kind == 'export':
+        if params.get('ledger_name') not in EXPORT_LEDGERS:
+            return '未知的导出类型'
+        if params.get('format', 'csv') not in ('csv', 'xlsx'):
+            return '导出格式只能是 csv 或 xlsx'
+    elif kind == 'report':
+        if params.get('report') not in REPORT_JOB_ENDPOINTS:
+            return '未知的报表'
+        if params.get('format', 'html') not in ('html', 'docx'):
+            return '报表格式只能是 html 或 docx'
+    elif kind == 'forecast_demand' and params.get('method', 'ses') not in ('ses', 'sma'):
+        return '预测方法只能是 ses 或 sma'
+    elif kind == 'markdown_docx' and params.get('source') not in markdown_sources():
+        return '找不到要转换的 Markdown 文件'
+    return None
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def worker_alive(worker):
+    host, _, pid = (worker or '').rpartition(':')
+    if host != socket.gethostname():
+        # 其他主机上的进程无法判断，视为仍在运行
+        return True
+    if int(pid) == os.getpid():
+        # 本进程刚启动，之前用同一进程号的任务必然已中断（如容器重启）
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def job_cancel_requested(job_id):
+    return db.session.query(Job.cancel_requested).filter_by(id=job_id).scalar()
+
+def run_job(job_id):
+    with app.app_context():
+        # 用条件 UPDATE 领取任务，多个进程同时提交同一任务时只有一个会执行
+        claimed = Job.query.filter_by(id=job_id, status='queued').update({
+            'status': 'running', 'started_at': datetime.utcnow(), 'worker': worker_id()
+        })
+        db.session.commit()
+        if not claimed:
+            return
+        job = db.session.get(Job, job_id)
+        params = json.loads(job.params)
+        
+        def check_cancelled():
+            if job_cancel_requested(job_id):
+                raise JobCancelled()
+        
+        result = None
+        error = None
+        try:
+            with app.test_request_context(query_string=params):
+                user = db.session.get(User, job.user_id) if job.user_id else None
+                if user is not None:
+                    login_user(user)
+                result = JOB_KINDS[job.kind]['run'](job, params, check_cancelled)
+            status = 'cancelled' if job_cancel_requested(job_id) else 'done'
+        except JobCancelled:
+            status = 'cancelled'
+        except HTTPException as e:
+            status, error = 'failed', e.description
+        except ImportError as e:
+            status, error = 'failed', f'缺少依赖：{e.name}'
+        except Exception as e:
+            app.logger.exception('后台任务 %s 执行失败', job_id)
+            db.session.rollback()
+            status, error = 'failed', str(e) or type(e).__name__
+        
+        if status != 'done' and result and os.path.exists(result[0]):
+            os.remove(result[0])
+            result = None
+        job = db.session.get(Job, job_id)
+        job.status = status
+        job.error = error
+        job.finished_at = datetime.utcnow()
+        if result:
+            job.result_path, job.result_name = result
+        db.session.commit()
+
+class JobRunner:
+    """进程内的任务线程池，JOB_WORKERS 限制同时执行的任务数"""
+    
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+    
+    def start(self):
+        with self.lock:
+            if self.executor is not None:
+                return
+            self.executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='job')
+        self.recover()
+    
+    def recover(self):
+        # 执行进程已退出的 running 任务重新排队，然后提交所有排队中的任务
+        for job in Job.query.filter_by(status='running'):
+            if not worker_alive(job.worker):
+                job.status = 'queued'
+                job.started_at = None
+        db.session.commit()
+        for (job_id,) in db.session.query(Job.id).filter_by(status='queued').order_by(Job.id):
+            self.executor.submit(run_job, job_id)
+    
+    def submit(self, job_id):
+        self.start()
+        self.executor.submit(run_job, job_id)
+
+job_runner = JobRunner()
+
+def submit_job(kind, params, user_id=None):
+    job = Job(kind=kind, params=json.dumps(params, ensure_ascii=False), user_id=user_id)
+    db.session.add(job)
+    db.session.commit()
+    job_runner.submit(job.id)
+    return job
+
+def cancel_job(job):
+    # 排队中的任务直接取消；执行中的任务在下一个检查点停止
+    if job.status == 'queued':
+        job.status = 'cancelled'
+        job.finished_at = datetime.utcnow()
+    elif job.status == 'running':
+        job.cancel_requested = True
+    else:
+        return False
+    db.session.commit()
+    return True
+
+@app.before_request
+def start_job_runner():
+    # 进程处理第一个请求时启动任务线程池，并恢复重启前未完成的任务
+    if job_runner.executor is None:
+        job_runner.start()
+
+def visible_jobs():
+    # 任务结果包含完整明细和报表，普通用户只能查看、下载和取消自己提交的任务，管理员可以查看全部
+    if current_user.is_authenticated and current_user.role == 'admin':
+        return Job.query
+    return Job.query.filter(Job.user_id == (current_user.id if current_user.is_authenticated else None))
+
+def get_job_or_404(job_id):
+    return visible_jobs().filter(Job.id == job_id).first_or_404()
+
+@app.route("/jobs", methods=['GET', 'POST'])
+@login_required
+def jobs():
+    if request.method == 'POST':
+        if request.is_json:
+            payload = request.get_json(silent=True)
+            if not isinstance(payload, dict) or not isinstance(payload.get('params') or {}, dict):
+                return jsonify({'error': '请求格式错误：应为 {"kind": ..., "params": {...}}'}), 400
+            kind, params = payload.get('kind'), payload.get('params') or {}
+        else:
+            params = {key: value for key, value in request.form.items() if key != 'kind' and value}
+            kind = request.form.get('kind')
+        error = validate_job_params(kind, params)
+        if error:
+            if request.is_json:
+                return jsonify({'error': error}), 400
+            flash(error, 'danger')
+            return redirect(url_for('jobs'))
+        job = submit_job(kind, params, current_user.id if current_user.is_authenticated else None)
+        if request.is_json:
+            return jsonify(job.to_dict()), 202
+        flash(f"已提交后台任务 #{job.id}（{JOB_KINDS[kind]['label']}）", 'success')
+        return redirect(url_for('jobs'))
+    
+    recent_jobs = visible_jobs().order_by(Job.id.desc()).limit(100).all()
+    return render_template('jobs.html', jobs=recent_jobs, job_kinds=JOB_KINDS,
+                           report_endpoints=REPORT_JOB_ENDPOINTS, export_ledgers=EXPORT_LEDGERS,
+                           markdown_sources=markdown_sources(),
+                           active=any(job.status in ('queued', 'running') for job in recent_jobs))
+
+@app.route("/jobs/<int:job_id>")
+@login_required
+def job_status(job_id):
+    return jsonify(get_job_or_404(job_id).to_dict())
+
+@app.route("/jobs/<int:job_id>/download")
+@login_required
+def download_job(job_id):
+    job = get_job_or_404(job_id)
+    if job.status != 'done' or not job.result_path or not os.path.exists(job.result_path):
+        abort(404)
+    return send_file(job.result_path, as_attachment=True, download_name=job.result_name)
+
+@app.route("/jobs/<int:job_id>/cancel", methods=['POST'])
+@login_required
+def cancel_job_route(job_id):
+    job = get_job_or_404(job_id)
+    cancelled = cancel_job(job)
+    if request.is_json:
+        return jsonify(job.to_dict()), 200 if cancelled else 409
+    if cancelled:
+        flash(f'已取消后台任务 #{job.id}', 'success')
+    else:
+        flash(f'后台任务 #{job.id} 已结束，无法取消', 'warning')
+    return redirect(url_for('jobs'))
 
 # 创建数据库
 def create_db():
     with app.app_context():
         db.create_all()
+        migrate_db()
+        product_catalog.load(db.session.get(CatalogVersion, 1).version)
         # 创建默认管理员用户
         admin_user = User.query.filter_by(email='admin@example.com').first()
         if not admin_user:
@@ -710,6 +3359,156 @@ def create_db():
             db.session.add(admin_user)
             db.session.commit()
 
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    create_db()
+    print('数据库迁移完成')
+
+@app.cli.command('rebuild-sales-summary')
+def rebuild_sales_summary_command():
+    rebuild_sales_summary()
+    print('销售日汇总已重建')
+
+@app.cli.command('snapshot-stock')
+def snapshot_stock_command():
+    # 建议每天定时执行，按时点查询库存时只需重放最近快照之后的流水
+    with db.engine.begin() as conn:
+        take_stock_snapshot(conn)
+    print('库存快照已保存')
+
+@app.cli.command('forecast-demand')
+@click.option('--method', type=click.Choice(['ses', 'sma']), default=None, help='预测方法：ses 指数平滑，sma 移动平均')
+@click.option('--history-days', type=int, default=None, help='使用最近多少天的销售历史，默认只读取对预测结果有影响的天数')
+def forecast_demand_command(method, history_days):
+    # 建议每天定时执行（在 rebuild-sales-summary 之后）
+    started = time.time()
+    count = refresh_replenishment_plan(method, history_days)
+    print(f'已计算 {count} 个商品的补货建议，耗时 {time.time() - started:.2f} 秒')
+
+@app.cli.command('close-period')
+@click.option('--month', default=None, help='要结账的月份（YYYY-MM），会重新计算已结账的月份；默认结账所有未结账的已结束月份')
+def close_period_command(month):
+    if month:
+        try:
+            months = [datetime.strptime(month, '%Y-%m').date()]
+        except ValueError:
+            raise click.BadParameter('月份格式应为 YYYY-MM', param_hint='--month')
+    else:
+        months = unclosed_months()
+    for month_start in months:
+        try:
+            close_period(month_start)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        print(f'{month_start:%Y-%m} 已结账')
+    if not months:
+        print('没有需要结账的月份')
+
+@app.cli.command('archive-ledgers')
+@click.option('--year', 'only_year', type=int, default=None, help='要归档的年份；默认归档所有已全部月结且尚未归档的往年')
+@click.option('--vacuum', is_flag=True, help='归档后执行 VACUUM，把删除明细后的空闲页归还给文件系统')
+def archive_ledgers_command(only_year, vacuum):
+    # 归档期间持有主库写锁，收银会等待，建议在营业时间之外执行
+    years = [only_year] if only_year else archivable_years()
+    for year in years:
+        try:
+            check_archivable(year)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        db.session.remove()
+        started = time.time()
+        try:
+            archive_year(DATABASE_PATH, app.config['ARCHIVE_DIR'], year,
+                         app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        print(f'{year} 年已归档到 {archive_filename(year)}，耗时 {time.time() - started:.2f} 秒')
+    if not years:
+        print('没有需要归档的年份')
+        return
+    invalidate_dashboard()
+    report_duplicate_ledger_ids()
+    if vacuum:
+        db.session.remove()
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('VACUUM')
+        print('VACUUM 完成')
+
+def report_duplicate_ledger_ids():
+    years = [row.year for row in LedgerArchive.query.order_by(LedgerArchive.year)]
+    duplicates = duplicate_ids(DATABASE_PATH, app.config['ARCHIVE_DIR'], years)
+    for table, first, second, count in duplicates:
+        print(f'{table}: {first} 与 {second} 有 {count} 个重复的 id')
+    if duplicates:
+        raise click.ClickException('明细 id 在主库和年度库之间重复，导出、合并查询和库存流水的 ref_id 会混淆')
+    print(f'主库和 {len(years)} 个年度库的明细 id 没有重复')
+
+@app.cli.command('check-ledger-ids')
+def check_ledger_ids_command():
+    db.session.remove()
+    report_duplicate_ledger_ids()
+
+@app.cli.command('compact-changes')
+@click.option('--drop-consumer', multiple=True, help='先删除不再使用的消费者，否则它的偏移量会阻止压缩')
+def compact_changes_command(drop_consumer):
+    # 建议定时执行；删除所有消费者都已确认的变更事件
+    if drop_consumer:
+        ChangeConsumer.query.filter(ChangeConsumer.name.in_(drop_consumer)).delete(synchronize_session=False)
+        db.session.commit()
+    for consumer in ChangeConsumer.query.order_by(ChangeConsumer.name):
+        print(f'{consumer.name}: 已确认到 {consumer.acked_offset}')
+    print(f'已压缩 {compact_changes()} 个变更事件')
+
+@app.cli.command('reprice-products')
+@click.option('--file', 'path', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='调价文件（CSV 或 JSONL，字段：product_id 以及 price、cost_price 中的一个或两个）')
+@click.option('--category', default=None, help='按规则调价时只调整该类别，默认全部商品')
+@click.option('--field', type=click.Choice(list(REPRICE_FIELDS)), default='price', help='按规则调整售价或成本价')
+@click.option('--percent', type=float, default=0, help='调价百分比，例如 5 表示上调5%')
+@click.option('--amount', type=float, default=0, help='调价金额（元），可与百分比同时使用')
+@click.option('--dry-run', is_flag=True, help='只计算差异，不保存')
+def reprice_products_command(path, category, field, percent, amount, dry_run):
+    started = time.time()
+    try:
+        if path:
+            file_format = 'jsonl' if path.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+            with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+                requested, rejected = parse_price_file(f, file_format)
+            summary = bulk_reprice(f'文件 {os.path.basename(path)}'[:200],
+                                   lambda batch, source: stage_file_changes(batch, source, requested, rejected),
+                                   dry_run)
+        else:
+            validate_price_rule(field, percent, amount)
+            summary = bulk_reprice(describe_price_rule(field, category, percent, amount),
+                                   lambda batch, source: stage_rule_changes(batch, source, field, category,
+                                                                            percent, amount),
+                                   dry_run)
+    except RepriceError as e:
+        raise click.ClickException(str(e))
+    for line_no, reason in summary['rejected']:
+        print(f'第{line_no}行: {reason}')
+    for item in summary['largest']:
+        print(f"{item['product_id']} {item['name']}: 售价 {item['old_price']:.2f} -> {item['new_price']:.2f}，"
+              f"成本价 {item['old_cost_price']:.2f} -> {item['new_cost_price']:.2f}")
+    print(f"匹配 {summary['matched']} 个商品，调价 {summary['changed']} 个，未变化 {summary['unchanged']} 个；"
+          f"售价合计 {summary['price_before']:.2f} -> {summary['price_after']:.2f}，"
+          f"成本价合计 {summary['cost_before']:.2f} -> {summary['cost_after']:.2f}")
+    print(f"{'试算完成，未保存' if dry_run else '已保存，批次 ' + summary['batch']}，耗时 {time.time() - started:.2f} 秒")
+
+@app.cli.command('import-sales')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='文件格式，默认按扩展名判断')
+@click.option('--chunk-size', type=int, default=None, help='每批处理的行数')
+def import_sales_command(path, file_format, chunk_size):
+    file_format = file_format or ('jsonl' if path.lower().endswith(('.jsonl', '.ndjson')) else 'csv')
+    started = time.time()
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        result = bulk_import_sales(f, file_format, chunk_size)
+    for line_no, reason in result['rejected']:
+        print(f'第{line_no}行: {reason}')
+    print(f"导入 {result['imported']} 条，拒绝 {len(result['rejected'])} 行，耗时 {time.time() - started:.2f} 秒")
+
 if __name__ == '__main__':
     create_db()
     app.run(debug=True)
\ No newline at end of file
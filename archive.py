@@ -0,0 +1,165 @@
+"""冷热分离：把已月结年度的销售、采购、费用、收入明细移到按年份划分的 SQLite 文件
+
+归档后主库只保留未归档年份的明细，收银写入、首页统计和日常索引维护只涉及较小的主库；
+报表期间跨入已归档年份时，用 ATTACH DATABASE 挂载对应的年度库，把明细表替换为
+主库与年度库的 UNION ALL 子查询（外层的日期条件会下推到每个分支，仍然使用日期索引）。
+明细表的 id 使用 AUTOINCREMENT：归档删除了最大的 id 后，新记录也不会重用这些 id，主库和各年度库中的 id 不会重复。
+本模块只依赖 sqlite3，不依赖 app.py。
+"""
+import os
+import sqlite3
+from datetime import datetime
+
+# 明细表及其日期列
+LEDGER_TABLES = {
+    'sale': 'sale_date',
+    'purchase': 'purchase_date',
+    'expense': 'expense_date',
+    'income': 'income_date',
+}
+
+
+def archive_schema(year):
+    """年度库挂载后的库名"""
+    return f'archive_{year}'
+
+
+def archive_filename(year):
+    return f'ledger_{year}.db'
+
+
+def uses_autoincrement(conn, table):
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    return row is not None and 'AUTOINCREMENT' in row[0].upper()
+
+
+def ensure_sequence(conn, table, high_water):
+    """把 AUTOINCREMENT 表的 id 序列推进到不小于 high_water，之后插入的记录 id 都大于 high_water"""
+    row = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+    if row is None:
+        conn.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, high_water))
+    elif row[0] < high_water:
+        conn.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ?', (high_water, table))
+
+
+def archived_max_ids(archive_dir, years):
+    """各年度库中每个明细表的最大 id：{表名: 最大 id}"""
+    max_ids = dict.fromkeys(LEDGER_TABLES, 0)
+    for year in years:
+        conn = sqlite3.connect(os.path.join(archive_dir, archive_filename(year)))
+        try:
+            for table in LEDGER_TABLES:
+                max_ids[table] = max(max_ids[table], conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0])
+        finally:
+            conn.close()
+    return max_ids
+
+
+def duplicate_ids(db_path, archive_dir, years):
+    """主库与各年度库、各年度库之间重复的明细 id，返回 [(表名, 库名, 库名, 重复数)]，正常情况下为空"""
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    duplicates = []
+    try:
+        for index, year in enumerate(years):
+            conn.execute(f'ATTACH DATABASE ? AS {archive_schema(year)}', (os.path.join(archive_dir, archive_filename(year)),))
+            # 每次最多同时挂载两个年度库，不受 SQLite 挂载数量的限制
+            for other in [None] + years[:index]:
+                if other is not None:
+                    conn.execute(f'ATTACH DATABASE ? AS {archive_schema(other)}',
+                                 (os.path.join(archive_dir, archive_filename(other)),))
+                other_schema = 'main' if other is None else archive_schema(other)
+                for table in LEDGER_TABLES:
+                    count = conn.execute(f'SELECT COUNT(*) FROM {archive_schema(year)}.{table} AS archived '
+                                         f'JOIN {other_schema}.{table} AS other ON other.id = archived.id').fetchone()[0]
+                    if count:
+                        duplicates.append((table, other_schema, archive_schema(year), count))
+                if other is not None:
+                    conn.execute(f'DETACH DATABASE {archive_schema(other)}')
+            conn.execute(f'DETACH DATABASE {archive_schema(year)}')
+    finally:
+        conn.close()
+    return duplicates
+
+
+def ledger_from(table, columns, years):
+    """明细表 table 合并 years 各年度库后的 FROM 子句，别名仍为表名，原语句中的列引用不用修改"""
+    column_list = ', '.join(columns)
+    parts = [f'SELECT {column_list} FROM main.{table}']
+    parts += [f'SELECT {column_list} FROM {archive_schema(year)}.{table}' for year in years]
+    return f"({' UNION ALL '.join(parts)}) AS {table}"
+
+
+def create_archive_table(conn, table, source_schema):
+    """按源表的列定义（类型、非空、主键）在 conn 的主库中建表，不复制外键；返回列名列表"""
+    columns = conn.execute(f'PRAGMA {source_schema}.table_info({table})').fetchall()
+    definitions = [f'{name} {column_type}' + (' NOT NULL' if not_null else '')
+                   for _, name, column_type, not_null, _, _ in columns]
+    primary_key = [name for _, name, _, _, _, pk in sorted(columns, key=lambda column: column[5]) if pk]
+    if primary_key:
+        definitions.append(f"PRIMARY KEY ({', '.join(primary_key)})")
+    conn.execute(f"CREATE TABLE {table} ({', '.join(definitions)})")
+    return [column[1] for column in columns]
+
+
+def archive_year(db_path, archive_dir, year, busy_timeout=5.0, log=print):
+    """把 year 年的明细移到 archive_dir 下的年度库并登记到 ledger_archive，返回 {表名: 行数}
+
+    调用方负责确认该年已经结束并全部月结。整个过程持有主库的写锁，复制和删除的是同一批数据；
+    年度库先写到临时文件，完整提交后才改名。删除明细和登记归档在主库的同一个事务中提交，
+    中途失败时主库不变，报表不会同时看到主库和年度库中的同一批记录。
+    """
+    start, end = f'{year}-01-01', f'{year + 1}-01-01'
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, archive_filename(year))
+    temp_path = path + '.tmp'
+
+    hot = sqlite3.connect(db_path, timeout=busy_timeout, isolation_level=None)
+    try:
+        hot.execute('BEGIN IMMEDIATE')
+        if hot.execute('SELECT 1 FROM ledger_archive WHERE year = ?', (year,)).fetchone():
+            raise ValueError(f'{year} 年已归档')
+        for table in LEDGER_TABLES:
+            if not uses_autoincrement(hot, table):
+                raise RuntimeError(f'{table} 表的 id 不是 AUTOINCREMENT，归档后 id 会被重用，请先执行 flask migrate-db')
+
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        cold = sqlite3.connect(temp_path, isolation_level=None)
+        try:
+            cold.execute('ATTACH DATABASE ? AS hot', (db_path,))
+            cold.execute('BEGIN')
+            counts = {}
+            max_ids = {}
+            for table, date_column in LEDGER_TABLES.items():
+                columns = ', '.join(create_archive_table(cold, table, 'hot'))
+                cold.execute(f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM hot.{table} '
+                             f'WHERE {date_column} >= ? AND {date_column} < ? ORDER BY {date_column}', (start, end))
+                cold.execute(f'CREATE INDEX main.ix_{table}_{date_column} ON {table} ({date_column})')
+                counts[table], max_ids[table] = cold.execute(
+                    f'SELECT COUNT(*), COALESCE(MAX(id), 0) FROM main.{table}').fetchone()
+                log(f'{table}: {counts[table]} 行')
+            cold.execute('COMMIT')
+            cold.execute('DETACH DATABASE hot')
+        finally:
+            cold.close()
+        os.replace(temp_path, path)
+
+        for table, date_column in LEDGER_TABLES.items():
+            deleted = hot.execute(f'DELETE FROM {table} WHERE {date_column} >= ? AND {date_column} < ?',
+                                  (start, end)).rowcount
+            if deleted != counts[table]:
+                raise RuntimeError(f'{table} 删除 {deleted} 行，与归档的 {counts[table]} 行不一致')
+            # AUTOINCREMENT 的序列不会因删除而回退，这里再确认一次，新记录的 id 一定大于已归档的 id
+            ensure_sequence(hot, table, max_ids[table])
+        hot.execute('INSERT INTO ledger_archive (year, filename, sale_rows, purchase_rows, expense_rows, '
+                    'income_rows, archived_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (year, archive_filename(year), counts['sale'], counts['purchase'], counts['expense'],
+                     counts['income'], datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')))
+        hot.execute('COMMIT')
+        return counts
+    except BaseException:
+        if hot.in_transaction:
+            hot.execute('ROLLBACK')
+        raise
+    finally:
+        hot.close()
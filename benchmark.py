@@ -0,0 +1,174 @@
+"""页面性能基准：用 Flask 测试客户端逐个请求各页面，记录 p50/p95 耗时、SQL 查询次数和峰值内存
+
+用法：python benchmark.py --db bench.db [--repeat 20] [--output benchmark.json] [--compare 上次结果.json]
+不指定 --db 时先用 seed_data.py 在临时目录生成一份小数据集。
+结果写入 JSON 文件，--compare 指定上一次的结果文件时会打印两次运行的对比。
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def benchmark_routes():
+    # (名称, URL)；名称用于在多次运行之间对比。home_uncached 每次请求前清空首页统计缓存
+    today = date.today()
+    month_ago = today - timedelta(days=30)
+    return [
+        ('home', '/home'),
+        ('home_uncached', '/home'),
+        ('product_list', '/products'),
+        ('product_search', '/products?q=食品商品0001'),
+        ('api_search_products', '/api/search/products?q=商品01'),
+        ('supplier_list', '/suppliers'),
+        ('purchase_list', '/purchases'),
+        ('sale_list', '/sales'),
+        ('sale_list_large_page', '/sales?per_page=500'),
+        ('expense_list', '/expenses'),
+        ('income_list', '/incomes'),
+        ('sales_report', '/report/sales'),
+        ('inventory_report', '/report/inventory'),
+        ('inventory_report_as_of', f'/report/inventory?as_of={month_ago:%Y-%m-%d}'),
+        ('financial_report', '/report/financial'),
+        ('financial_report_year', '/report/financial?period=year'),
+        ('financial_report_compare', '/report/financial?period=year&compare=2'),
+        ('export_sales_csv', f'/export/sales?format=csv&start={month_ago:%Y-%m-%d}&end={today:%Y-%m-%d}'),
+        ('metrics', '/metrics'),
+    ]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_benchmark(repeat, warmup=1):
+    import app as finance_app
+    app = finance_app.app
+    app.config['LOGIN_DISABLED'] = True
+    client = app.test_client()
+    # /metrics 需要令牌
+    app.config['METRICS_TOKEN'] = app.config['METRICS_TOKEN'] or 'benchmark'
+    client.environ_base['HTTP_AUTHORIZATION'] = f"Bearer {app.config['METRICS_TOKEN']}"
+    metrics = finance_app.request_metrics
+    adapter = app.url_map.bind('localhost')
+
+    results = {}
+    for name, url in benchmark_routes():
+        for _ in range(warmup):
+            client.get(url).close()
+
+        # 从 SQL 监控的按端点计数中得到每次请求的查询次数
+        endpoint = adapter.match(url.split('?')[0])[0]
+        queries_before = metrics.queries[endpoint]
+        requests_before = metrics.requests[endpoint]
+        latencies = []
+        status = None
+        for _ in range(repeat):
+            if name == 'home_uncached':
+                finance_app.invalidate_dashboard()
+            started = time.perf_counter()
+            response = client.get(url)
+            response.get_data()
+            latencies.append((time.perf_counter() - started) * 1000)
+            status = response.status_code
+            response.close()
+        queries = (metrics.queries[endpoint] - queries_before) / (metrics.requests[endpoint] - requests_before)
+
+        # 单独跑一次测量 Python 内存峰值（tracemalloc 会拖慢请求，不计入耗时）
+        tracemalloc.start()
+        client.get(url).get_data()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[name] = {
+            'url': url,
+            'status': status,
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'mean_ms': round(sum(latencies) / len(latencies), 2),
+            'queries': round(queries, 1),
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
+        print(f"{name:28} {status}  p50 {results[name]['p50_ms']:9.2f}ms  p95 {results[name]['p95_ms']:9.2f}ms  "
+              f"查询 {results[name]['queries']}  内存峰值 {results[name]['peak_memory_kb']:.0f}KB")
+    return results
+
+
+def table_counts(db_path):
+    conn = sqlite3.connect(db_path)
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('product', 'supplier', 'purchase', 'sale', 'expense', 'income')}
+    conn.close()
+    return counts
+
+
+def print_comparison(previous, current):
+    print(f"\n与 {previous['meta']['finished_at']} 的结果对比（p50 / p95，比值 < 1 表示变快）：")
+    for name, result in current['routes'].items():
+        before = previous['routes'].get(name)
+        if not before:
+            print(f'{name:28} 新增')
+            continue
+        ratios = [f"{result[key] / before[key]:.2f}" if before[key] else '-' for key in ('p50_ms', 'p95_ms')]
+        queries = f"查询 {before['queries']} → {result['queries']}"
+        print(f'{name:28} p50 x{ratios[0]}  p95 x{ratios[1]}  {queries}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='页面性能基准')
+    parser.add_argument('--db', help='使用已生成的数据库（见 seed_data.py）；不指定时生成临时的小数据集')
+    parser.add_argument('--sales', type=int, default=100000, help='未指定 --db 时临时数据集的销售记录数')
+    parser.add_argument('--repeat', type=int, default=20, help='每个页面的请求次数')
+    parser.add_argument('--output', default='benchmark.json', help='结果文件')
+    parser.add_argument('--compare', help='上一次运行的结果文件')
+    args = parser.parse_args()
+
+    workdir = None
+    if args.db:
+        db_path = os.path.abspath(args.db)
+        if not os.path.exists(db_path):
+            parser.error(f'{args.db} 不存在，请先运行 seed_data.py')
+        os.environ['FINANCE_DB_PATH'] = db_path
+    else:
+        import seed_data
+        workdir = tempfile.mkdtemp()
+        db_path = os.path.join(workdir, 'bench.db')
+        seed_data.seed(db_path, sales=args.sales, days=365)
+
+    started = datetime.now()
+    routes = run_benchmark(args.repeat)
+    report = {
+        'meta': {
+            'started_at': started.isoformat(timespec='seconds'),
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+            'repeat': args.repeat,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'rows': table_counts(db_path),
+            # Linux 上单位为 KB
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+        'routes': routes,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'结果已写入 {args.output}')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            print_comparison(json.load(f), report)
+    if workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,172 @@
+"""变更流的本地消费者：把 finance.db 中商品、供应商和四类明细的变化增量同步到一个分析用的 SQLite 副本
+
+用法：python change_consumer.py --db finance.db --target analytics.db [--name analytics] [--batch 5000] [--follow 5]
+首次运行（目标库中还没有偏移量）时，在同一个读快照中记下最新的事件偏移量并整表复制（包括已归档的年度库），
+之后每次只读取该偏移量之后的事件。每批事件和新的偏移量在目标库的同一个事务中提交，中断后重新运行不会重复或遗漏；
+目标库提交后再把偏移量确认到 finance.db 的 change_consumer 表，flask compact-changes 据此删除已确认的事件。
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from archive import LEDGER_TABLES, archive_filename, archive_schema, create_archive_table, duplicate_ids
+
+# 同步的表，与 app.py 中记录变更事件的表一致
+TABLES = ('product', 'supplier') + tuple(LEDGER_TABLES)
+
+OFFSET_TABLE = 'change_feed_offset'
+
+
+def read_offset(target, name):
+    target.execute(f'CREATE TABLE IF NOT EXISTS {OFFSET_TABLE} (name TEXT PRIMARY KEY, last_offset INTEGER NOT NULL, '
+                   'synced_at TEXT NOT NULL)')
+    row = target.execute(f'SELECT last_offset FROM {OFFSET_TABLE} WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+
+def save_offset(target, name, offset):
+    target.execute(f'INSERT INTO {OFFSET_TABLE} (name, last_offset, synced_at) VALUES (?, ?, ?) '
+                   'ON CONFLICT(name) DO UPDATE SET last_offset = excluded.last_offset, synced_at = excluded.synced_at',
+                   (name, offset, datetime.now().isoformat(timespec='seconds')))
+
+
+def bootstrap(target, db_path, name, archive_dir):
+    """整表复制，返回复制时的最新事件偏移量；同一个事务中读取的源库数据是同一个快照"""
+    # 已归档年度的明细不会再变化，也不会产生变更事件，一并复制；目标库按 id 存放明细，id 重复时拒绝复制
+    years = [year for year, in target.execute('SELECT year FROM source.ledger_archive ORDER BY year')]
+    duplicates = duplicate_ids(db_path, archive_dir, years)
+    if duplicates:
+        details = '，'.join(f'{table} 在 {first} 与 {second} 中有 {count} 个' for table, first, second, count in duplicates)
+        raise SystemExit(f'明细 id 在主库和年度库之间重复（{details}），请先执行 flask migrate-db 和 flask check-ledger-ids')
+    target.execute('BEGIN')
+    offset = target.execute('SELECT COALESCE(MAX(id), 0) FROM source.change_event').fetchone()[0]
+    for year in years:
+        target.execute(f'ATTACH DATABASE ? AS {archive_schema(year)}', (os.path.join(archive_dir, archive_filename(year)),))
+    for table in TABLES:
+        target.execute(f'DROP TABLE IF EXISTS main.{table}')
+        columns = ', '.join(create_archive_table(target, table, 'source'))
+        target.execute(f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM source.{table}')
+        if table in LEDGER_TABLES:
+            for year in years:
+                target.execute(f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM {archive_schema(year)}.{table}')
+        print(f"{table}: {target.execute(f'SELECT COUNT(*) FROM main.{table}').fetchone()[0]} 行")
+    save_offset(target, name, offset)
+    target.execute('COMMIT')
+    for year in years:
+        target.execute(f'DETACH DATABASE {archive_schema(year)}')
+    return offset
+
+
+def table_columns(target, table):
+    return {row[1] for row in target.execute(f'PRAGMA main.table_info({table})')}
+
+
+def apply_events(target, events, columns):
+    """在目标库中重放一批事件：insert 插入新行，update 按 id 更新整行，delete 按 id 删除
+
+    insert 的 id 在目标库中已存在、update 的 id 不存在，都说明副本与源库不一致，抛出 SystemExit 而不是覆盖已有的行。
+    """
+    for offset, entity, entity_id, op, data in events:
+        if entity not in TABLES:
+            continue
+        if op == 'delete':
+            target.execute(f'DELETE FROM main.{entity} WHERE id = ?', (entity_id,))
+            continue
+        row = json.loads(data)
+        known = columns.setdefault(entity, table_columns(target, entity))
+        for column in row.keys() - known:
+            # 源表新增了列
+            target.execute(f'ALTER TABLE main.{entity} ADD COLUMN {column}')
+            known.add(column)
+        if op == 'insert':
+            try:
+                target.execute(f'INSERT INTO main.{entity} ({", ".join(row)}) VALUES ({", ".join("?" * len(row))})',
+                               tuple(row.values()))
+            except sqlite3.IntegrityError:
+                raise SystemExit(f'事件 {offset}：{entity} 的 id {entity_id} 在副本中已存在，请检查后使用 --resync 重新整表复制')
+            continue
+        updates = ', '.join(f'{column} = ?' for column in row if column != 'id')
+        values = [value for column, value in row.items() if column != 'id']
+        if target.execute(f'UPDATE main.{entity} SET {updates} WHERE id = ?', (*values, entity_id)).rowcount != 1:
+            raise SystemExit(f'事件 {offset}：{entity} 的 id {entity_id} 在副本中不存在，请检查后使用 --resync 重新整表复制')
+
+
+def ack(db_path, name, offset, busy_timeout):
+    """把已同步的偏移量确认到源库（只前进不后退）"""
+    conn = sqlite3.connect(db_path, timeout=busy_timeout)
+    try:
+        with conn:
+            conn.execute('INSERT INTO change_consumer (name, acked_offset, updated_at) VALUES (?, ?, ?) '
+                         'ON CONFLICT(name) DO UPDATE SET acked_offset = MAX(acked_offset, excluded.acked_offset), '
+                         'updated_at = excluded.updated_at',
+                         (name, offset, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')))
+    finally:
+        conn.close()
+
+
+def sync(db_path, target_path, name, batch, archive_dir, resync=False, busy_timeout=5.0):
+    """同步到最新，返回 (重放的事件数, 最新偏移量)"""
+    target = sqlite3.connect(target_path, isolation_level=None)
+    try:
+        target.execute('ATTACH DATABASE ? AS source', (db_path,))
+        offset = None if resync else read_offset(target, name)
+        if offset is None:
+            offset = bootstrap(target, db_path, name, archive_dir)
+            print(f'已整表复制，偏移量 {offset}')
+        oldest = target.execute('SELECT MIN(id) FROM source.change_event').fetchone()[0]
+        if oldest is not None and oldest > offset + 1:
+            raise SystemExit(f'偏移量 {offset} 之后的事件已被压缩（最早为 {oldest}），请使用 --resync 重新整表复制')
+
+        applied = 0
+        columns = {}
+        while True:
+            target.execute('BEGIN')
+            events = target.execute('SELECT id, entity, entity_id, op, data FROM source.change_event '
+                                    'WHERE id > ? ORDER BY id LIMIT ?', (offset, batch)).fetchall()
+            if not events:
+                target.execute('ROLLBACK')
+                break
+            apply_events(target, events, columns)
+            offset = events[-1][0]
+            save_offset(target, name, offset)
+            target.execute('COMMIT')
+            applied += len(events)
+            if len(events) < batch:
+                break
+    finally:
+        target.close()
+    ack(db_path, name, offset, busy_timeout)
+    return applied, offset
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把 finance.db 的变更流增量同步到分析用的 SQLite 副本')
+    parser.add_argument('--db', default=os.environ.get('FINANCE_DB_PATH', 'finance.db'), help='源数据库')
+    parser.add_argument('--target', default='analytics.db', help='目标数据库')
+    parser.add_argument('--name', default='analytics', help='消费者名称，用于在源库中确认偏移量')
+    parser.add_argument('--batch', type=int, default=5000, help='每个事务重放的事件数')
+    parser.add_argument('--archive-dir', default=None, help='已归档年度库所在目录，默认为源库所在目录下的 archive/')
+    parser.add_argument('--resync', action='store_true', help='忽略已保存的偏移量，重新整表复制')
+    parser.add_argument('--follow', type=float, default=0, help='每隔多少秒同步一次，0 表示同步一次后退出')
+    args = parser.parse_args()
+
+    archive_dir = args.archive_dir or os.path.join(os.path.dirname(os.path.abspath(args.db)), 'archive')
+    resync = args.resync
+    while True:
+        started = time.time()
+        applied, offset = sync(args.db, args.target, args.name, args.batch, archive_dir, resync)
+        resync = False
+        print(f'重放 {applied} 个事件，偏移量 {offset}，耗时 {time.time() - started:.2f} 秒')
+        if not args.follow:
+            break
+        time.sleep(args.follow)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""并发销售一致性检查：多个线程同时对同一商品下单，检查最终库存是否准确且没有超卖
+
+用法：python concurrency_check.py [--threads 8] [--sales 50] [--stock 300]
+检查在临时目录中的独立数据库上进行，不会影响 finance.db。
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+
+def run_check(threads, sales_per_thread, initial_stock):
+    workdir = tempfile.mkdtemp()
+    # 数据库路径在导入 app 时读取，因此先设置环境变量再导入
+    os.environ['FINANCE_DB_PATH'] = os.path.join(workdir, 'finance.db')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as finance_app
+
+    app, db = finance_app.app, finance_app.db
+    app.config['LOGIN_DISABLED'] = True
+    finance_app.create_db()
+    with app.app_context():
+        product = finance_app.Product(name='并发测试商品', category='测试', price=10.0, cost_price=6.0)
+        db.session.add(product)
+        db.session.commit()
+        db.session.add(finance_app.Inventory(product_id=product.id, quantity=initial_stock))
+        db.session.commit()
+        product_id = product.id
+
+    errors = []
+    barrier = threading.Barrier(threads)
+
+    def till():
+        client = app.test_client()
+        barrier.wait()
+        for _ in range(sales_per_thread):
+            response = client.post('/sale/add', data={'product_id': product_id, 'quantity': 1})
+            if response.status_code != 302:
+                errors.append(response.status_code)
+
+    workers = [threading.Thread(target=till) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    with app.app_context():
+        final_stock = db.session.query(finance_app.Inventory.quantity).filter_by(product_id=product_id).scalar()
+        sold = db.session.query(db.func.coalesce(db.func.sum(finance_app.Sale.quantity), 0)).scalar()
+        summary_sold = db.session.query(
+            db.func.coalesce(db.func.sum(finance_app.SalesDailySummary.quantity), 0)
+        ).scalar()
+        db.engine.dispose()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    attempted = threads * sales_per_thread
+    print(f'尝试销售 {attempted} 次，成功 {sold} 件，剩余库存 {final_stock}，请求错误 {len(errors)} 次')
+    checks = [
+        (not errors, '存在失败的请求'),
+        (final_stock >= 0, '库存为负数（超卖）'),
+        (final_stock + sold == initial_stock, '库存与销售数量不一致'),
+        (sold == min(attempted, initial_stock), '成功销售数量不正确'),
+        (summary_sold == sold, '销售日汇总与销售明细不一致'),
+    ]
+    failed = [message for ok, message in checks if not ok]
+    for message in failed:
+        print(f'失败: {message}')
+    if not failed:
+        print('检查通过')
+    return not failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='并发销售一致性检查')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--sales', type=int, default=50, help='每个线程的销售次数')
+    parser.add_argument('--stock', type=int, default=300, help='初始库存（小于总销售次数时可检查超卖）')
+    args = parser.parse_args()
+    sys.exit(0 if run_check(args.threads, args.sales, args.stock) else 1)
@@ -0,0 +1,185 @@
+"""把销售、库存、财务报表数据直接写成 Word 文档
+
+数据来自 app.py 中的 sales_report_data / inventory_report_data / financial_report_data，
+不经过 HTML 或 Markdown；表格用 md_to_word.add_rows_table 一次性创建，几千行也能很快生成。
+"""
+from datetime import datetime
+from io import BytesIO
+
+from docx import Document
+
+from md_to_word import add_rows_table, set_font_color
+
+
+def money(value):
+    return f'{value or 0:.2f}'
+
+
+def add_heading(doc, text, level):
+    """添加黑色标题"""
+    heading = doc.add_heading(level=level)
+    set_font_color(heading.add_run(text))
+    return heading
+
+
+def add_paragraph(doc, text):
+    para = doc.add_paragraph()
+    set_font_color(para.add_run(text))
+    return para
+
+
+def add_table(doc, header, rows, empty_text=None):
+    """添加带表头的表格；没有数据且指定了 empty_text 时改为一段说明文字"""
+    if not rows and empty_text:
+        return add_paragraph(doc, empty_text)
+    return add_rows_table(doc, [header] + rows)
+
+
+def new_document(title):
+    doc = Document()
+    add_heading(doc, title, 0)
+    add_paragraph(doc, f'生成时间：{datetime.now():%Y-%m-%d %H:%M:%S}')
+    return doc
+
+
+def build_sales_report(data, days=30):
+    """销售报表：每日、月度和商品销售统计"""
+    doc = new_document('销售报表')
+
+    add_heading(doc, f'最近{days}天每日销售统计', 1)
+    add_table(doc, ['日期', '销售额 (¥)'],
+              [[str(sale.sale_date), money(sale.total_amount)] for sale in data['daily_sales']],
+              '期间没有销售记录')
+
+    add_heading(doc, '月度销售统计', 1)
+    add_table(doc, ['月份', '销售额 (¥)'],
+              [[sale.month, money(sale.total_amount)] for sale in data['monthly_sales']],
+              '没有销售记录')
+
+    add_heading(doc, '商品销售统计', 1)
+    add_table(doc, ['商品名称', '销售数量', '销售额 (¥)'],
+              [[sale.name, str(sale.total_quantity), money(sale.total_amount)] for sale in data['product_sales']],
+              '没有销售记录')
+    return doc
+
+
+def build_inventory_report(data):
+    """库存报表：概览、按类别统计、低库存和全部商品库存"""
+    title = '库存报表'
+    if data.get('as_of'):
+        title += f"（截至 {data['as_of']} 日终）"
+    doc = new_document(title)
+
+    add_heading(doc, '库存概览', 1)
+    add_table(doc, ['项目', '数值'], [
+        ['总库存价值 (¥)', money(data['total_inventory_value'])],
+        ['低库存商品数量', str(len(data['low_stock_items']))],
+    ])
+
+    add_heading(doc, '按类别统计库存', 1)
+    add_table(doc, ['类别', '库存数量', '库存价值 (¥)'],
+              [[item.category or '', str(item.total_quantity), money(item.total_value)]
+               for item in data['category_inventory']],
+              '没有库存记录')
+
+    if data.get('as_of'):
+        add_heading(doc, '低库存商品（库存<10）', 1)
+        add_table(doc, ['商品名称', '类别', '库存数量'],
+                  [[item.name, item.category or '', str(item.quantity)] for item in data['low_stock_items']],
+                  '没有低库存商品')
+    else:
+        add_heading(doc, '需补货商品（库存不高于补货点）', 1)
+        add_table(doc, ['商品名称', '类别', '库存数量', '日均销量', '补货点', '可售天数'],
+                  [[item.name, item.category or '', str(item.quantity),
+                    f'{item.daily_demand:.1f}' if item.daily_demand is not None else '-',
+                    f'{item.reorder_point:.0f}' if item.reorder_point is not None else '10',
+                    f'{item.days_of_cover:.1f}' if item.days_of_cover is not None else '-']
+                   for item in data['low_stock_items']],
+                  '没有需补货商品')
+
+    add_heading(doc, '所有商品库存', 1)
+    add_table(doc, ['商品名称', '类别', '库存数量', '单价 (¥)', '库存价值 (¥)'],
+              [[item.name, item.category or '', str(item.quantity), money(item.price),
+                money(item.price * item.quantity)] for item in data['inventory_items']],
+              '没有库存记录')
+    return doc
+
+
+def category_rows(categories, total):
+    return [[item.category or '', money(item.total_amount),
+             f'{item.total_amount / total * 100 if total > 0 else 0:.1f}%'] for item in categories]
+
+
+def build_financial_report(data):
+    """财务报表：利润表、费用和收入明细、现金流量表、资产负债表，以及逐月明细和往年同期对比"""
+    period_label = data['period_label']
+    doc = new_document(f'财务报表（{period_label}）')
+    if data['closed_months']:
+        add_paragraph(doc, f"其中 {data['closed_months']} 个月已月结，数据取自结账记录")
+
+    add_heading(doc, f'利润表（{period_label}）', 1)
+    add_table(doc, ['项目', '金额 (¥)'], [
+        ['营业收入', money(data['month_sales'])],
+        ['其他收入', money(data['month_other_income'])],
+        ['营业成本', money(data['month_purchase_cost'])],
+        ['运营费用', money(data['month_expenses'])],
+        ['净利润', money(data['month_profit'])],
+    ])
+
+    add_heading(doc, '费用分类明细', 2)
+    add_table(doc, ['费用类别', '金额 (¥)', '占比'],
+              category_rows(data['expense_categories'], data['month_expenses']), '本期没有费用记录')
+
+    add_heading(doc, '其他收入明细', 2)
+    add_table(doc, ['收入类别', '金额 (¥)', '占比'],
+              category_rows(data['income_categories'], data['month_other_income']), '本期没有其他收入记录')
+
+    add_heading(doc, f'现金流量表（{period_label}）', 1)
+    add_table(doc, ['项目', '金额 (¥)', '类型'], [
+        ['销售商品、提供劳务收到的现金', f"+{money(data['month_sales'])}", '经营活动流入'],
+        ['收到的其他与经营活动有关的现金', f"+{money(data['month_other_income'])}", '经营活动流入'],
+        ['购买商品、接受劳务支付的现金', f"-{money(data['month_purchase_cost'])}", '经营活动流出'],
+        ['支付的其他与经营活动有关的现金', f"-{money(data['month_expenses'])}", '经营活动流出'],
+        ['经营活动产生的现金流量净额', money(data['net_cash_flow']), '净流量'],
+    ])
+
+    add_heading(doc, '资产负债表', 1)
+    add_table(doc, ['项目', '金额 (¥)'], [
+        ['库存商品', money(data['total_inventory_value'])],
+        ['未分配利润', money(data['month_profit'])],
+        ['总资产', money(data['total_assets'])],
+        ['流动负债', money(data['total_liabilities'])],
+        ['所有者权益', money(data['total_equity'])],
+        ['负债和所有者权益总计', money(data['total_liabilities'] + data['total_equity'])],
+    ])
+
+    flow_header = ['销售收入 (¥)', '采购成本 (¥)', '费用 (¥)', '其他收入 (¥)', '利润 (¥)']
+    flow_keys = ['sales', 'purchase_cost', 'expenses', 'other_income', 'profit']
+    if len(data.get('monthly_breakdown') or []) > 1:
+        add_heading(doc, '逐月明细', 1)
+        add_table(doc, ['月份'] + flow_header,
+                  [[item['label']] + [money(item[key]) for key in flow_keys] for item in data['monthly_breakdown']])
+
+    if data.get('comparison'):
+        add_heading(doc, '往年同期对比', 1)
+        current = {'label': period_label, 'sales': data['month_sales'], 'other_income': data['month_other_income'],
+                   'purchase_cost': data['month_purchase_cost'], 'expenses': data['month_expenses'],
+                   'profit': data['month_profit'], 'inventory_value': data['total_inventory_value']}
+        add_table(doc, ['期间'] + flow_header + ['期末库存价值 (¥)'],
+                  [[item['label']] + [money(item[key]) for key in flow_keys + ['inventory_value']]
+                   for item in [current] + data['comparison']])
+    return doc
+
+
+REPORT_BUILDERS = {
+    'sales': build_sales_report,
+    'inventory': build_inventory_report,
+    'financial': build_financial_report,
+}
+
+
+def report_to_bytes(doc):
+    output = BytesIO()
+    doc.save(output)
+    output.seek(0)
+    return output
@@ -0,0 +1,296 @@
+"""收银并发压测：在本机启动应用，多个模拟收银台按比例混合发起销售、采购和报表请求
+
+用法：python load_test.py [--tills 16] [--servers 2] [--duration 20] [--sale-ratio 0.7 --purchase-ratio 0.2 --report-ratio 0.1]
+--servers 为应用进程数（每个进程一个多线程 HTTP 服务，共用同一个数据库文件），收银台按轮询分配到各进程。
+压测在临时目录中的独立数据库上进行（--db 可指定一份已有数据库，会先复制），不会影响 finance.db。
+输出吞吐量、各类请求的延迟分位数、数据库锁冲突/重试次数，以及压测结束后的库存一致性检查。
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import secrets
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlencode
+
+REPORT_URLS = ['/home', '/report/inventory', '/report/financial', '/report/sales', '/sales']
+METRIC_PATTERN = re.compile(r'^(finance_(?:lock_errors|write_retries|lock_wait_seconds)_total)\{endpoint="([^"]+)"\} (\S+)$')
+
+
+def serve(db_path, port, busy_timeout_ms, ready):
+    # 在子进程中运行：数据库路径和连接参数在导入 app 时读取
+    os.environ['FINANCE_DB_PATH'] = db_path
+    if busy_timeout_ms is not None:
+        os.environ['SQLITE_BUSY_TIMEOUT_MS'] = str(busy_timeout_ms)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    from werkzeug.serving import make_server
+    import app as finance_app
+    finance_app.app.config['LOGIN_DISABLED'] = True
+    # 慢查询和锁冲突导致的 500 错误会大量出现，只在汇总结果中统计
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    logging.getLogger('finance.sql').setLevel(logging.ERROR)
+    finance_app.app.logger.setLevel(logging.CRITICAL)
+    server = make_server('127.0.0.1', port, finance_app.app, threaded=True)
+    ready.set()
+    server.serve_forever()
+
+
+def prepare_database(db_path, source, products, initial_stock):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if source:
+        shutil.copyfile(source, db_path)
+    os.environ['FINANCE_DB_PATH'] = db_path
+    import app as finance_app
+    finance_app.create_db()
+    with finance_app.app.app_context():
+        db = finance_app.db
+        if not source:
+            if not finance_app.Supplier.query.first():
+                db.session.add(finance_app.Supplier(name='压测供应商', contact='压测', phone='1', address='本地'))
+            for i in range(products):
+                product = finance_app.Product(name=f'压测商品{i + 1}', category='压测', price=10.0, cost_price=6.0)
+                db.session.add(product)
+                db.session.flush()
+                db.session.add(finance_app.Inventory(product_id=product.id, quantity=initial_stock))
+            db.session.commit()
+        product_ids = [row[0] for row in db.session.query(finance_app.Product.id)]
+        supplier_ids = [row[0] for row in db.session.query(finance_app.Supplier.id)]
+        db.engine.dispose()
+    return product_ids, supplier_ids
+
+
+def stock_totals(db_path):
+    conn = sqlite3.connect(db_path)
+    totals = {
+        'inventory': dict(conn.execute('SELECT product_id, SUM(quantity) FROM inventory GROUP BY product_id')),
+        'sold': dict(conn.execute('SELECT product_id, SUM(quantity) FROM sale GROUP BY product_id')),
+        'purchased': dict(conn.execute('SELECT product_id, SUM(quantity) FROM purchase GROUP BY product_id')),
+        'moved': dict(conn.execute('SELECT product_id, SUM(change) FROM stock_movement GROUP BY product_id')),
+        'summary_sold': conn.execute('SELECT COALESCE(SUM(quantity), 0) FROM sales_daily_summary').fetchone()[0],
+    }
+    conn.close()
+    return totals
+
+
+def scrape_lock_metrics(ports):
+    totals = defaultdict(float)
+    for port in ports:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        token = os.environ.get('METRICS_TOKEN')
+        conn.request('GET', '/metrics', headers={'Authorization': f'Bearer {token}'} if token else {})
+        for line in conn.getresponse().read().decode('utf-8').splitlines():
+            match = METRIC_PATTERN.match(line)
+            if match:
+                totals[match.group(1)] += float(match.group(3))
+        conn.close()
+    return totals
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))]
+
+
+class Till(threading.Thread):
+    """模拟一个收银台：在截止时间前连续发送请求，记录每个请求的类型、结果和耗时"""
+
+    def __init__(self, port, deadline, ratios, product_ids, supplier_ids, seed):
+        super().__init__(daemon=True)
+        self.port = port
+        self.deadline = deadline
+        self.ratios = ratios
+        self.product_ids = product_ids
+        self.supplier_ids = supplier_ids
+        self.rng = random.Random(seed)
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(int)
+        self.sold = defaultdict(int)
+        self.purchased = defaultdict(int)
+
+    def request(self, method, path, form=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        body = urlencode(form) if form else None
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if form else {}
+        started = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status, response.getheader('Location', ''), time.perf_counter() - started
+        finally:
+            conn.close()
+
+    def run(self):
+        kinds, weights = zip(*self.ratios.items())
+        while time.time() < self.deadline:
+            kind = self.rng.choices(kinds, weights)[0]
+            product_id = self.rng.choice(self.product_ids)
+            quantity = self.rng.randint(1, 3)
+            try:
+                if kind == 'sale':
+                    status, location, elapsed = self.request('POST', '/sale/add', {
+                        'product_id': product_id, 'quantity': quantity})
+                    # 成功跳转到销售列表，库存不足时回到录入页面
+                    if status == 302 and location.endswith('/sales'):
+                        outcome = 'ok'
+                        self.sold[product_id] += quantity
+                    elif status == 302:
+                        outcome = 'out_of_stock'
+                    else:
+                        outcome = f'http_{status}'
+                elif kind == 'purchase':
+                    status, location, elapsed = self.request('POST', '/purchase/add', {
+                        'product_id': product_id, 'supplier_id': self.rng.choice(self.supplier_ids),
+                        'quantity': quantity * 5})
+                    outcome = 'ok' if status == 302 else f'http_{status}'
+                    if outcome == 'ok':
+                        self.purchased[product_id] += quantity * 5
+                else:
+                    status, location, elapsed = self.request('GET', self.rng.choice(REPORT_URLS))
+                    outcome = 'ok' if status == 200 else f'http_{status}'
+            except (OSError, http.client.HTTPException) as e:
+                outcome, elapsed = f'error_{type(e).__name__}', 0
+            self.outcomes[(kind, outcome)] += 1
+            if elapsed:
+                self.latencies[kind].append(elapsed * 1000)
+
+
+def run_load_test(args):
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'load_test.db')
+    product_ids, supplier_ids = prepare_database(db_path, args.db, args.products, args.stock)
+    before = stock_totals(db_path)
+
+    # 应用进程继承环境变量，抓取 /metrics 时使用同一个令牌
+    os.environ.setdefault('METRICS_TOKEN', secrets.token_hex(16))
+    ctx = multiprocessing.get_context('spawn')
+    ports = [args.port + i for i in range(args.servers)]
+    servers = []
+    for port in ports:
+        ready = ctx.Event()
+        process = ctx.Process(target=serve, args=(db_path, port, args.busy_timeout, ready), daemon=True)
+        process.start()
+        if not ready.wait(60):
+            raise SystemExit(f'端口 {port} 的应用进程启动失败')
+        servers.append(process)
+
+    ratios = {'sale': args.sale_ratio, 'purchase': args.purchase_ratio, 'report': args.report_ratio}
+    ratios = {kind: ratio for kind, ratio in ratios.items() if ratio > 0}
+    lock_before = scrape_lock_metrics(ports)
+    started = time.time()
+    tills = [Till(ports[i % len(ports)], started + args.duration, ratios, product_ids, supplier_ids, args.seed + i)
+             for i in range(args.tills)]
+    for till in tills:
+        till.start()
+    for till in tills:
+        till.join()
+    elapsed = time.time() - started
+    lock_after = scrape_lock_metrics(ports)
+
+    for process in servers:
+        process.terminate()
+        process.join()
+    after = stock_totals(db_path)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    # 汇总
+    latencies = defaultdict(list)
+    outcomes = defaultdict(int)
+    sold = defaultdict(int)
+    purchased = defaultdict(int)
+    for till in tills:
+        for kind, values in till.latencies.items():
+            latencies[kind].extend(values)
+        for key, count in till.outcomes.items():
+            outcomes[key] += count
+        for product_id, quantity in till.sold.items():
+            sold[product_id] += quantity
+        for product_id, quantity in till.purchased.items():
+            purchased[product_id] += quantity
+
+    total_requests = sum(outcomes.values())
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output',)},
+        'elapsed_seconds': round(elapsed, 2),
+        'requests': total_requests,
+        'throughput_rps': round(total_requests / elapsed, 1),
+        'latency_ms': {kind: {
+            'count': len(values),
+            'p50': round(percentile(values, 0.5), 2),
+            'p95': round(percentile(values, 0.95), 2),
+            'p99': round(percentile(values, 0.99), 2),
+            'max': round(max(values), 2) if values else 0,
+        } for kind, values in sorted(latencies.items())},
+        'outcomes': {f'{kind}:{outcome}': count for (kind, outcome), count in sorted(outcomes.items())},
+        'lock_errors': int(lock_after['finance_lock_errors_total'] - lock_before['finance_lock_errors_total']),
+        'write_retries': int(lock_after['finance_write_retries_total'] - lock_before['finance_write_retries_total']),
+        'lock_wait_seconds': round(lock_after['finance_lock_wait_seconds_total']
+                                   - lock_before['finance_lock_wait_seconds_total'], 3),
+    }
+
+    # 一致性检查：数据库中的变化与客户端确认成功的请求一致，且库存、流水、日汇总互相吻合
+    checks = []
+    for product_id in product_ids:
+        start_stock = before['inventory'].get(product_id, 0)
+        end_stock = after['inventory'].get(product_id, 0)
+        db_sold = after['sold'].get(product_id, 0) - before['sold'].get(product_id, 0)
+        db_purchased = after['purchased'].get(product_id, 0) - before['purchased'].get(product_id, 0)
+        moved = after['moved'].get(product_id, 0) - before['moved'].get(product_id, 0)
+        checks.extend([
+            (end_stock >= 0, f'商品 {product_id} 库存为负数（超卖）'),
+            (db_sold == sold[product_id], f'商品 {product_id} 销售数量与成功请求不一致'),
+            (db_purchased == purchased[product_id], f'商品 {product_id} 采购数量与成功请求不一致'),
+            (end_stock - start_stock == db_purchased - db_sold, f'商品 {product_id} 库存变化与采购/销售不一致'),
+            (moved == end_stock - start_stock, f'商品 {product_id} 库存流水与库存变化不一致'),
+        ])
+    checks.append((after['summary_sold'] - before['summary_sold'] == sum(sold.values()), '销售日汇总与销售明细不一致'))
+    report['consistency_failures'] = [message for ok, message in checks if not ok]
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='收银并发压测')
+    parser.add_argument('--tills', type=int, default=16, help='并发收银台数量')
+    parser.add_argument('--servers', type=int, default=2, help='应用进程数')
+    parser.add_argument('--duration', type=float, default=20, help='压测时长（秒）')
+    parser.add_argument('--sale-ratio', type=float, default=0.7)
+    parser.add_argument('--purchase-ratio', type=float, default=0.2)
+    parser.add_argument('--report-ratio', type=float, default=0.1)
+    parser.add_argument('--products', type=int, default=20, help='未指定 --db 时创建的商品数')
+    parser.add_argument('--stock', type=int, default=200, help='未指定 --db 时每个商品的初始库存')
+    parser.add_argument('--db', help='在这份数据库的副本上压测（如 seed_data.py 生成的 bench.db）')
+    parser.add_argument('--busy-timeout', type=int, default=None, help='覆盖 SQLITE_BUSY_TIMEOUT_MS，调小可更快暴露锁冲突')
+    parser.add_argument('--port', type=int, default=5600, help='第一个应用进程的端口')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='结果另存为 JSON 文件')
+    args = parser.parse_args()
+
+    report = run_load_test(args)
+    print(f"{args.tills} 个收银台 / {args.servers} 个进程，{report['elapsed_seconds']} 秒内 {report['requests']} 个请求，"
+          f"吞吐量 {report['throughput_rps']} 请求/秒")
+    for kind, stats in report['latency_ms'].items():
+        print(f"  {kind:9} {stats['count']:6} 次  p50 {stats['p50']:8.2f}ms  p95 {stats['p95']:8.2f}ms  "
+              f"p99 {stats['p99']:8.2f}ms  最大 {stats['max']:8.2f}ms")
+    print('  结果: ' + '，'.join(f'{key} {count}' for key, count in report['outcomes'].items()))
+    print(f"  数据库锁冲突 {report['lock_errors']} 次，重试 {report['write_retries']} 次，"
+          f"锁等待 {report['lock_wait_seconds']} 秒")
+    for message in report['consistency_failures']:
+        print(f'失败: {message}')
+    if not report['consistency_failures']:
+        print('一致性检查通过')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if report['consistency_failures'] else 0)
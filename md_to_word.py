@@ -1,8 +1,20 @@
-import markdown
+import argparse
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import deepcopy
+
 from docx import Document
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
 from docx.shared import Inches, Pt, RGBColor
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-from bs4 import BeautifulSoup
+
+# 转换逻辑变化时修改此版本号，批量转换会重新生成所有文件
+CONVERTER_VERSION = 2
+MANIFEST_NAME = '.md_to_word_manifest.json'
 
 
 def set_font_color(run, color=RGBColor(0, 0, 0)):
@@ -10,96 +22,171 @@ def set_font_color(run, color=RGBColor(0, 0, 0)):
     run.font.color.rgb = color
 
 
-def add_html_to_docx(doc, html_content):
-    """将HTML内容添加到Word文档中"""
+HEADING_LEVELS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+
+
+def walk_html(root):
+    """按文档顺序遍历一次 root 的子孙节点，产生 (事件, 节点, 深度)；事件为 'start'/'end'/'text'"""
+    from bs4 import CData, NavigableString
+
+    stack = [(root, iter(root.contents))]
+    while stack:
+        node = next(stack[-1][1], None)
+        if node is None:
+            tag, _ = stack.pop()
+            if stack:
+                yield 'end', tag, len(stack)
+        elif node.name is not None:
+            yield 'start', node, len(stack)
+            stack.append((node, iter(node.contents)))
+        elif type(node) in (NavigableString, CData):
+            # 与 Tag.text 一致，忽略注释等其他字符串类型
+            yield 'text', node, len(stack)
+
+
+def black_run_template():
+    """黑色文字的 w:r 模板，填充表格时复制使用，避免为每个单元格创建 Run/Font 对象"""
+    run = OxmlElement('w:r')
+    rpr = OxmlElement('w:rPr')
+    color = OxmlElement('w:color')
+    color.set(qn('w:val'), '000000')
+    rpr.append(color)
+    run.append(rpr)
+    text = OxmlElement('w:t')
+    text.set(qn('xml:space'), 'preserve')
+    run.append(text)
+    return run
+
+
+def add_rows_table(doc, rows):
+    """添加一个表格，rows 为每行单元格文本的列表，列数由第一行确定"""
+    if not rows:
+        return None
+    cols = len(rows[0])
+
+    # 一次创建所有行，直接写入单元格的 XML
+    table = doc.add_table(rows=len(rows), cols=cols)
+    table.style = 'Table Grid'
+    template = black_run_template()
+    for tr, cells in zip(table._tbl.tr_lst, rows):
+        for tc, text in zip(tr.tc_lst, cells):
+            run = deepcopy(template)
+            run[-1].text = text
+            tc.p_lst[0].append(run)
+    return table
+
+
+def table_rows(rows):
+    """将遍历时收集的 (tr, 表头单元格, 数据单元格) 转为单元格文本列表，第一行补齐到列数"""
+    texts = []
+    cols = 0
+    for _, th_cells, td_cells in rows:
+        if not texts:
+            # 列数由第一行确定
+            cols = max(len(th_cells), len(td_cells))
+        # 优先使用表头单元格
+        texts.append([''.join(cell) for cell in (th_cells if th_cells else td_cells)])
+    if texts:
+        texts[0] = texts[0] + [''] * (cols - len(texts[0]))
+    return texts
+
+
+def add_html_to_docx(doc, html_content, check_cancelled=None):
+    """将HTML内容添加到Word文档中；check_cancelled 在处理每个顶层元素之前调用，可抛出异常中止转换
+
+    整个文档只遍历一次：列表项和表格单元格的文字在遍历过程中收集，不再对每个列表或表格单独查找
+    """
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # 遍历HTML中的所有元素
-    for element in soup.children:
-        if element.name == 'h1':
-            heading = doc.add_heading(level=1)
-            run = heading.add_run(element.text)
-            set_font_color(run)
-        elif element.name == 'h2':
-            heading = doc.add_heading(level=2)
-            run = heading.add_run(element.text)
-            set_font_color(run)
-        elif element.name == 'h3':
-            heading = doc.add_heading(level=3)
-            run = heading.add_run(element.text)
-            set_font_color(run)
-        elif element.name == 'h4':
-            heading = doc.add_heading(level=4)
-            run = heading.add_run(element.text)
-            set_font_color(run)
-        elif element.name == 'h5':
-            heading = doc.add_heading(level=5)
-            run = heading.add_run(element.text)
-            set_font_color(run)
-        elif element.name == 'h6':
-            heading = doc.add_heading(level=6)
-            run = heading.add_run(element.text)
-            set_font_color(run)
-        elif element.name == 'p':
-            para = doc.add_paragraph()
-            run = para.add_run(element.text)
-            set_font_color(run)
-        elif element.name == 'ul':
-            # 处理无序列表
-            for li in element.find_all('li'):
-                para = doc.add_paragraph(style='List Bullet')
-                run = para.add_run(li.text)
-                set_font_color(run)
-        elif element.name == 'ol':
-            # 处理有序列表
-            for li in element.find_all('li'):
-                para = doc.add_paragraph(style='List Number')
-                run = para.add_run(li.text)
+
+    name = None
+    texts = []        # 标题、段落、代码块的文字
+    style = None      # 当前列表的样式
+    open_items = []   # 尚未结束的列表项：(段落, 文字)，嵌套项的文字也计入外层项
+    rows = []         # 当前表格的行：(tr, 表头单元格, 数据单元格)
+    open_rows = []
+    open_cells = []   # 尚未结束的单元格文字，嵌套表格的文字也计入外层单元格
+
+    for event, node, depth in walk_html(soup):
+        if depth == 1:
+            # 顶层元素
+            if event == 'start':
+                if check_cancelled:
+                    check_cancelled()
+                name = node.name
+                texts = []
+                if name in ('ul', 'ol'):
+                    style = 'List Bullet' if name == 'ul' else 'List Number'
+                elif name == 'table':
+                    rows = []
+                elif name == 'br':
+                    # 处理换行
+                    doc.add_paragraph()
+            elif event == 'end':
+                text = ''.join(texts)
+                if name in HEADING_LEVELS:
+                    heading = doc.add_heading(level=HEADING_LEVELS[name])
+                    run = heading.add_run(text)
+                    set_font_color(run)
+                elif name == 'p':
+                    para = doc.add_paragraph()
+                    run = para.add_run(text)
+                    set_font_color(run)
+                elif name == 'table':
+                    # 处理表格
+                    add_rows_table(doc, table_rows(rows))
+                elif name in ('pre', 'code'):
+                    # 处理代码块和行内代码
+                    para = doc.add_paragraph()
+                    run = para.add_run(text)
+                    run.font.name = 'Courier New'
+                    if name == 'pre':
+                        run.font.size = Pt(10)
+                    set_font_color(run)
+                name = None
+            continue
+
+        if event == 'text':
+            if name in ('ul', 'ol'):
+                for _, item_texts in open_items:
+                    item_texts.append(node)
+            elif name == 'table':
+                for cell in open_cells:
+                    cell.append(node)
+            else:
+                texts.append(node)
+        elif name in ('ul', 'ol') and node.name == 'li':
+            # 处理列表（包括嵌套列表中的项目），段落按列表项出现的顺序创建
+            if event == 'start':
+                open_items.append((doc.add_paragraph(style=style), []))
+            else:
+                para, item_texts = open_items.pop()
+                run = para.add_run(''.join(item_texts))
                 set_font_color(run)
-        elif element.name == 'table':
-            # 处理表格
-            rows = element.find_all('tr')
-            if rows:
-                # 确定表格列数
-                first_row = rows[0]
-                cols = max(len(first_row.find_all('th')), len(first_row.find_all('td')))
-                
-                # 创建表格
-                table = doc.add_table(rows=0, cols=cols)
-                table.style = 'Table Grid'
-                
-                # 填充表格内容
-                for row in rows:
-                    doc_row = table.add_row().cells
-                    th_cells = row.find_all('th')
-                    td_cells = row.find_all('td')
-                    
-                    # 优先使用表头单元格
-                    cells = th_cells if th_cells else td_cells
-                    
-                    for i, cell in enumerate(cells):
-                        if i < len(doc_row):
-                            run = doc_row[i].paragraphs[0].add_run(cell.text)
-                            set_font_color(run)
-        elif element.name == 'pre':
-            # 处理代码块
-            para = doc.add_paragraph()
-            run = para.add_run(element.text)
-            run.font.name = 'Courier New'
-            run.font.size = Pt(10)
-            set_font_color(run)
-        elif element.name == 'code':
-            # 处理行内代码
-            para = doc.add_paragraph()
-            run = para.add_run(element.text)
-            run.font.name = 'Courier New'
-            set_font_color(run)
-        elif element.name == 'br':
-            # 处理换行
-            doc.add_paragraph()
-
-
-def md_to_docx(md_path, docx_path):
+        elif name == 'table' and node.name == 'tr':
+            if event == 'start':
+                row = (node, [], [])
+                rows.append(row)
+                open_rows.append(row)
+            else:
+                open_rows.pop()
+        elif name == 'table' and node.name in ('th', 'td'):
+            # 只收集直接属于当前行的单元格
+            if not open_rows or node.parent is not open_rows[-1][0]:
+                continue
+            if event == 'start':
+                cell = []
+                open_rows[-1][1 if node.name == 'th' else 2].append(cell)
+                open_cells.append(cell)
+            else:
+                open_cells.pop()
+
+
+def md_to_docx(md_path, docx_path, check_cancelled=None):
+    """check_cancelled 在各阶段之间调用（后台任务用于响应取消），抛出的异常会中止转换且不保存文件"""
+    import markdown
+
     # 创建Document对象
     doc = Document()
     
@@ -111,14 +198,115 @@ def md_to_docx(md_path, docx_path):
     html_content = markdown.markdown(md_content)
     
     # 将HTML内容添加到Word文档中
-    add_html_to_docx(doc, html_content)
+    add_html_to_docx(doc, html_content, check_cancelled)
     
     # 保存Word文档
+    if check_cancelled:
+        check_cancelled()
     doc.save(docx_path)
     print(f'Word文档已生成: {docx_path}')
 
 
+def content_hash(path):
+    """Markdown文件内容和转换器版本的哈希值"""
+    digest = hashlib.sha256(f'v{CONVERTER_VERSION}:'.encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def collect_sources(patterns):
+    """展开目录（其中的 .md 文件）和通配符，返回去重后的文件列表"""
+    sources = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, '*.md'))
+        else:
+            matches = glob.glob(pattern, recursive=True)
+        sources.extend(os.path.abspath(path) for path in sorted(matches) if path.endswith('.md'))
+    return list(dict.fromkeys(sources))
+
+
+def load_manifest(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    # 先写临时文件再替换，中断时不会留下损坏的清单
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def convert_one(md_path, docx_path):
+    """在子进程中转换单个文件，返回 (源文件, 错误信息)"""
+    try:
+        md_to_docx(md_path, docx_path)
+        return md_path, None
+    except Exception as e:
+        return md_path, f'{type(e).__name__}: {e}'
+
+
+def batch_convert(patterns, out_dir=None, workers=None, force=False, manifest_path=None):
+    """批量转换：内容未变化（哈希与清单一致且输出文件存在）的文件会被跳过，其余文件在进程池中并行转换"""
+    sources = collect_sources(patterns)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    manifest_path = manifest_path or os.path.join(out_dir or os.getcwd(), MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+
+    pending = {}
+    skipped = 0
+    for md_path in sources:
+        docx_path = os.path.join(out_dir or os.path.dirname(md_path),
+                                 os.path.splitext(os.path.basename(md_path))[0] + '.docx')
+        digest = content_hash(md_path)
+        entry = manifest.get(md_path)
+        if not force and entry and entry['hash'] == digest and os.path.exists(entry['output']) \
+                and entry['output'] == docx_path:
+            skipped += 1
+            continue
+        pending[md_path] = (docx_path, digest)
+
+    failed = []
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(convert_one, md_path, docx_path)
+                       for md_path, (docx_path, _) in pending.items()]
+            for future in as_completed(futures):
+                md_path, error = future.result()
+                if error:
+                    failed.append((md_path, error))
+                    manifest.pop(md_path, None)
+                else:
+                    docx_path, digest = pending[md_path]
+                    manifest[md_path] = {'hash': digest, 'output': docx_path}
+        save_manifest(manifest_path, manifest)
+
+    print(f'共 {len(sources)} 个文件：转换 {len(pending) - len(failed)} 个，跳过未变化的 {skipped} 个，失败 {len(failed)} 个')
+    for md_path, error in failed:
+        print(f'转换失败 {md_path}: {error}')
+    return not failed
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Markdown 转 Word；不带参数时转换系统完整报告')
+    parser.add_argument('sources', nargs='*', help='Markdown 文件、目录或通配符（如 "reports/**/*.md"）')
+    parser.add_argument('--out-dir', help='输出目录，默认与源文件相同')
+    parser.add_argument('--workers', type=int, default=None, help='并行进程数，默认为 CPU 核数')
+    parser.add_argument('--force', action='store_true', help='忽略清单，重新转换所有文件')
+    parser.add_argument('--manifest', help=f'转换清单文件，默认为输出目录（或当前目录）下的 {MANIFEST_NAME}')
+    args = parser.parse_args()
+
+    if args.sources:
+        ok = batch_convert(args.sources, args.out_dir, args.workers, args.force, args.manifest)
+        raise SystemExit(0 if ok else 1)
+
     md_file = '系统完整报告.md'
     docx_file = '超市财务管理系统完整报告_new.docx'
-    md_to_docx(md_file, docx_file)
\ No newline at end of file
+    md_to_docx(md_file, docx_file)
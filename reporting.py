@@ -0,0 +1,173 @@
+"""报表聚合：用一条 UNION ALL 语句一次算出某个期间的全部财务指标
+
+每张明细表只按日期索引扫描一次窗口内的数据，查询次数不随期间长度或指标数量增加。
+传入 sources 时，明细表换成合并了已归档年度数据的子查询（见 archive.py）。
+本模块只依赖 SQLAlchemy，传入会话（或连接）即可使用，不依赖 app.py。
+"""
+from collections import namedtuple
+
+from sqlalchemy import DateTime, bindparam, text
+
+CategoryTotal = namedtuple('CategoryTotal', ['category', 'total_amount'])
+
+PeriodMetrics = namedtuple('PeriodMetrics', [
+    'sales',                # 期间销售额
+    'sub_sales',            # 子区间（如今日）销售额
+    'purchases',            # 期间采购成本
+    'expenses',             # 期间费用合计
+    'other_income',         # 期间其他收入合计
+    'expense_categories',   # 费用分类统计（按金额降序）
+    'income_categories',    # 收入分类统计（按金额降序）
+    'inventory_value',      # 当前库存价值（按成本价）
+    'low_stock_count',      # 当前需补货商品数（有补货建议时按补货点，否则库存小于 low_stock）
+    'product_count',        # 商品总数
+])
+
+MonthlyFlow = namedtuple('MonthlyFlow', ['month', 'sales', 'purchases', 'expenses', 'other_income'])
+
+LEDGER_TABLES = ('sale', 'purchase', 'expense', 'income')
+
+
+def ledger_sql(template, sources=None):
+    """把语句模板中的 {sale} 等占位符替换为明细表；sources 可把某张表换成合并了归档数据的子查询"""
+    names = {table: table for table in LEDGER_TABLES}
+    names.update(sources or {})
+    return text(template.format(**names))
+
+
+# 列：指标名、分类、金额、附加值（销售行为子区间销售额，库存行为低库存数量）
+PERIOD_METRICS_TEMPLATE = '''
+    SELECT 'sales' AS metric, NULL AS category,
+           COALESCE(SUM(total_amount), 0) AS amount,
+           COALESCE(SUM(CASE WHEN sale_date >= :sub_start AND sale_date < :sub_end
+                             THEN total_amount ELSE 0 END), 0) AS extra
+    FROM {sale} WHERE sale_date >= :start AND sale_date < :end
+    UNION ALL
+    SELECT 'purchases', NULL, COALESCE(SUM(total_cost), 0), 0
+    FROM {purchase} WHERE purchase_date >= :start AND purchase_date < :end
+    UNION ALL
+    SELECT 'expense', category, SUM(amount), 0
+    FROM {expense} WHERE expense_date >= :start AND expense_date < :end
+    GROUP BY category
+    UNION ALL
+    SELECT 'income', category, SUM(amount), 0
+    FROM {income} WHERE income_date >= :start AND income_date < :end
+    GROUP BY category
+    UNION ALL
+    SELECT 'inventory', NULL,
+           COALESCE(SUM(product.cost_price * inventory.quantity), 0),
+           COALESCE(SUM(CASE WHEN replenishment_plan.product_id IS NULL THEN inventory.quantity < :low_stock
+                             ELSE inventory.quantity <= replenishment_plan.reorder_point END), 0)
+    FROM inventory JOIN product ON product.id = inventory.product_id
+    LEFT JOIN replenishment_plan ON replenishment_plan.product_id = inventory.product_id
+    UNION ALL
+    SELECT 'products', NULL, COUNT(*), 0 FROM product
+'''
+
+
+def period_metrics_sql(sources=None):
+    return ledger_sql(PERIOD_METRICS_TEMPLATE, sources).bindparams(
+        *(bindparam(name, type_=DateTime) for name in ('start', 'end', 'sub_start', 'sub_end')))
+
+
+PERIOD_METRICS_SQL = period_metrics_sql()
+
+
+def period_metrics(session, window, sub_window=None, low_stock=10, sources=None):
+    """计算 [start, end) 期间的指标；sub_window 应位于 window 之内，用于同时统计如今日销售额"""
+    start, end = window
+    sub_start, sub_end = sub_window or window
+    statement = period_metrics_sql(sources) if sources else PERIOD_METRICS_SQL
+    rows = session.execute(statement, {
+        'start': start, 'end': end,
+        'sub_start': sub_start, 'sub_end': sub_end,
+        'low_stock': low_stock,
+    }).all()
+
+    values = {}
+    expense_categories = []
+    income_categories = []
+    for metric, category, amount, extra in rows:
+        if metric == 'expense':
+            expense_categories.append(CategoryTotal(category, amount))
+        elif metric == 'income':
+            income_categories.append(CategoryTotal(category, amount))
+        else:
+            values[metric] = (amount, extra)
+    expense_categories.sort(key=lambda item: item.total_amount, reverse=True)
+    income_categories.sort(key=lambda item: item.total_amount, reverse=True)
+
+    return PeriodMetrics(
+        sales=values['sales'][0],
+        sub_sales=values['sales'][1],
+        purchases=values['purchases'][0],
+        expenses=sum(item.total_amount for item in expense_categories),
+        other_income=sum(item.total_amount for item in income_categories),
+        expense_categories=expense_categories,
+        income_categories=income_categories,
+        inventory_value=values['inventory'][0],
+        low_stock_count=int(values['inventory'][1]),
+        product_count=int(values['products'][0]),
+    )
+
+
+# 按月分组的发生额，列：指标名、月份（YYYY-MM）、金额
+MONTHLY_FLOWS_TEMPLATE = '''
+    SELECT 'sales' AS metric, strftime('%Y-%m', sale_date) AS month, SUM(total_amount) AS amount
+    FROM {sale} WHERE sale_date >= :start AND sale_date < :end GROUP BY month
+    UNION ALL
+    SELECT 'purchases', strftime('%Y-%m', purchase_date), SUM(total_cost)
+    FROM {purchase} WHERE purchase_date >= :start AND purchase_date < :end GROUP BY 2
+    UNION ALL
+    SELECT 'expenses', strftime('%Y-%m', expense_date), SUM(amount)
+    FROM {expense} WHERE expense_date >= :start AND expense_date < :end GROUP BY 2
+    UNION ALL
+    SELECT 'other_income', strftime('%Y-%m', income_date), SUM(amount)
+    FROM {income} WHERE income_date >= :start AND income_date < :end GROUP BY 2
+'''
+
+
+def monthly_flows(session, window, sources=None):
+    """[start, end) 期间逐月的发生额，一条语句算出，返回按月份排序的 MonthlyFlow 列表（没有业务的月份为 0）"""
+    start, end = window
+    statement = ledger_sql(MONTHLY_FLOWS_TEMPLATE, sources).bindparams(
+        *(bindparam(name, type_=DateTime) for name in ('start', 'end')))
+    totals = {}
+    for metric, month, amount in session.execute(statement, {'start': start, 'end': end}):
+        totals.setdefault(month, {})[metric] = amount or 0
+
+    flows = []
+    month_start = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while month_start < end:
+        key = f'{month_start:%Y-%m}'
+        values = totals.get(key, {})
+        flows.append(MonthlyFlow(key, *(values.get(field, 0) for field in MonthlyFlow._fields[1:])))
+        month_start = month_start.replace(year=month_start.year + month_start.month // 12,
+                                          month=month_start.month % 12 + 1)
+    return flows
+
+
+def combine_metrics(parts, closing=None):
+    """合并按时间顺序排列的多段期间指标：发生额相加，库存价值等时点指标取 closing（默认最后一段）"""
+    closing = closing or parts[-1]
+
+    def merge_categories(lists):
+        totals = {}
+        for items in lists:
+            for category, amount in items:
+                totals[category] = totals.get(category, 0) + amount
+        return sorted((CategoryTotal(category, amount) for category, amount in totals.items()),
+                      key=lambda item: item.total_amount, reverse=True)
+
+    return PeriodMetrics(
+        sales=sum(part.sales for part in parts),
+        sub_sales=sum(part.sub_sales for part in parts),
+        purchases=sum(part.purchases for part in parts),
+        expenses=sum(part.expenses for part in parts),
+        other_income=sum(part.other_income for part in parts),
+        expense_categories=merge_categories(part.expense_categories for part in parts),
+        income_categories=merge_categories(part.income_categories for part in parts),
+        inventory_value=closing.inventory_value,
+        low_stock_count=closing.low_stock_count,
+        product_count=closing.product_count,
+    )
@@ -0,0 +1,209 @@
+"""生成压测用的模拟数据：商品、供应商、采购、销售、费用和收入，销售量带有周末和季节波动
+
+用法：python seed_data.py --db bench.db --sales 1000000 [--days 730] [--products 2000]
+数据写入 --db 指定的独立数据库（默认 bench.db），不会影响 finance.db。
+销售等明细用 sqlite3 的 executemany 分批插入，插入完成后再一次性生成库存、库存流水、销售日汇总和库存快照。
+"""
+import argparse
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+CATEGORIES = ['食品', '饮料', '日用品', '生鲜', '烟酒', '零食', '粮油', '家电', '服装', '母婴']
+EXPENSE_CATEGORIES = ['房租', '水电', '工资', '运输', '维修', '办公用品']
+INCOME_CATEGORIES = ['租金收入', '返利', '废品回收', '广告位', '其他']
+BATCH_SIZE = 50000
+
+
+def seasonal_factor(day):
+    # 年内波动（春节前后和年底高峰）乘以周末系数
+    yearly = 1 + 0.25 * math.cos(2 * math.pi * (day.timetuple().tm_yday - 20) / 365)
+    weekend = 1.35 if day.weekday() >= 5 else 1.0
+    return yearly * weekend
+
+
+def day_weights(days, end_day):
+    dates = [end_day - timedelta(days=offset) for offset in range(days - 1, -1, -1)]
+    return dates, [seasonal_factor(day) for day in dates]
+
+
+def spread_over_days(total, dates, weights, rng):
+    # 按权重把 total 条记录分到每一天（加少量随机噪声），返回每天的数量
+    noisy = [weight * rng.uniform(0.85, 1.15) for weight in weights]
+    scale = total / sum(noisy)
+    counts = [int(weight * scale) for weight in noisy]
+    for i in rng.sample(range(len(dates)), min(total - sum(counts), len(dates))):
+        counts[i] += 1
+    return counts
+
+
+def timestamps(day, count, rng):
+    # 营业时间 8:00-22:00 内按时间顺序排列的时间戳（与 SQLAlchemy 存储格式一致）
+    prefix = day.isoformat()
+    for seconds in sorted(rng.randrange(8 * 3600, 22 * 3600) for _ in range(count)):
+        yield f'{prefix} {seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}.000000'
+
+
+def insert_batches(conn, sql, rows):
+    batch = []
+    inserted = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany(sql, batch)
+            inserted += len(batch)
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+        inserted += len(batch)
+    return inserted
+
+
+def seed(db_path, products=2000, suppliers=50, sales=1000000, days=730,
+         expenses_per_day=5, incomes_per_day=2, seed_value=42, log=print):
+    """在 db_path 新建数据库并填充模拟数据，返回各表行数"""
+    # 数据库路径在导入 app 时读取，因此先设置环境变量再导入
+    os.environ['FINANCE_DB_PATH'] = os.path.abspath(db_path)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as finance_app
+    finance_app.create_db()
+    with finance_app.app.app_context():
+        finance_app.db.engine.dispose()
+
+    rng = random.Random(seed_value)
+    end_day = date.today() - timedelta(days=1)
+    dates, weights = day_weights(days, end_day)
+    started = time.time()
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -256000')
+    with conn:
+        product_rows = []
+        for i in range(products):
+            category = CATEGORIES[i % len(CATEGORIES)]
+            cost_price = round(rng.uniform(1, 200), 2)
+            product_rows.append((f'{category}商品{i + 1:05d}', category,
+                                 round(cost_price * rng.uniform(1.1, 1.6), 2), cost_price))
+        conn.executemany('INSERT INTO product (name, category, price, cost_price) VALUES (?, ?, ?, ?)', product_rows)
+        conn.executemany('INSERT INTO supplier (name, contact, phone, address) VALUES (?, ?, ?, ?)', [
+            (f'供应商{i + 1:03d}', f'联系人{i + 1}', f'138{i:08d}', f'工业园区{i + 1}号') for i in range(suppliers)
+        ])
+        product_ids = [row[0] for row in conn.execute('SELECT id FROM product ORDER BY id')]
+        supplier_ids = [row[0] for row in conn.execute('SELECT id FROM supplier ORDER BY id')]
+        prices = {row[0]: (row[1], row[2]) for row in conn.execute('SELECT id, price, cost_price FROM product')}
+    log(f'商品 {products} 个，供应商 {suppliers} 个')
+
+    # 少数畅销商品占大部分销量（近似 Zipf 分布）
+    popularity = [1 / (rank + 1) ** 0.8 for rank in range(len(product_ids))]
+    rng.shuffle(popularity)
+    cumulative = []
+    running = 0
+    for weight in popularity:
+        running += weight
+        cumulative.append(running)
+
+    sold = dict.fromkeys(product_ids, 0)
+
+    def sale_rows():
+        for day, count in zip(dates, spread_over_days(sales, dates, weights, rng)):
+            chosen = rng.choices(product_ids, cum_weights=cumulative, k=count)
+            for product_id, moment in zip(chosen, timestamps(day, count, rng)):
+                quantity = 1 if rng.random() < 0.7 else rng.randint(2, 6)
+                sold[product_id] += quantity
+                yield (product_id, quantity, round(prices[product_id][0] * quantity, 2),
+                       round(prices[product_id][1] * quantity, 2), moment)
+
+    with conn:
+        inserted = insert_batches(conn, 'INSERT INTO sale (product_id, quantity, total_amount, total_cost, '
+                                        'sale_date) VALUES (?, ?, ?, ?, ?)', sale_rows())
+    log(f'销售 {inserted} 条，用时 {time.time() - started:.1f} 秒')
+
+    # 采购：每个商品每两周左右补货一次，总量覆盖销量并留有余量
+    def purchase_rows():
+        restock_every = 14
+        for start in range(0, days, restock_every):
+            day = dates[start]
+            for product_id, moment in zip(product_ids, timestamps(day, len(product_ids), rng)):
+                share = sold[product_id] * restock_every / days
+                quantity = max(1, int(share * rng.uniform(1.05, 1.3)) + rng.randint(0, 10))
+                yield (product_id, rng.choice(supplier_ids), quantity,
+                       round(prices[product_id][1] * quantity, 2), moment)
+
+    with conn:
+        inserted = insert_batches(conn, 'INSERT INTO purchase (product_id, supplier_id, quantity, total_cost, '
+                                        'purchase_date) VALUES (?, ?, ?, ?, ?)', purchase_rows())
+    log(f'采购 {inserted} 条')
+
+    def ledger_rows(per_day, categories, low, high):
+        for day, weight in zip(dates, weights):
+            count = max(0, round(per_day * rng.uniform(0.5, 1.5)))
+            for moment in timestamps(day, count, rng):
+                category = rng.choice(categories)
+                yield category, round(rng.uniform(low, high) * weight, 2), category, moment
+
+    with conn:
+        expense_count = insert_batches(conn, 'INSERT INTO expense (description, amount, category, expense_date) '
+                                             'VALUES (?, ?, ?, ?)',
+                                       ledger_rows(expenses_per_day, EXPENSE_CATEGORIES, 50, 3000))
+        income_count = insert_batches(conn, 'INSERT INTO income (description, amount, category, income_date) '
+                                            'VALUES (?, ?, ?, ?)',
+                                      ledger_rows(incomes_per_day, INCOME_CATEGORIES, 20, 1500))
+    log(f'费用 {expense_count} 条，收入 {income_count} 条')
+
+    # 派生数据：库存、库存流水、销售日汇总，以及作为按时点查询起点的库存快照
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+    with conn:
+        conn.execute('DELETE FROM inventory')
+        conn.execute('''INSERT INTO inventory (product_id, quantity, last_updated)
+                        SELECT product.id,
+                               COALESCE((SELECT SUM(quantity) FROM purchase WHERE product_id = product.id), 0)
+                               - COALESCE((SELECT SUM(quantity) FROM sale WHERE product_id = product.id), 0), ?
+                        FROM product''', (now,))
+        conn.execute('DELETE FROM stock_movement')
+        conn.execute('''INSERT INTO stock_movement (product_id, change, reason, ref_id, moved_at)
+                        SELECT product_id, quantity, 'purchase', id, purchase_date FROM purchase
+                        UNION ALL
+                        SELECT product_id, -quantity, 'sale', id, sale_date FROM sale
+                        ORDER BY 5''')
+        for statement in finance_app.rebuild_sales_summary_sql():
+            conn.execute(statement)
+        conn.execute('DELETE FROM stock_snapshot')
+        conn.execute('INSERT INTO stock_snapshot (snapshot_at, product_id, quantity) '
+                     'SELECT ?, product_id, quantity FROM inventory', (now,))
+    conn.execute('ANALYZE')
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('product', 'supplier', 'purchase', 'sale', 'expense', 'income', 'stock_movement')}
+    conn.close()
+    log(f'完成，总用时 {time.time() - started:.1f} 秒')
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='生成压测用的模拟数据')
+    parser.add_argument('--db', default='bench.db', help='目标数据库文件（默认 bench.db）')
+    parser.add_argument('--force', action='store_true', help='目标数据库已存在时删除后重建')
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--suppliers', type=int, default=50)
+    parser.add_argument('--sales', type=int, default=1000000, help='销售记录数，可到千万级')
+    parser.add_argument('--days', type=int, default=730, help='数据覆盖的天数（截至昨天）')
+    parser.add_argument('--expenses-per-day', type=float, default=5)
+    parser.add_argument('--incomes-per-day', type=float, default=2)
+    parser.add_argument('--seed', type=int, default=42, help='随机数种子，相同参数生成相同数据')
+    args = parser.parse_args()
+
+    if os.path.abspath(args.db) == os.path.abspath('finance.db'):
+        parser.error('不能写入 finance.db，请指定其他文件')
+    if os.path.exists(args.db):
+        if not args.force:
+            parser.error(f'{args.db} 已存在，使用 --force 重建')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+    print(seed(args.db, args.products, args.suppliers, args.sales, args.days,
+               args.expenses_per_day, args.incomes_per_day, args.seed))
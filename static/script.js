@@ -11,6 +11,73 @@ function validateForm() {
     return true;
 }
 
+// 商品/供应商输入联想：输入框带 data-typeahead 属性（搜索接口地址），
+// 选中结果后把 id 写入同一 .typeahead 容器中的隐藏字段
+let typeaheadTimer = null;
+
+function showTypeaheadResults(input, items) {
+    const container = input.closest('.typeahead');
+    const results = container.querySelector('.typeahead-results');
+    results.innerHTML = '';
+    items.forEach(item => {
+        const option = document.createElement('button');
+        option.type = 'button';
+        option.className = 'list-group-item list-group-item-action';
+        option.textContent = item.label;
+        option.addEventListener('click', function() {
+            input.value = item.name;
+            container.querySelector('input[type=hidden]').value = item.id;
+            results.innerHTML = '';
+        });
+        results.appendChild(option);
+    });
+}
+
+document.addEventListener('input', function(e) {
+    const input = e.target;
+    if (!input.dataset || !input.dataset.typeahead) {
+        return;
+    }
+    input.closest('.typeahead').querySelector('input[type=hidden]').value = '';
+    clearTimeout(typeaheadTimer);
+    const q = input.value.trim();
+    if (!q) {
+        showTypeaheadResults(input, []);
+        return;
+    }
+    typeaheadTimer = setTimeout(function() {
+        fetch(input.dataset.typeahead + '?q=' + encodeURIComponent(q))
+            .then(response => response.json())
+            .then(items => showTypeaheadResults(input, items));
+    }, 150);
+});
+
+// 提交前确认联想输入框都已选中结果
+document.addEventListener('submit', function(e) {
+    const unselected = Array.from(e.target.querySelectorAll('.typeahead')).some(
+        container => !container.querySelector('input[type=hidden]').value
+    );
+    if (unselected) {
+        e.preventDefault();
+        alert('请从搜索结果中选择');
+    }
+});
+
+// 首页实时统计：服务器推送有变化的指标，只替换对应的数字，不刷新整个页面
+function connectDashboardStream(container) {
+    const source = new EventSource(container.dataset.dashboardStream);
+    source.onmessage = function(e) {
+        const stats = JSON.parse(e.data);
+        Object.keys(stats).forEach(name => {
+            const element = container.querySelector('[data-stat="' + name + '"]');
+            if (element && element.textContent !== String(stats[name])) {
+                element.textContent = stats[name];
+            }
+        });
+    };
+    // 连接断开时浏览器会按服务器给出的 retry 间隔自动重连，重连后先收到完整统计
+}
+
 // 页面加载完成后的初始化
 document.addEventListener('DOMContentLoaded', function() {
     // 添加删除确认事件监听器到所有带有delete-btn类的按钮
@@ -22,4 +89,32 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         });
     });
+    
+    // 整单结账：添加/删除商品行
+    const basketLines = document.getElementById('basket-lines');
+    const addLineButton = document.getElementById('add-line');
+    if (basketLines && addLineButton) {
+        addLineButton.addEventListener('click', function() {
+            const line = basketLines.querySelector('.basket-line').cloneNode(true);
+            line.querySelectorAll('input').forEach(field => { field.value = ''; });
+            line.querySelectorAll('.typeahead-results').forEach(results => { results.innerHTML = ''; });
+            basketLines.appendChild(line);
+        });
+        basketLines.addEventListener('click', function(e) {
+            if (e.target.classList.contains('remove-line') && basketLines.children.length > 1) {
+                e.target.closest('.basket-line').remove();
+            }
+        });
+    }
+    
+    const dashboard = document.querySelector('[data-dashboard-stream]');
+    if (dashboard && window.EventSource) {
+        connectDashboardStream(dashboard);
+    }
+    
+    // 后台任务页面：有未完成的任务时定时刷新
+    const autoRefresh = document.querySelector('[data-auto-refresh]');
+    if (autoRefresh) {
+        setTimeout(() => location.reload(), parseInt(autoRefresh.dataset.autoRefresh, 10));
+    }
 });